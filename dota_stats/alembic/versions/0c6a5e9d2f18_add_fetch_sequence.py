@@ -0,0 +1,29 @@
+"""Add fetch sequence cursor
+
+Revision ID: 0c6a5e9d2f18
+Revises: e84f27b6d915
+Create Date: 2021-01-16 11:25:09.873415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0c6a5e9d2f18'
+down_revision = 'e84f27b6d915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create table for the match sequence number cursor"""
+    op.create_table("dota_fetch_sequence",
+                    sa.Column('name', sa.String(32), primary_key=True),
+                    sa.Column('match_seq_num', sa.BigInteger),
+                    sa.Column('updated', sa.BigInteger))
+
+
+def downgrade():
+    """Drop match sequence number cursor table"""
+    op.drop_table("dota_fetch_sequence")
@@ -0,0 +1,58 @@
+"""Add hero columns and masks to matches
+
+Revision ID: 3d8a5c2f7b19
+Revises: 7f2b4d1e9a63
+Create Date: 2021-01-21 20:42:18.731504
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d8a5c2f7b19'
+down_revision = '7f2b4d1e9a63'
+branch_labels = None
+depends_on = None
+
+COLUMNS = ["{0}_hero{1}".format(team, idx) for team in ["radiant", "dire"]
+           for idx in range(1, 6)]
+MASKS = ["{0}_mask_{1}".format(team, half) for team in ["radiant", "dire"]
+         for half in ["lo", "hi"]]
+
+
+def upgrade():
+    """Integer hero columns and hero bitmasks, existing rows are filled in
+    with `python db_util.py --backfill`.
+
+    The new columns are deliberately not indexed. A mask test
+    (`Match.has_hero`) can't use a B-tree index, and a hero on a team may be
+    in any of five position columns. Every query filters on a start time
+    range and skill first, served by ix_start_time (ix_skill_start_time and
+    ix_start_time_skill from 9a4c7e2b5d16), and the hero test only runs on
+    those rows. Ten more indexes would slow every match insert."""
+
+    # One ALTER so MariaDB copies the table once
+    if op.get_bind().dialect.name == "mysql":
+        op.execute("ALTER TABLE dota_matches " + ", ".join(
+            ["ADD COLUMN {} SMALLINT".format(t) for t in COLUMNS] +
+            ["ADD COLUMN {} BIGINT".format(t) for t in MASKS]))
+        return
+
+    with op.batch_alter_table("dota_matches") as batch_op:
+        for column in COLUMNS:
+            batch_op.add_column(sa.Column(column, sa.SmallInteger))
+        for column in MASKS:
+            batch_op.add_column(sa.Column(column, sa.BigInteger))
+
+
+def downgrade():
+    """Drop hero columns and masks"""
+    if op.get_bind().dialect.name == "mysql":
+        op.execute("ALTER TABLE dota_matches " + ", ".join(
+            "DROP COLUMN {}".format(t) for t in COLUMNS + MASKS))
+        return
+
+    with op.batch_alter_table("dota_matches") as batch_op:
+        for column in COLUMNS + MASKS:
+            batch_op.drop_column(column)
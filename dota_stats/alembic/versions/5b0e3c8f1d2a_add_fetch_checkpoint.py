@@ -0,0 +1,30 @@
+"""Add fetch checkpoint
+
+Revision ID: 5b0e3c8f1d2a
+Revises: c71c3f058b8c
+Create Date: 2021-01-09 10:12:41.208311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e3c8f1d2a'
+down_revision = 'c71c3f058b8c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create table to checkpoint fetch progress for each skill"""
+    op.create_table("dota_fetch_checkpoint",
+                    sa.Column('skill', sa.Integer, primary_key=True),
+                    sa.Column('hero', sa.Integer),
+                    sa.Column('start_at_match_id', sa.BigInteger),
+                    sa.Column('updated', sa.BigInteger))
+
+
+def downgrade():
+    """Drop fetch checkpoint table"""
+    op.drop_table("dota_fetch_checkpoint")
@@ -0,0 +1,66 @@
+"""Partition by time
+
+Revision ID: 5e27c9d04b81
+Revises: b6e1f04a9c3d
+Create Date: 2021-01-24 16:31:07.905113
+
+"""
+import time
+from datetime import datetime as dt
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5e27c9d04b81'
+down_revision = 'b6e1f04a9c3d'
+branch_labels = None
+depends_on = None
+
+DAY = 24*60*60
+DAYS_AHEAD = 7
+
+# Table, time column, primary key before and after partitioning
+TABLES = [
+    ("dota_matches", "start_time", ["match_id"]),
+    ("dota_hero_win_rate", "time", ["time_hero_skill"]),
+    ("dota_match_players", "start_time", ["match_id", "hero_id"]),
+]
+
+
+def upgrade():
+    """RANGE partition tables by day on their time column. Every unique key
+    must include the partitioning column, so it is added to the primary
+    key. Only MariaDB supports partitioning, elsewhere this does nothing."""
+
+    conn = op.get_bind()
+    if conn.dialect.name != "mysql":
+        return
+
+    end = (int(time.time())//DAY + DAYS_AHEAD + 1)*DAY
+    for table, column, keys in TABLES:
+        first = conn.execute("SELECT MIN({0}) FROM {1}".format(
+            column, table)).first()[0]
+        first = int(time.time()) if first is None else int(first)
+
+        partitions = ["PARTITION p{0} VALUES LESS THAN ({1})".format(
+            dt.utcfromtimestamp(t - DAY).strftime("%Y%m%d"), t)
+                      for t in range((first//DAY + 1)*DAY, end + 1, DAY)]
+        partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+        op.execute("ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY "
+                   "({1}) PARTITION BY RANGE ({2}) ({3})".format(
+                       table, ", ".join(keys + [column]), column,
+                       ", ".join(partitions)))
+
+
+def downgrade():
+    """Remove partitioning and restore primary keys"""
+
+    conn = op.get_bind()
+    if conn.dialect.name != "mysql":
+        return
+
+    for table, _, keys in TABLES:
+        op.execute("ALTER TABLE {0} REMOVE PARTITIONING".format(table))
+        op.execute("ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY "
+                   "({1})".format(table, ", ".join(keys)))
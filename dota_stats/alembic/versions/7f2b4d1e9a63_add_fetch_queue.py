@@ -0,0 +1,37 @@
+"""Add fetch work queue
+
+Revision ID: 7f2b4d1e9a63
+Revises: 0c6a5e9d2f18
+Create Date: 2021-01-19 21:14:36.440187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f2b4d1e9a63'
+down_revision = '0c6a5e9d2f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create lease based work queue for fetch workers"""
+    op.create_table("dota_fetch_queue",
+                    sa.Column('hero', sa.Integer, primary_key=True),
+                    sa.Column('skill', sa.Integer, primary_key=True),
+                    sa.Column('window_start', sa.BigInteger,
+                              primary_key=True),
+                    sa.Column('status', sa.String(16)),
+                    sa.Column('owner', sa.String(64)),
+                    sa.Column('lease_expires', sa.BigInteger),
+                    sa.Column('attempts', sa.Integer),
+                    sa.Column('updated', sa.BigInteger))
+    op.create_index('ix_dota_fetch_queue_status', 'dota_fetch_queue',
+                    ['status'])
+
+
+def downgrade():
+    """Drop fetch work queue"""
+    op.drop_table("dota_fetch_queue")
@@ -0,0 +1,102 @@
+"""InnoDB and covering indexes
+
+Not an online migration on MariaDB: stop `fetch.py` and the other cron jobs
+which write before upgrading, the engine change blocks writes to each table
+while it is copied.
+
+Revision ID: 9a4c7e2b5d16
+Revises: 5e27c9d04b81
+Create Date: 2021-01-26 21:08:44.310527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c7e2b5d16'
+down_revision = '5e27c9d04b81'
+branch_labels = None
+depends_on = None
+
+# Tables `db_util.create_database` used to make MyISAM. Upgrade converts
+# those still on MyISAM to InnoDB, downgrade converts them back
+MYISAM = ["dota_matches", "dota_fetch_summary"]
+
+# Table, index, columns added and index, columns replaced. The hourly scan in
+# `win_rate_pick_rate.main` is answered from ix_skill_start_time alone, and
+# the `start_time` range scans in `fetch.py`/`fetch_summary.py` from
+# ix_start_time_skill (InnoDB secondary indexes carry the primary key).
+INDEXES = [
+    ("dota_matches", "ix_skill_start_time",
+     ["api_skill", "start_time", "radiant_win", "radiant_heroes",
+      "dire_heroes"], None, None),
+    ("dota_matches", "ix_start_time_skill", ["start_time", "api_skill"],
+     "ix_start_time", ["start_time"]),
+    ("dota_hero_win_rate", "ix_time_hero_skill_rates",
+     ["time", "hero", "skill", "radiant_win", "radiant_total", "dire_win",
+      "dire_total"],
+     "ix_time_hero_skill", ["time", "hero", "skill"]),
+]
+
+
+def get_indexes(conn, table):
+    """Names of the indexes on `table`"""
+    return {t['name'] for t in sa.inspect(conn).get_indexes(table)}
+
+
+def upgrade():
+    """Convert MyISAM tables to InnoDB, so fetch writes no longer take table
+    locks against analytics reads, then add covering indexes online. An
+    engine change rebuilds the table and MariaDB can't do it without
+    blocking writes, so the fetcher must be stopped while it runs. Reads
+    carry on (LOCK=SHARED). A table already converted with an online tool
+    such as pt-online-schema-change is left alone, as are indexes which
+    `db_util.create_database` already made."""
+
+    conn = op.get_bind()
+    mysql = conn.dialect.name == "mysql"
+    if mysql:
+        myisam = {t[0] for t in conn.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES WHERE "
+            "TABLE_SCHEMA=DATABASE() AND ENGINE='MyISAM'")}
+        for table in MYISAM:
+            if table in myisam:
+                op.execute("ALTER TABLE {0} ENGINE=InnoDB, ALGORITHM=COPY, "
+                           "LOCK=SHARED".format(table))
+
+    for table, index, columns, replaces, _ in INDEXES:
+        existing = get_indexes(conn, table)
+        add = index not in existing
+        drop = replaces in existing
+        if not mysql:
+            if add:
+                op.create_index(index, table, columns)
+            if drop:
+                op.drop_index(replaces, table)
+            continue
+
+        changes = []
+        if add:
+            changes.append("ADD INDEX {0} ({1})".format(index,
+                                                        ", ".join(columns)))
+        if drop:
+            changes.append("DROP INDEX {0}".format(replaces))
+        if changes:
+            op.execute("ALTER TABLE {0} {1}, ALGORITHM=INPLACE, "
+                       "LOCK=NONE".format(table, ", ".join(changes)))
+
+
+def downgrade():
+    """Restore the original indexes, and the MyISAM engine of the tables
+    `db_util.create_database` used to make"""
+
+    conn = op.get_bind()
+    for table, index, _, replaces, columns in INDEXES:
+        if replaces is not None:
+            op.create_index(replaces, table, columns)
+        op.drop_index(index, table)
+
+    if conn.dialect.name == "mysql":
+        for table in MYISAM:
+            op.execute("ALTER TABLE {0} ENGINE=MyISAM".format(table))
@@ -0,0 +1,30 @@
+"""Add fetch high water mark
+
+Revision ID: a3d91f6c0b47
+Revises: 5b0e3c8f1d2a
+Create Date: 2021-01-10 14:03:27.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d91f6c0b47'
+down_revision = '5b0e3c8f1d2a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create table of match history high water marks by hero and skill"""
+    op.create_table("dota_fetch_high_water",
+                    sa.Column('hero', sa.Integer, primary_key=True),
+                    sa.Column('skill', sa.Integer, primary_key=True),
+                    sa.Column('match_id', sa.BigInteger),
+                    sa.Column('updated', sa.BigInteger))
+
+
+def downgrade():
+    """Drop high water mark table"""
+    op.drop_table("dota_fetch_high_water")
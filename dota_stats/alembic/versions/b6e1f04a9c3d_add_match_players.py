@@ -0,0 +1,40 @@
+"""Add match players
+
+Revision ID: b6e1f04a9c3d
+Revises: 3d8a5c2f7b19
+Create Date: 2021-01-23 11:05:52.284617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import TINYINT
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e1f04a9c3d'
+down_revision = '3d8a5c2f7b19'
+branch_labels = None
+depends_on = None
+
+ITEM_SLOTS = ["item_0", "item_1", "item_2", "item_3", "item_4", "item_5",
+              "item_neutral", "backpack_0", "backpack_1", "backpack_2"]
+
+
+def upgrade():
+    """Create normalized per player table"""
+    op.create_table("dota_match_players",
+                    sa.Column('match_id', sa.BigInteger, primary_key=True),
+                    sa.Column('hero_id', sa.SmallInteger, primary_key=True),
+                    sa.Column('start_time', sa.BigInteger),
+                    sa.Column('player_slot', sa.SmallInteger),
+                    sa.Column('team', sa.SmallInteger().with_variant(
+                        TINYINT, 'mysql')),
+                    sa.Column('gold_spent', sa.Integer),
+                    *[sa.Column(t, sa.SmallInteger) for t in ITEM_SLOTS])
+    op.create_index('ix_dota_match_players_start_time', 'dota_match_players',
+                    ['start_time'])
+
+
+def downgrade():
+    """Drop per player table"""
+    op.drop_table("dota_match_players")
@@ -0,0 +1,29 @@
+"""Add high water start time
+
+Revision ID: d2f5a8c3e7b4
+Revises: 9a4c7e2b5d16
+Create Date: 2021-01-28 19:12:36.482907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f5a8c3e7b4'
+down_revision = '9a4c7e2b5d16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Start time of the newest match behind each high water mark. Existing
+    marks have none, so the next run pages those heroes fully once."""
+    op.add_column('dota_fetch_high_water',
+                  sa.Column('start_time', sa.BigInteger))
+
+
+def downgrade():
+    """Drop high water start time"""
+    with op.batch_alter_table('dota_fetch_high_water') as batch_op:
+        batch_op.drop_column('start_time')
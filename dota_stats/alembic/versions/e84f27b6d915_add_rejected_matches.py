@@ -0,0 +1,31 @@
+"""Add rejected matches
+
+Revision ID: e84f27b6d915
+Revises: a3d91f6c0b47
+Create Date: 2021-01-12 19:40:52.126730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e84f27b6d915'
+down_revision = 'a3d91f6c0b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create negative cache of rejected match IDs"""
+    op.create_table("dota_rejected_matches",
+                    sa.Column('match_id', sa.BigInteger, primary_key=True),
+                    sa.Column('reason', sa.String(32)),
+                    sa.Column('start_time', sa.BigInteger))
+    op.create_index('ix_dota_rejected_matches_start_time',
+                    'dota_rejected_matches', ['start_time'])
+
+
+def downgrade():
+    """Drop rejected matches table"""
+    op.drop_table("dota_rejected_matches")
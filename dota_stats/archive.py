@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Append-only archive of raw `GetMatchDetails` responses, so new derived
+fields or parse fixes can be applied to history without paying the API cost
+again.
+
+Matches are stored in rotating segment files (`matches_000001.json.gz`, ...).
+Each match is written as its own gzip member holding one line of JSON, so a
+segment can be streamed with `gzip.open` or a single match read directly.
+Alongside each segment, a small tab separated index (`.idx`) records the
+match ID, offset and length of every member.
+
+Writes happen in a background thread fed by a bounded queue, keeping
+compression and disk access off the fetch threads. If the queue is full the
+match is dropped from the archive (counted in `dropped`) rather than
+blocking a fetch.
+"""
+import os
+import glob
+import gzip
+import json
+import queue
+import threading
+import logging
+
+SEGMENT_BYTES = 64*1024*1024    # Rotate segments at this size
+QUEUE_SIZE = 10000              # Matches waiting to be written
+
+log = logging.getLogger("dota")
+
+
+class Segment:
+    """Segment file and its index, open for appending"""
+
+    def __init__(self, data_name, index_name):
+        # Both stay open across writes, until the segment is full
+        # pylint: disable=consider-using-with
+        self.data_file = open(data_name, "ab")
+        self.index_file = open(index_name, "a")
+
+    def append(self, match):
+        """Write a match as its own gzip member, returns offset and length"""
+
+        data = gzip.compress((json.dumps(match) + "\n").encode())
+        offset = self.data_file.tell()
+        self.data_file.write(data)
+        self.data_file.flush()
+
+        self.index_file.write("{0}\t{1}\t{2}\n".format(
+            match['match_id'], offset, len(data)))
+        self.index_file.flush()
+        return offset, len(data)
+
+    def close(self):
+        """Close the segment and its index"""
+        self.data_file.close()
+        self.index_file.close()
+
+
+class MatchArchive:
+    """Compressed, indexed archive of raw match JSON in `directory`"""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES,
+                 queue_size=QUEUE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.dropped = 0
+
+        # Load the index of existing segments, new matches always go into a
+        # new segment.
+        self.index = {}
+        self.segment = 0
+        for filename in sorted(glob.glob(os.path.join(directory, "*.idx"))):
+            segment = int(os.path.basename(filename)[8:14])
+            self.segment = max(self.segment, segment)
+            with open(filename) as file_handle:
+                for line in file_handle:
+                    match_id, offset, length = line.split()
+                    self.index[int(match_id)] = (segment, int(offset),
+                                                 int(length))
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def segment_name(self, segment, ext="json.gz"):
+        """Path to a segment file"""
+        return os.path.join(self.directory,
+                            "matches_{0:06d}.{1}".format(segment, ext))
+
+    def put(self, match):
+        """Queue a match for archiving, never blocks"""
+        try:
+            self.queue.put_nowait(match)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        """Background writer, the only user of the open segment"""
+        segment = None
+        while True:
+            match = self.queue.get()
+            if match is None:
+                break
+            try:
+                if segment is None:
+                    self.segment += 1
+                    segment = Segment(self.segment_name(self.segment),
+                                      self.segment_name(self.segment, "idx"))
+                if self._write(segment, match):
+                    segment.close()
+                    segment = None
+            except (OSError, TypeError, ValueError) as e_msg:
+                log.error("Archive error: %s", str(e_msg))
+
+        if segment is not None:
+            segment.close()
+
+    def _write(self, segment, match):
+        """Append a match to the current segment, True once it is full"""
+
+        offset, length = segment.append(match)
+        self.index[match['match_id']] = (self.segment, offset, length)
+        return offset + length >= self.segment_bytes
+
+    def close(self):
+        """Write everything queued and close the current segment"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            log.error("Archive dropped %d matches", self.dropped)
+
+    def read(self, match_id):
+        """Read a single archived match, None if not in the archive"""
+
+        if match_id not in self.index:
+            return None
+
+        segment, offset, length = self.index[match_id]
+        with open(self.segment_name(segment), "rb") as file_handle:
+            file_handle.seek(offset)
+            return json.loads(gzip.decompress(file_handle.read(length)))
+
+
+def iter_segment(filename):
+    """Stream every match stored in an archive segment"""
+
+    with gzip.open(filename, "rt") as file_handle:
+        for line in file_handle:
+            yield json.loads(line)
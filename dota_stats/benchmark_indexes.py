@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""benchmark_indexes.py
+
+Compare latency of the hot range scans before and after the InnoDB and
+covering indexes migration (9a4c7e2b5d16), on a synthetic dataset of
+matches and hourly win rates. The queries are the ones run by
+`win_rate_pick_rate.main` (one per skill and hour block),
+`fetch_summary.fetch_rows` and `win_rate_pick_rate.get_current_win_rate_table`.
+
+    python benchmark_indexes.py [URI] [--matches N] [--days D]
+
+URI defaults to a temporary SQLite file. On MariaDB it must be an empty
+scratch database: "before" uses MyISAM tables with the original indexes,
+"after" converts them to InnoDB and swaps in the migration's indexes. The
+tables are dropped afterwards.
+"""
+import os
+import time
+import argparse
+import tempfile
+import importlib.util
+import numpy as np
+from sqlalchemy import create_engine
+
+MIGRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "alembic", "versions",
+                         "9a4c7e2b5d16_innodb_covering_indexes.py")
+TABLES = {
+    "dota_matches": "CREATE TABLE dota_matches (match_id BIGINT PRIMARY KEY, "
+                    "start_time BIGINT, radiant_heroes CHAR(32), dire_heroes "
+                    "CHAR(32), radiant_win SMALLINT, api_skill INTEGER, items "
+                    "VARCHAR(1024), gold_spent VARCHAR(1024))",
+    "dota_hero_win_rate": "CREATE TABLE dota_hero_win_rate (time_hero_skill "
+                          "VARCHAR(128) PRIMARY KEY, time BIGINT, hero "
+                          "INTEGER, skill INTEGER, radiant_win INTEGER, "
+                          "radiant_total INTEGER, dire_win INTEGER, "
+                          "dire_total INTEGER)",
+}
+HEROES = 121
+BATCH = 10000
+END = 1611619200    # Synthetic data ends at this time
+
+
+def load_indexes():
+    """Index changes made by the migration"""
+    spec = importlib.util.spec_from_file_location("migration", MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    return migration.INDEXES
+
+
+def create_tables(engine, indexes):
+    """Tables as before the migration, MyISAM on MariaDB"""
+
+    suffix = " ENGINE=MyISAM" if engine.dialect.name == "mysql" else ""
+    with engine.connect() as conn:
+        for stmt in TABLES.values():
+            conn.execute(stmt + suffix)
+        for table, _, _, replaces, columns in indexes:
+            if replaces is not None:
+                conn.execute("CREATE INDEX {0} ON {1} ({2})".format(
+                    replaces, table, ", ".join(columns)))
+
+
+def migrate(engine, indexes):
+    """Apply the migration's changes to the benchmark tables"""
+
+    mysql = engine.dialect.name == "mysql"
+    with engine.connect() as conn:
+        for table in TABLES:
+            if mysql:
+                conn.execute("ALTER TABLE {0} ENGINE=InnoDB".format(table))
+        for table, index, columns, replaces, _ in indexes:
+            conn.execute("CREATE INDEX {0} ON {1} ({2})".format(
+                index, table, ", ".join(columns)))
+            if replaces is not None:
+                conn.execute("DROP INDEX {0}{1}".format(
+                    replaces, " ON " + table if mysql else ""))
+        if not mysql:
+            conn.execute("ANALYZE")
+
+
+def load_data(engine, matches, days):
+    """Random matches spread over `days`, and hourly win rates for every
+    hero and skill over the same period"""
+    load_matches(engine, matches, days)
+    load_win_rates(engine, days)
+
+
+def load_matches(engine, matches, days):
+    """Random matches spread over `days`"""
+
+    rng = np.random.default_rng(0)
+    start_times = np.sort(rng.integers(END - days*24*3600, END, matches))
+    heroes = rng.integers(1, HEROES + 1, (matches, 10))
+    skills = rng.integers(1, 4, matches)
+    wins = rng.integers(0, 2, matches)
+    items = ",".join(["1234"]*120)      # Typical width of the JSON columns
+    gold = ",".join(["12345"]*10)
+
+    with engine.connect() as conn:
+        for begin in range(0, matches, BATCH):
+            conn.execute(
+                "INSERT INTO dota_matches VALUES (%s, %s, %s, %s, %s, %s, "
+                "%s, %s)" if engine.dialect.name == "mysql" else
+                "INSERT INTO dota_matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(5700000000 + idx, int(start_times[idx]),
+                  str(heroes[idx, :5].tolist()),
+                  str(heroes[idx, 5:].tolist()), int(wins[idx]),
+                  int(skills[idx]), items, gold)
+                 for idx in range(begin, min(begin + BATCH, matches))])
+
+
+def load_win_rates(engine, days):
+    """Hourly win rates for every hero and skill over `days`"""
+
+    rows = []
+    for hour in range(END - days*24*3600, END, 3600):
+        for skill in range(1, 4):
+            for hero in range(1, HEROES + 1):
+                rows.append(("{0}_H{1:03}_S{2}".format(hour, hero, skill),
+                             hour, hero, skill, 5, 10, 5, 10))
+
+    with engine.connect() as conn:
+        for begin in range(0, len(rows), BATCH):
+            conn.execute(
+                "INSERT INTO dota_hero_win_rate VALUES (%s, %s, %s, %s, %s, "
+                "%s, %s, %s)" if engine.dialect.name == "mysql" else
+                "INSERT INTO dota_hero_win_rate VALUES (?, ?, ?, ?, ?, ?, ?, "
+                "?)", rows[begin:begin + BATCH])
+
+
+def queries(days):
+    """Name and statements of each benchmark"""
+
+    hourly = ["select radiant_win, radiant_heroes, dire_heroes from "
+              "dota_matches where start_time>={0} and start_time<={1} and "
+              "api_skill={2};".format(end - 3600, end, skill)
+              for skill in range(1, 4)
+              for end in range(END, END - days*24*3600, -3600)]
+    return [
+        ("Hourly win rate scans", hourly),
+        ("Fetch summary rows", [
+            "select start_time, match_id, api_skill from dota_matches "
+            "where start_time>={0};".format(END - 3*24*3600)]),
+        ("Current win rate table", [
+            "SELECT * FROM dota_hero_win_rate WHERE time>={0} AND "
+            "time<={1};".format(END - 3*24*3600, END)]),
+    ]
+
+
+def benchmark(engine, days, repeat):
+    """Median time of each set of queries"""
+
+    results = []
+    with engine.connect() as conn:
+        for name, stmts in queries(days):
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                for stmt in stmts:
+                    conn.execute(stmt).fetchall()
+                times.append(time.time() - start)
+            results.append((name, len(stmts), float(np.median(times))))
+    return results
+
+
+def print_results(before, after):
+    """Table of query times before and after the migration"""
+
+    print("{0:24} {1:>8} {2:>10} {3:>10} {4:>8}".format(
+        "", "Queries", "Before", "After", "Speedup"))
+    for (name, count, old), (_, _, new) in zip(before, after):
+        print("{0:24} {1:8} {2:8.3f} s {3:8.3f} s {4:7.1f}x".format(
+            name, count, old, new, old / new))
+
+
+def main():
+    """Main entry point"""
+
+    parser = argparse.ArgumentParser(description="Benchmark hot queries "
+                                                 "before and after covering "
+                                                 "indexes.")
+    parser.add_argument("uri", nargs="?", help="Scratch database URI")
+    parser.add_argument("--matches", type=int, default=500000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=5)
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        uri = opts.uri or "sqlite:///{}".format(os.path.join(tmp_dir,
+                                                             "bench"))
+        engine = create_engine(uri)
+        if set(TABLES) & set(engine.table_names()):
+            parser.error("{0} already has benchmark tables, use an empty "
+                         "database".format(uri))
+
+        indexes = load_indexes()
+        try:
+            create_tables(engine, indexes)
+            start = time.time()
+            load_data(engine, opts.matches, opts.days)
+            print("Loaded {0:,} matches over {1} days in {2:.1f} s".format(
+                opts.matches, opts.days, time.time() - start))
+
+            before = benchmark(engine, opts.days, opts.repeat)
+            start = time.time()
+            migrate(engine, indexes)
+            print("Migrated in {0:.1f} s".format(time.time() - start))
+            after = benchmark(engine, opts.days, opts.repeat)
+            print_results(before, after)
+        finally:
+            with engine.connect() as conn:
+                for table in TABLES:
+                    conn.execute("DROP TABLE IF EXISTS {0}".format(table))
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
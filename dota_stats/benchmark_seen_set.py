@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""benchmark_seen_set.py
+
+Compare memory use and throughput of `dotautil.SeenSet` against the
+dictionary previously used for `fetch_state.MATCH_IDS`. For each size, match
+IDs are seeded in bulk (as at start-up), then the same number of lookups are
+made, half hits and half misses, and a further 10% of new IDs are added one
+at a time (as `fetch_matches` does).
+
+    python benchmark_seen_set.py [SIZE ...]     (default 1000000 10000000)
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+from dota_stats.dotautil import SeenSet
+
+
+def make_ids(size):
+    """Realistic, roughly sequential match IDs and start times"""
+
+    rng = np.random.default_rng(0)
+    match_ids = 5700000000 + np.cumsum(rng.integers(2, 20, size))
+    start_times = 1607867126 + np.arange(size) // 100
+    return match_ids, start_times
+
+
+def measure_seed(create, seed, match_ids, start_times):
+    """Create and seed a structure, returns it with the seed time and the
+    memory allocated"""
+
+    tracemalloc.start()
+    start = time.time()
+    seen = create()
+    seed(seen, match_ids, start_times)
+    seed_time = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return seen, seed_time, memory
+
+
+def insert_rate(seen, new_ids):
+    """New IDs added per second, one at a time"""
+
+    start = time.time()
+    for match_id in new_ids:
+        seen[match_id] = 1607867126
+    return len(new_ids) / (time.time() - start)
+
+
+def benchmark(name, create, seed, size):
+    """Time and measure one structure"""
+
+    match_ids, start_times = make_ids(size)
+    lookups = np.concatenate([match_ids[::2], match_ids[::2] + 1]).tolist()
+    new_ids = (match_ids[-1] + 1 + np.arange(size // 10)).tolist()
+
+    seen, seed_time, memory = measure_seed(create, seed, match_ids,
+                                           start_times)
+
+    start = time.time()
+    hits = sum(1 for t in lookups if t in seen)
+    lookup_time = time.time() - start
+    assert hits == len(match_ids[::2])
+
+    print("{0:8} {1:>10,} {2:10.1f} MB {3:8.2f} s {4:12,.0f}/s "
+          "{5:12,.0f}/s".format(name, size, memory/1e6, seed_time,
+                                len(lookups)/lookup_time,
+                                insert_rate(seen, new_ids)))
+
+
+def seed_dict(seen, match_ids, start_times):
+    """Seed as `fetch.main` used to, one row at a time"""
+    for match_id, start_time in zip(match_ids.tolist(),
+                                    start_times.tolist()):
+        seen[match_id] = start_time
+
+
+def seed_seen_set(seen, match_ids, start_times):
+    """Seed in bulk"""
+    seen.update(match_ids, start_times)
+
+
+def main():
+    """Main entry point"""
+
+    sizes = [int(t) for t in sys.argv[1:]] or [1000000, 10000000]
+    print("{0:8} {1:>10} {2:>13} {3:>10} {4:>14} {5:>14}".format(
+        "", "IDs", "Memory", "Seed", "Lookups", "Inserts"))
+    for size in sizes:
+        benchmark("dict", dict, seed_dict, size)
+        benchmark("SeenSet", SeenSet, seed_seen_set, size)
+
+
+if __name__ == "__main__":
+    main()
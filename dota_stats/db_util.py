@@ -6,16 +6,39 @@ import os
 import argparse
 import logging
 import sys
+import json
+import time
+import threading
 from datetime import datetime as dt
-from sqlalchemy import create_engine, Column, CHAR, VARCHAR, BigInteger, \
-    Integer, String
+from sqlalchemy import create_engine, event, exc, Column, CHAR, VARCHAR, \
+    BigInteger, Integer, SmallInteger, String, text, and_, bindparam
 from sqlalchemy.dialects.mysql import TINYINT
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from dota_stats.dotautil import Bitmask
 
 DB_URI = os.environ['DOTA_DB_URI']
 Base = declarative_base()
 
+# Tables RANGE partitioned by day on a time column in MariaDB, partitions are
+# created this many days ahead
+PARTITIONED = [
+    ("dota_matches", "start_time"),
+    ("dota_hero_win_rate", "time"),
+    ("dota_match_players", "start_time"),
+]
+PARTITION_DAYS_AHEAD = 7
+DAY = 24*60*60
+
+# Connection pool of the engine shared by each process, see `get_engine`
+POOL_SIZE = int(os.environ.get('DOTA_DB_POOL_SIZE', 5))
+POOL_OVERFLOW = int(os.environ.get('DOTA_DB_POOL_OVERFLOW', 10))
+POOL_TIMEOUT = 30       # Seconds to wait for a connection before failing
+POOL_RECYCLE = 3600     # Reconnect before MariaDB's wait_timeout
+ENGINES = {}
+ENGINES_LOCK = threading.Lock()
+
 # Logging
 log = logging.getLogger("purge")
 if int(os.environ['DOTA_LOGGING']) == 0:
@@ -36,22 +59,64 @@ log.addHandler(ch)
 
 
 class Match(Base):
-    """Base class for match results"""
+    """Base class for match results. In MariaDB the primary key is
+    (match_id, start_time), as the table is partitioned on start_time."""
     __tablename__ = 'dota_matches'
 
     match_id = Column(BigInteger, primary_key=True)
     start_time = Column(BigInteger)
     radiant_heroes = Column(CHAR(32))
     dire_heroes = Column(CHAR(32))
-    radiant_win = Column(TINYINT)
+    radiant_win = Column(SmallInteger().with_variant(TINYINT, 'mysql'))
     api_skill = Column(Integer)
     items = Column(VARCHAR(1024))
     gold_spent = Column(VARCHAR(1024))
 
+    # Heroes by position (same order as `radiant_heroes`) and as a
+    # `dotautil.Bitmask` split into two halves, so SQL can filter by hero.
+    # Not indexed, filter on a start time range first (see 3d8a5c2f7b19)
+    radiant_hero1 = Column(SmallInteger)
+    radiant_hero2 = Column(SmallInteger)
+    radiant_hero3 = Column(SmallInteger)
+    radiant_hero4 = Column(SmallInteger)
+    radiant_hero5 = Column(SmallInteger)
+    dire_hero1 = Column(SmallInteger)
+    dire_hero2 = Column(SmallInteger)
+    dire_hero3 = Column(SmallInteger)
+    dire_hero4 = Column(SmallInteger)
+    dire_hero5 = Column(SmallInteger)
+    radiant_mask_lo = Column(BigInteger)
+    radiant_mask_hi = Column(BigInteger)
+    dire_mask_lo = Column(BigInteger)
+    dire_mask_hi = Column(BigInteger)
+
     def __repr__(self):
         return '<Match %r Radiant %r Dire %r>' % (
             self.match_id, self.radiant_heroes, self.dire_heroes)
 
+    @staticmethod
+    def hero_columns(radiant_heroes, dire_heroes):
+        """Values of the hero and mask columns for lists of hero IDs"""
+
+        columns = {}
+        for team, heroes in [("radiant", radiant_heroes),
+                             ("dire", dire_heroes)]:
+            for idx in range(5):
+                columns["{0}_hero{1}".format(team, idx+1)] = \
+                    heroes[idx] if idx < len(heroes) else None
+            lo_mask, hi_mask = Bitmask.split(Bitmask.encode(heroes))
+            columns[team + "_mask_lo"] = lo_mask
+            columns[team + "_mask_hi"] = hi_mask
+        return columns
+
+    @classmethod
+    def has_hero(cls, hero, team="radiant"):
+        """Filter expression for matches with `hero` on `team`"""
+
+        half, value = Bitmask.hero_half(hero)
+        column = getattr(cls, "{0}_mask_{1}".format(team, half))
+        return column.op('&')(value) != 0
+
 
 class FetchSummary(Base):
     """Base class for fetch summary stats"""
@@ -61,6 +126,89 @@ class FetchSummary(Base):
     rec_count = Column(Integer)
 
 
+class FetchCheckpoint(Base):
+    """Progress of the per-hero match history paging in `fetch.py` for each
+    skill, so an interrupted run can resume. A null `start_at_match_id`
+    means all of `hero` has been fetched."""
+    __tablename__ = "dota_fetch_checkpoint"
+
+    skill = Column(Integer, primary_key=True)
+    hero = Column(Integer)
+    start_at_match_id = Column(BigInteger)
+    updated = Column(BigInteger)
+
+
+class FetchHighWater(Base):
+    """Newest match ID and start time in the match history of each hero and
+    skill which has been completely fetched. Paging stops a maximum match
+    duration before `start_time`."""
+    __tablename__ = "dota_fetch_high_water"
+
+    hero = Column(Integer, primary_key=True)
+    skill = Column(Integer, primary_key=True)
+    match_id = Column(BigInteger)
+    start_time = Column(BigInteger)
+    updated = Column(BigInteger)
+
+
+class FetchSequence(Base):
+    """Cursor for fetching by match sequence number in `fetch.py`, every
+    match before `match_seq_num` has been fetched and written."""
+    __tablename__ = "dota_fetch_sequence"
+
+    name = Column(String(32), primary_key=True)
+    match_seq_num = Column(BigInteger)
+    updated = Column(BigInteger)
+
+
+class FetchWork(Base):
+    """Work queue of (hero, skill, window) items for fetch workers on several
+    nodes, see `work_queue.py`"""
+    __tablename__ = "dota_fetch_queue"
+
+    hero = Column(Integer, primary_key=True)
+    skill = Column(Integer, primary_key=True)
+    window_start = Column(BigInteger, primary_key=True)
+    status = Column(String(16), index=True)
+    owner = Column(String(64))
+    lease_expires = Column(BigInteger)
+    attempts = Column(Integer)
+    updated = Column(BigInteger)
+
+
+class MatchPlayer(Base):
+    """One row per hero in each match, with the item slots (`fetch.py`
+    `ITEM_SLOTS`) as item IDs. `team` is 0 for radiant and 1 for dire."""
+    __tablename__ = "dota_match_players"
+
+    match_id = Column(BigInteger, primary_key=True)
+    hero_id = Column(SmallInteger, primary_key=True)
+    start_time = Column(BigInteger, index=True)
+    player_slot = Column(SmallInteger)
+    team = Column(SmallInteger().with_variant(TINYINT, 'mysql'))
+    gold_spent = Column(Integer)
+    item_0 = Column(SmallInteger)
+    item_1 = Column(SmallInteger)
+    item_2 = Column(SmallInteger)
+    item_3 = Column(SmallInteger)
+    item_4 = Column(SmallInteger)
+    item_5 = Column(SmallInteger)
+    item_neutral = Column(SmallInteger)
+    backpack_0 = Column(SmallInteger)
+    backpack_1 = Column(SmallInteger)
+    backpack_2 = Column(SmallInteger)
+
+
+class RejectedMatch(Base):
+    """Matches rejected by the filters in `fetch.py`, so they are not fetched
+    again"""
+    __tablename__ = "dota_rejected_matches"
+
+    match_id = Column(BigInteger, primary_key=True)
+    reason = Column(String(32))
+    start_time = Column(BigInteger, index=True)
+
+
 class HeroWinRate(Base):
     """Win rate/pick rate revised table"""
     __tablename__ = "dota_hero_win_rate"
@@ -80,9 +228,95 @@ class HeroWinRate(Base):
 # -----------------------------------------------------------------------------
 
 
+class TimedQueuePool(QueuePool):
+    """QueuePool which records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+def _fork_safe(engine):
+    """Invalidate pooled connections opened by another process, so a forked
+    child (gunicorn worker, fetch shard) never shares a socket with its
+    parent. The SQLAlchemy recipe for pools crossing `fork()`."""
+
+    @event.listens_for(engine, "connect")
+    def connect(_, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(_, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid {0}, attempting to check "
+                "out in pid {1}".format(connection_record.info['pid'],
+                                        os.getpid()))
+
+
+def get_engine(uri=None):
+    """Engine for `uri` (default `DB_URI`) shared by the whole process,
+    created on first use. SQLite keeps SQLAlchemy's default pool, anything
+    else gets a `TimedQueuePool` sized by `DOTA_DB_POOL_SIZE` and
+    `DOTA_DB_POOL_OVERFLOW`."""
+
+    uri = DB_URI if uri is None else uri
+    with ENGINES_LOCK:
+        if uri not in ENGINES:
+            if uri.startswith("sqlite"):
+                engine = create_engine(uri, echo=False)
+            else:
+                engine = create_engine(
+                    uri, echo=False, poolclass=TimedQueuePool,
+                    pool_size=POOL_SIZE, max_overflow=POOL_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=True)
+            _fork_safe(engine)
+            ENGINES[uri] = engine
+        return ENGINES[uri]
+
+
+def dispose_engines():
+    """Close the pooled connections of every shared engine, the engines
+    themselves stay usable and reconnect on demand"""
+    with ENGINES_LOCK:
+        for engine in ENGINES.values():
+            engine.dispose()
+
+
+def pool_stats(uri=None):
+    """Pool metrics of the shared engine for `uri`: connections checked out,
+    overflow in use, and the total and worst wait for a connection. Empty
+    if the engine hasn't been created or doesn't use a `TimedQueuePool`."""
+
+    engine = ENGINES.get(DB_URI if uri is None else uri)
+    if engine is None or not isinstance(engine.pool, TimedQueuePool):
+        return {}
+
+    pool = engine.pool
+    return {'size': pool.size(), 'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'checkouts': pool.checkouts,
+            'wait_time': round(pool.wait_time, 3),
+            'max_wait': round(pool.max_wait, 3)}
+
+
 def connect_database():
-    """Connect to database and return session"""
-    engine = create_engine(DB_URI, echo=False)
+    """Return the shared engine and a new session bound to it"""
+    engine = get_engine()
     s_maker = sessionmaker()
     s_maker.configure(bind=engine)
     session = s_maker()
@@ -90,29 +324,173 @@ def connect_database():
     return engine, session
 
 
+def upsert_statement(dialect, table, columns, keys):
+    """Bulk upsert of `columns` into `table`, bound by name so it can be
+    passed a list of dictionaries (executemany). Replaces any existing row
+    with the same `keys`. MySQL/MariaDB use `ON DUPLICATE KEY UPDATE`, SQLite
+    (used as a local stand-in) uses `ON CONFLICT`.
+    """
+    stmt = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+        table, ", ".join(columns), ", ".join(":" + t for t in columns))
+    updates = [t for t in columns if t not in keys]
+
+    if dialect == "sqlite":
+        stmt += " ON CONFLICT({0}) DO UPDATE SET {1}".format(
+            ", ".join(keys),
+            ", ".join("{0}=excluded.{0}".format(t) for t in updates))
+    else:
+        stmt += " ON DUPLICATE KEY UPDATE {0}".format(
+            ", ".join("{0}=VALUES({0})".format(t) for t in updates))
+
+    return text(stmt)
+
+
+def backfill_heroes(engine, batch_size=10000):
+    """Fill in the hero and mask columns of matches written before they
+    existed, from `radiant_heroes` and `dire_heroes`. Works through the
+    table in batches by match ID, returns the number of rows updated."""
+
+    table = Match.__table__
+    columns = list(Match.hero_columns([], []).keys())
+    stmt = table.update().where(
+        table.c.match_id == bindparam("b_match_id")).values(
+            {t: bindparam(t) for t in columns})
+
+    num_rows = 0
+    last_id = -1
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                table.select().with_only_columns([
+                    table.c.match_id, table.c.radiant_heroes,
+                    table.c.dire_heroes]).where(and_(
+                        table.c.match_id > last_id,
+                        table.c.radiant_mask_lo.is_(None))).order_by(
+                            table.c.match_id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                values = Match.hero_columns(json.loads(row.radiant_heroes),
+                                            json.loads(row.dire_heroes))
+                values['b_match_id'] = row.match_id
+                updates.append(values)
+            conn.execute(stmt, updates)
+
+        num_rows += len(rows)
+        last_id = rows[-1].match_id
+        log.info("Backfilled %d matches, up to match ID %d", num_rows,
+                 last_id)
+
+    return num_rows
+
+
 def get_max_start_time():
     """Return the most recent start time"""
 
-    engine, _ = connect_database()
+    engine = get_engine()
     with engine.connect() as conn:
         rows = conn.execute("select max(start_time) from dota_matches")
     return int(rows.first()[0])
 
 
+def partition_name(bound):
+    """Name of the daily partition holding times before `bound`"""
+    return "p" + dt.utcfromtimestamp(bound - DAY).strftime("%Y%m%d")
+
+
+def get_partitions(conn, table):
+    """(name, upper bound) of the daily partitions of `table` in order,
+    without the `pmax` catch-all. Empty if the table isn't partitioned."""
+
+    rows = conn.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM "
+        "information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND "
+        "TABLE_NAME = :table ORDER BY PARTITION_ORDINAL_POSITION"),
+                        table=table)
+    return [(t[0], int(t[1])) for t in rows
+            if t[0] is not None and t[0] != "pmax"]
+
+
+def new_partition_bounds(last_bound, now, days_ahead=PARTITION_DAYS_AHEAD):
+    """Upper bounds of the daily partitions to add after the partition
+    ending at `last_bound`, so that there are partitions until `days_ahead`
+    days after `now`."""
+
+    end = (int(now)//DAY + days_ahead + 1)*DAY
+    return list(range(last_bound + DAY, end + 1, DAY))
+
+
+def expired_partitions(partitions, cutoff):
+    """Names of the partitions holding only times up to `cutoff`"""
+    return [name for name, bound in partitions if bound <= cutoff + 1]
+
+
+def maintain_partitions(engine, now=None, days_ahead=PARTITION_DAYS_AHEAD):
+    """Create the daily partitions of the next `days_ahead` days ahead of
+    time by splitting the (empty) `pmax` partition, which is cheap. Does
+    nothing on databases without partitioning (SQLite)."""
+
+    if engine.dialect.name != "mysql":
+        return
+    if now is None:
+        now = dt.utcnow().timestamp()
+
+    with engine.connect() as conn:
+        for table, _ in PARTITIONED:
+            partitions = get_partitions(conn, table)
+            if not partitions:
+                log.error("%s is not partitioned, run alembic upgrade", table)
+                continue
+
+            bounds = new_partition_bounds(partitions[-1][1], now, days_ahead)
+            if not bounds:
+                continue
+
+            log.info("%s adding partitions %s to %s", table,
+                     partition_name(bounds[0]), partition_name(bounds[-1]))
+            conn.execute(
+                "ALTER TABLE {0} REORGANIZE PARTITION pmax INTO ({1}, "
+                "PARTITION pmax VALUES LESS THAN MAXVALUE)".format(
+                    table, ", ".join(
+                        "PARTITION {0} VALUES LESS THAN ({1})".format(
+                            partition_name(t), t) for t in bounds)))
+
+
 def purge_database(days):
-    """Purge all records older than `days` relative to current time."""
+    """Purge all records older than `days` relative to current time.
+    Partitioned tables drop whole days of partitions, so rows up to a day
+    older than the cutoff are kept until the next purge."""
 
     now = dt.utcnow().timestamp()
     cutoff = int(now - (days*24*60*60))
 
-    engine, _ = connect_database()
+    engine = get_engine()
+    maintain_partitions(engine, now)
 
     tbl_col = [
                 ("dota_matches", "start_time"),
                 ("dota_hero_win_rate", "time"),
+                ("dota_rejected_matches", "start_time"),
+                ("dota_match_players", "start_time"),
                ]
     with engine.connect() as conn:
         for table, col in tbl_col:
+            partitions = []
+            if engine.dialect.name == "mysql" and \
+                    (table, col) in PARTITIONED:
+                partitions = get_partitions(conn, table)
+
+            if partitions:
+                expired = expired_partitions(partitions, cutoff)
+                log.info("{0:20} dropping {1} partitions".format(
+                    table, len(expired)))
+                if expired:
+                    conn.execute("ALTER TABLE {0} DROP PARTITION {1}".format(
+                        table, ", ".join(expired)))
+                continue
+
             stmt = "SELECT COUNT(*) FROM {0} WHERE {1}<={2}".format(
                 table, col, cutoff)
             num_delete = conn.execute(stmt)
@@ -136,27 +514,30 @@ def create_database():
     """Create the clean database tables"""
 
     # Drop all of the tables
-    engine, _ = connect_database()
+    engine = get_engine()
     with engine.connect() as conn:
         for table in engine.table_names():
             conn.execute("DROP TABLE {};".format(table))
 
-        # dota_matches
+        # dota_matches, with the covering indexes of the hot range scans
         stmt = "CREATE TABLE dota_matches (match_id BIGINT PRIMARY KEY, " \
                "start_time BIGINT, radiant_heroes CHAR(32), dire_heroes " \
                "CHAR(32), radiant_win BOOLEAN, api_skill INTEGER, " \
-               "items VARCHAR(1024), gold_spent VARCHAR(1024)) ENGINE = " \
-               "'MyISAM'; "
+               "items VARCHAR(1024), gold_spent VARCHAR(1024), " \
+               "INDEX ix_skill_start_time (api_skill, start_time, " \
+               "radiant_win, radiant_heroes, dire_heroes), " \
+               "INDEX ix_start_time_skill (start_time, api_skill)) " \
+               "ENGINE='InnoDB'; "
         conn.execute(stmt)
 
         # fetch_history
         stmt = "CREATE TABLE fetch_history (match_id BIGINT PRIMARY KEY, " \
-               "start_time BIGINT) ENGINE = 'MyISAM'; "
+               "start_time BIGINT) ENGINE='InnoDB'; "
         conn.execute(stmt)
 
         # fetch_summary
         stmt = "CREATE TABLE fetch_summary (date_hour_skill CHAR(32) PRIMARY " \
-               "KEY, skill INT, rec_count INT) ENGINE='MyISAM'; "
+               "KEY, skill INT, rec_count INT) ENGINE='InnoDB'; "
         conn.execute(stmt)
 
         # fetch_win_rate
@@ -164,7 +545,7 @@ def create_database():
                "KEY, skill TINYINT, hero CHAR(128), time_range CHAR(128), " \
                "radiant_win INT, radiant_total INT, radiant_win_pct FLOAT, " \
                "dire_win INT, dire_total INT, dire_win_pct FLOAT, win INT, " \
-               "total INT, win_pct FLOAT) ENGINE='MyISAM'; "
+               "total INT, win_pct FLOAT) ENGINE='InnoDB'; "
         conn.execute(stmt)
 
 
@@ -176,6 +557,12 @@ if __name__ == "__main__":
     parser.add_argument('--purge', action='store', type=int,
                         help='Purge the database of records older than PURGE '
                              'from the current time.')
+    parser.add_argument('--partitions', action='store_true',
+                        help='Create partitions for the next '
+                             '{} days.'.format(PARTITION_DAYS_AHEAD))
+    parser.add_argument('--backfill', action='store_true',
+                        help='Fill in hero columns of matches written '
+                             'before they were added.')
 
     opts = parser.parse_args()
 
@@ -183,5 +570,9 @@ if __name__ == "__main__":
         create_database()
     elif opts.purge is not None:
         purge_database(opts.purge)
+    elif opts.partitions:
+        maintain_partitions(get_engine())
+    elif opts.backfill:
+        backfill_heroes(get_engine())
     else:
         parser.print_help()
@@ -4,10 +4,13 @@
     - MatchSerialization
     - Bitmask
     - MLEncoding
+    - SeenSet
 
 See individual methods for more information.
 """
 
+import time
+import threading
 from datetime import datetime
 import numpy as np
 from dota_stats import meta
@@ -193,3 +196,170 @@ class MLEncoding:
             counter += 1
 
         return radiant_win, x1_hero, x2_against, x_all
+
+
+class Bitmask:
+    """Sets of heroes as 128 bit masks, so team compositions can be stored
+    and filtered in SQL. Bit N is hero `meta.HEROES[N]` rather than the hero
+    ID, as hero IDs go past 128 with gaps. New heroes are appended to
+    `meta.HEROES`, so existing bits never move.
+
+    The database has no 128 bit integer type, so masks are stored as two 64
+    bit halves (`lo`, bits 0-63 and `hi`, bits 64-127), each as a signed
+    two's complement BIGINT.
+    """
+
+    BITS = 128
+
+    @classmethod
+    def bit(cls, hero):
+        """Bit position of `hero`"""
+
+        idx = meta.HEROES.index(hero)
+        if idx >= cls.BITS:
+            raise ValueError("Hero {} does not fit in a {} bit mask".format(
+                hero, cls.BITS))
+        return idx
+
+    @classmethod
+    def encode(cls, heroes):
+        """Mask of a list of hero IDs"""
+
+        mask = 0
+        for hero in heroes:
+            mask |= 1 << cls.bit(hero)
+        return mask
+
+    @staticmethod
+    def decode(mask):
+        """Hero IDs in `mask`, in the order of `meta.HEROES`"""
+
+        return [hero for idx, hero in enumerate(meta.HEROES)
+                if mask >> idx & 1]
+
+    @staticmethod
+    def _signed(value):
+        """64 bit unsigned to signed"""
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    @classmethod
+    def split(cls, mask):
+        """(lo, hi) signed 64 bit halves of `mask`, as stored"""
+
+        return (cls._signed(mask & 0xFFFFFFFFFFFFFFFF),
+                cls._signed(mask >> 64 & 0xFFFFFFFFFFFFFFFF))
+
+    @staticmethod
+    def join(lo, hi):
+        """Mask from stored halves"""
+
+        return (hi & 0xFFFFFFFFFFFFFFFF) << 64 | (lo & 0xFFFFFFFFFFFFFFFF)
+
+    @classmethod
+    def hero_half(cls, hero):
+        """Which half holds `hero` ("lo" or "hi") and the signed value to AND
+        with it to test for the hero"""
+
+        lo, hi = cls.split(1 << cls.bit(hero))
+        return ("lo", lo) if lo != 0 else ("hi", hi)
+
+
+class SeenSet:
+    """Compact set of match IDs with their start times, used in place of a
+    dictionary to track matches already fetched. IDs live in a sorted NumPy
+    array (with a parallel array of start times), about 12 bytes per match
+    instead of the ~100 of a dictionary entry. New IDs go into a small
+    dictionary which is merged into the arrays once it reaches
+    `buffer_size`.
+
+    If `horizon` (seconds) is set, matches which started more than `horizon`
+    before the current time are evicted on each merge.
+
+    Supports `match_id in seen`, `seen[match_id] = start_time` and `len`,
+    and is safe to share between threads. `claim` checks and adds in one
+    step, which also works through a `multiprocessing` manager proxy.
+    """
+
+    def __init__(self, horizon=None, buffer_size=65536):
+        self.horizon = horizon
+        self.buffer_size = buffer_size
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.times = np.zeros(0, dtype=np.uint32)
+        self.buffer = {}
+        self.lock = threading.Lock()
+
+    def _find(self, match_id):
+        """Index of `match_id` in the sorted array, -1 if not there"""
+
+        idx = self.ids.searchsorted(match_id)
+        if idx < len(self.ids) and self.ids[idx] == match_id:
+            return idx
+        return -1
+
+    def __contains__(self, match_id):
+        with self.lock:
+            return match_id in self.buffer or self._find(match_id) >= 0
+
+    def __setitem__(self, match_id, start_time):
+        with self.lock:
+            idx = self._find(match_id)
+            if idx >= 0:
+                self.times[idx] = start_time
+            else:
+                self._add(match_id, start_time)
+
+    def _add(self, match_id, start_time):
+        """Add a match which is not in the arrays. Must hold the lock."""
+
+        self.buffer[match_id] = start_time
+        if len(self.buffer) >= self.buffer_size:
+            self._merge(np.fromiter(self.buffer.keys(), dtype=np.int64),
+                        np.fromiter(self.buffer.values(), dtype=np.uint32))
+            self.buffer = {}
+
+    def claim(self, match_ids, start_times):
+        """Add the matches which are not already in the set, returning their
+        IDs. Checking and adding is atomic, so concurrent callers never both
+        claim the same match."""
+
+        new = []
+        with self.lock:
+            for match_id, start_time in zip(match_ids, start_times):
+                if match_id not in self.buffer and self._find(match_id) < 0:
+                    self._add(match_id, start_time)
+                    new.append(match_id)
+        return new
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids) + len(self.buffer)
+
+    def _merge(self, match_ids, start_times):
+        """Merge new IDs into the sorted arrays, evicting old matches. Must
+        hold the lock."""
+
+        ids = np.concatenate([self.ids, match_ids])
+        times = np.concatenate([self.times, start_times])
+
+        if self.horizon is not None:
+            keep = times >= time.time() - self.horizon
+            ids, times = ids[keep], times[keep]
+
+        ids, index = np.unique(ids, return_index=True)
+        self.ids = ids
+        self.times = times[index]
+
+    def update(self, match_ids, start_times):
+        """Add many matches at once, e.g. when seeding from the database"""
+
+        with self.lock:
+            self._merge(np.asarray(match_ids, dtype=np.int64),
+                        np.asarray(start_times, dtype=np.uint32))
+
+    def clear(self):
+        """Remove everything"""
+
+        with self.lock:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.times = np.zeros(0, dtype=np.uint32)
+            self.buffer = {}
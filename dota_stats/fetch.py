@@ -4,81 +4,41 @@
 Fetches, parses, and puts matches into MariaDB using steam API. This script
 is usually run using `crontab` and `flock` on a regular basis.
 
-To avoid duplicate data pulls, on loading, creates a dictionary of already
-fetched matches within a time horizon. The main routine creates a
-ThreadPoolExecutor which is used to parallelize data pulls and process.
-The main routine calls `fetch_matches`, which uses the `GetMatchHistory`
-endpoint to fetch recent matches for a specified `hero` and `skill` level.
-This continues in a loop until no more matches are found.
-
-The matches IDs are passed in the `process_matches` along with some metadata
-and the executor. The internal dictionary is updated to prevent "re-pulls" of
-matches. `process_matches` calls `process_match` in either a single thread or
-multiple threads depending on the multithreading setup. This is point at which
-the process is parallelized. `process_match` calls `fetch_match` to grab a
-single match from the API, parses the output in `parse_match`, and returns.
-`parse_match` is where filtering conditions are applied. A call is made to
-`parse_players` which handles that subset of the match info.
-
-Control is returned to `process_matches` and data is written into database
-in `write_matches` if valid matches still exist.
+To avoid duplicate data pulls, on loading, creates a compact set of already
+fetched matches within a time horizon (`dotautil.SeenSet`). Fetching is
+organized as a pipeline (`pipeline.py`): a producer thread pages through
+`GetMatchHistory` for each hero and skill level, stopping at the high water
+mark of the previous run, while match details are fetched in parallel,
+either on a thread pool or an asyncio engine (`--engine async`). Each match
+is parsed and filtered in `match_parse.py` and written to the database in
+batches by a background writer (`match_writer.py`). Steam API calls are in
+`steam_api.py`, and the progress kept between runs (checkpoint, high water
+marks, reject cache and sequence cursor) in `fetch_state.py`.
+
+Raw match details can optionally be kept (`--archive DIR`) in a compressed,
+append-only archive, written from a background thread, see `archive.py`.
+With `--replay PATH ...` archived (or other stored) match JSON is re-parsed
+across a process pool and written to the database, without calling the API
+(`replay.py`).
+
+`--sequence` replaces the hero by hero paging with a walk of the global match
+sequence number (`sequence.py`). `--processes N` spreads the (hero, skill)
+pairs across worker processes and `--worker` claims them from the database
+work queue (`shards.py`).
 """
 import time
 import logging
 import os
 import sys
-import ssl
-import json
 import argparse
-from functools import partial
-from concurrent import futures
 import datetime as dt
-import requests
-import numpy as np
-from dota_stats import meta
-from dota_stats.db_util import Match, connect_database
+from sqlalchemy import exc
+from dota_stats import meta, http_util, archive, dotautil, work_queue, \
+    steam_api, fetch_state, pipeline, sequence, shards, replay
+from dota_stats.db_util import connect_database, dispose_engines, \
+    maintain_partitions
 
-
-# Globals
-NUM_THREADS = int(os.environ['DOTA_THREADS'])    # 1 = single threaded
-MIN_MATCH_LEN = 1200
 INITIAL_HORIZON = 1    # Days to load from database on start-up
-CTX = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-
-# Globals used in multi-threading
-MATCH_IDS = {}
-
-PLAYER_FIELDS = [
-    "account_id",
-    "player_slot",
-    "hero_id",
-    "item_0",
-    "item_1",
-    "item_2",
-    "item_3",
-    "item_4",
-    "item_5",
-    "backpack_0",
-    "backpack_1",
-    "backpack_2",
-    "kills",
-    "deaths",
-    "assists",
-    "leaver_status",
-    "last_hits",
-    "denies",
-    "gold_per_min",
-    "xp_per_min",
-    "level",
-    "hero_damage",
-    "tower_damage",
-    "hero_healing",
-    "gold",
-    "gold_spent",
-    "scaled_hero_damage",
-    "scaled_tower_damage",
-    "scaled_hero_healing"
-]
 
 # Logging
 log = logging.getLogger("dota")
@@ -94,358 +54,74 @@ ch.setFormatter(fmt)
 log.addHandler(ch)
 
 
-class ParseException(Exception):
-    """Used to indicate a parse error in the JSON from Valve API"""
-
-
-class APIException(Exception):
-    """Used to indicate an error fetching from the Valve API"""
-
-
-def fetch_url(url):
-    """Simple wait loop around fetching to deal with things like network
-    outages, etc..."""
-
-    sleep_schedule = np.logspace(-0.5, 3, 20)
-    sleep_schedule += sleep_schedule*np.random.rand(20)
-    for sleep in sleep_schedule:
-        time.sleep(np.random.uniform(0.3*sleep, 0.7*sleep))
-        headers = {
-            'Accept': 'gzip',
-            'Content-Encoding': 'gzip',
-            'Content-Type': 'application/json',
-        }
-        try:
-            resp = requests.get(url, headers=headers, timeout=60)
-        except requests.exceptions.ConnectionError as conn_error:
-            log.error("Connection error: %r", conn_error)
-        except requests.exceptions.ReadTimeout as timeout_error:
-            log.error("Timeout error: %r", timeout_error)
-        else:
-            # Normal response
-            if resp.status_code == 200:
-                resp_json = json.loads(resp.content)
-                if 'error' in resp_json['result']:
-                    raise APIException(resp_json['result']['error'])
-                return resp_json['result']
-
-            # Error handling
-            if resp.status_code == 429:
-                log.error("Too many requests")
-            elif resp.status_code == 503:
-                log.error("Service unavailable")
-            elif resp.status_code == 403:
-                raise APIException("Forbidden - Check Steam API key")
-            else:
-                log.error("Unknown repsonse %d %s", resp.status_code,
-                          resp.reason)
-
-    raise ValueError("Could not fetch (timeout?): {}".format(url))
-
-
-def parse_players(match_id, players):
-    """Parse the players section of the JSON response."""
-
-    radiant_heroes = []
-    radiant_gpm = []
-    dire_heroes = []
-    dire_gpm = []
-    items_dict = {}
-    gold_spent = {}
-    leaver = False
-
-    for player in players:
-        # DOTA_LEAVER_NONE = 0;
-        # DOTA_LEAVER_DISCONNECTED = 1;
-        # DOTA_LEAVER_DISCONNECTED_TOO_LONG = 2;
-        # DOTA_LEAVER_ABANDONED = 3;
-        # DOTA_LEAVER_AFK = 4;
-        # DOTA_LEAVER_NEVER_CONNECTED = 5;
-        # DOTA_LEAVER_NEVER_CONNECTED_TOO_LONG = 6;
-
-        if player['leaver_status'] > 1:
-            leaver = True
-
-        player_slot = player['player_slot']
-
-        # Check to see if we're missing a hero ID
-        if player['hero_id'] not in meta.HERO_DICT.keys():
-
-            if player['hero_id'] == 0:
-                raise ParseException("Null Hero ID")
-            raise ValueError("Missing hero: {} {}".format(
-                match_id, player['hero_id']))
-
-        # Check for intentional feeding
-        if player['deaths'] > 30 and player['kills'] < 5:
-            raise ParseException("Feeding")
-
-        if player_slot <= 4:
-            radiant_heroes.append(player['hero_id'])
-            radiant_gpm.append(player['gold_per_min'])
-        else:
-            dire_heroes.append(player['hero_id'])
-            dire_gpm.append(player['gold_per_min'])
-
-        # Net worth
-        gold_spent[player['hero_id']] = player['gold_spent']
-
-        # Get active items on hero
-        items = []
-        item_fields = [t for t in player.keys() if t[0:4] == 'item']
-        for field in item_fields:
-            items.append(player[field])
-
-        # No/destroyed items
-        if set(items) == {0}:
-            raise ParseException("No items")
-
-        bp_fields = [t for t in player.keys() if t[0:8] == 'backpack']
-        for field in bp_fields:
-            items.append(player[field])
-
-        items_dict[player['hero_id']] = items
-
-        # Sort heroes by farm -- probably not correct but good first pass
-        radiant_heroes = [x for _, x in sorted(zip(radiant_gpm,
-                                                   radiant_heroes),
-                                               reverse=True)]
-        dire_heroes = [x for _, x in sorted(zip(dire_gpm, dire_heroes),
-                                            reverse=True)]
-
-    return leaver, radiant_heroes, dire_heroes, items_dict, gold_spent
-
-
-def parse_match(match):
-    """Parse match info from main API endpoint. Player section is broken
-    out into a separate subroutine for clarity.
-    """
-    match['batch_time'] = int(dt.datetime.fromtimestamp(match[
-        'start_time']).strftime("%Y%m%d_%H%M"))
-
-    valid_game_modes = ["game_mode_all_pick",
-                        "game_mode_captains_mode",
-                        "game_mode_random_draft",
-                        "game_mode_single_draft",
-                        "game_mode_all_random",
-                        "game_mode_least_played",
-                        "game_mode_captains_draft",
-                        "game_mode_all_draft"]
-
-    game_mode = meta.MODE_ENUM[str(match['game_mode'])]['name']
-
-    # Bad game mode
-    if game_mode not in valid_game_modes:
-        raise ParseException("Bad Mode: {}".format(game_mode))
-
-    # Bail if zero length matches
-    if match['duration'] < MIN_MATCH_LEN:
-        raise ParseException("Min Length")
-
-    # Lobby types
-    if not match['lobby_type'] in meta.LOBBY_ENUM.values():
-        raise ValueError("Unknown lobby type: {}".format(match['match_id']))
-    if not(match['lobby_type'] in [0, 2, 7, 9, 13]):
-        raise ParseException("Lobby Type")
-
-    players = match["players"]
-
-    # Bail if Missing players
-    if {} in players:
-        raise ParseException("Min Players")
-
-    leaver, radiant_heroes, dire_heroes, items_dict, gold_spent =\
-        parse_players(match['match_id'], players)
-
-    if leaver:
-        raise ParseException("Leaver")
-
-    summary = {
-                'match_id': match['match_id'],
-                'start_time': match['start_time'],
-                'radiant_heroes': radiant_heroes,
-                'dire_heroes': dire_heroes,
-                'radiant_win': match['radiant_win'],
-                'api_skill': match['api_skill'],
-                'items': json.dumps(items_dict),
-                'gold_spent': json.dumps(gold_spent),
-            }
-
-    return summary
-
-
-def fetch_match(match_id, skill):
-    """Skill is optional, this simply sets an object in the json
-    for reference"""
-
-    url = "https://api.steampowered.com/IDOTA2Match_570/"
-    url += "GetMatchDetails/V001/?key={0}&match_id={1}"
-
-    match = {}
-    for _ in range(10):
-        match = fetch_url(url.format(os.environ['STEAM_KEY'], match_id))
-        if 'start_time' in match.keys():
-            break
-
-        log.error("Match ID not found: %s", str(match_id))
-        time.sleep(1)
-
-    match['api_skill'] = skill
-
-    # If something went wrong, log to file and return no match
-    if 'start_time' not in match.keys():
-        if not os.path.exists('error'):
-            os.makedirs('error')
-        with open("./error/{}.json".format(match_id), "w") as file_handle:
-            file_handle.write(json.dumps(match))
-        raise APIException("Bad match JSON {}".format(match_id))
-
-    return match
-
-
-def process_match(hero, skill, match_id):
-    """Process a single match, used by the multi-threading engine."""
-
-    txt = "match ID {0} hero {1:3} skill {2}".format(match_id, hero, skill)
-
-    try:
-        match = fetch_match(match_id, skill)
-    except APIException as e_msg:
-        log.error("{0:30.30} {1}". format("API Error", str(e_msg)))
-        return None
-
-    try:
-        summary = parse_match(match)
-        log.debug("{0:30.30} {1}". format("Success", txt))
-        return summary
-    except ParseException as e_msg:
-        log.debug("{0:30.30} {1}". format(str(e_msg), txt))
-        return None
-
-
-def write_matches(session, matches):
-    """Write matches to database"""
-
-    for summary in matches:
-        match = Match()
-        match.match_id = summary['match_id']
-        match.start_time = summary['start_time']
-        match.radiant_heroes = str(summary['radiant_heroes'])
-        match.dire_heroes = str(summary['dire_heroes'])
-        match.radiant_win = summary['radiant_win']
-        match.api_skill = summary['api_skill']
-        match.items = summary['items']
-        match.gold_spent = summary['gold_spent']
-
-        # pylint: disable=no-member
-        session.merge(match)
-        session.commit()
-        # pylint: enable=no-member
-
-
-def process_matches(session, match_ids, hero, skill, executor):
-    """Loop over all match_ids, parsing JSON output and writing
-    to database.
-    """
-    log.debug("%d matches for processing", len(match_ids))
-    match_ids = [m for m in match_ids if m not in MATCH_IDS.keys()]
-    log.info("%d matches after removing duplicates.", len(match_ids))
-
-    if NUM_THREADS == 1:
-        matches = [process_match(hero, skill, match_id) for match_id in
-                   match_ids]
-    else:
-        f_p = partial(process_match, hero, skill)
-        matches = executor.map(f_p, match_ids, timeout=3600)
-
-    matches = [m for m in matches if m is not None]
-
-    if matches is not None:
-        log.info("%d valid matches to write to database", len(matches))
-        write_matches(session, matches)
-
-
-def fetch_matches_loop(url, skill, start_at_match_id, hero):
-    """Loop until we find matches. There is a bug in valve API with load
-    balancing, sometimes the API returns no matches, so we'll re-try a few
-    times if we expect more matches.
-    """
-    resp = {}
-    for retry in range(20):
-        resp = fetch_url(url.format(
-            os.environ["STEAM_KEY"],
-            skill,
-            start_at_match_id,
-            hero,
-        ))
-
-        log.error("num_results (try %d) %d", retry, resp['num_results'])
-
-        # If we found results, break out of loop
-        if resp['num_results'] > 0:
-            break
-
-        time.sleep(1)
-
-    return resp
-
-
-def fetch_matches(session, hero, skill, executor):
-    """Gets list of matches by page. This is just the index, not the
-    individual match results.
-    """
-    counter = 1
-    start = time.time()
-    start_at_match_id = 9999999999
-
-    url = "https://api.steampowered.com/IDOTA2Match_570/GetMatchHistory/"
-    url += "V001/?key={0}&skill={1}&start_at_match_id={2}&hero_id={3}"
-
-    no_results_remain = False
-    while not no_results_remain:
-        log.info("Fetching more matches: %d", counter)
-
-        resp = fetch_matches_loop(url, skill, start_at_match_id, hero)
-
-        if resp['num_results'] > 0:
-            match_ids = [t['match_id'] for t in resp['matches']]
-            process_matches(session, match_ids, hero, skill, executor)
-            start_at_match_id = min(match_ids)-1
-
-        # Set dictionary for start time so we don't fetch multiple times,
-        # both in current cache as well as the database.
-        matches = []
-        start_times = []
-        for match in resp['matches']:
-
-            # Skip if already in database
-            if not match['match_id'] in MATCH_IDS.keys():
-                MATCH_IDS[match['match_id']] = match['start_time']
-                matches.append(match['match_id'])
-                start_times.append(match['start_time'])
-
-        # Exit if no results remain
-        if resp['results_remaining'] == 0:
-            no_results_remain = True
-        else:
-            log.info("Remaining %d (Match ID %d)", resp['results_remaining'],
-                     start_at_match_id)
-
-        counter = counter+1
-
-    mpm = str(60*counter/(time.time()-start))
-    log.debug("Matches per minute: %s", mpm)
-
-
 def parse_command_line():
     """Parse command line options."""
 
     parser = argparse.ArgumentParser(
         description='Fetch matches from DOTA 2 API web services.')
-    parser.add_argument('hero', type=str, help='"all" or hero names')
-    parser.add_argument('skill', type=int, help="skill = {1, 2, 3}")
+    parser.add_argument('hero', type=str, nargs='?',
+                        help='"all" or hero names')
+    parser.add_argument('skill', type=int, nargs='?',
+                        help="skill = {1, 2, 3}")
+    parser.add_argument('--engine', choices=["thread", "async"],
+                        default=pipeline.ENGINE,
+                        help='Engine used to fetch match details (default '
+                             'DOTA_ENGINE)')
+    parser.add_argument('--archive', default=os.environ.get('DOTA_ARCHIVE'),
+                        help='Directory to archive raw match details '
+                             '(default DOTA_ARCHIVE, off if not set)')
+    parser.add_argument('--replay', nargs='+', metavar='PATH',
+                        help='Instead of fetching, re-parse stored match '
+                             'JSON (files, archive segments or directories) '
+                             'and write to the database')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint of an interrupted "all" '
+                             'run and start again from the first hero')
+    parser.add_argument('--sequence', nargs='?', type=int, const=-1,
+                        metavar='SEQ_NUM',
+                        help='Instead of paging by hero, fetch all public '
+                             'matches by sequence number, starting from the '
+                             'saved cursor, SEQ_NUM, or the latest match')
+    parser.add_argument('--skills', type=int, nargs='+', choices=[1, 2, 3],
+                        help='Fetch several skill levels in one run, '
+                             'instead of `skill`')
+    parser.add_argument('--processes', type=int,
+                        default=int(os.environ.get('DOTA_PROCESSES', 0)),
+                        help='Shard (hero, skill) pairs across this many '
+                             'processes, each match is fetched once across '
+                             'all of them (default DOTA_PROCESSES, 0 for a '
+                             'single process)')
+    parser.add_argument('--enqueue', action='store_true',
+                        help='Add the heroes and skills to the database work '
+                             'queue for the current hour, for `--worker`s '
+                             'on any node')
+    parser.add_argument('--worker', action='store_true',
+                        help='Claim heroes and skills from the database work '
+                             'queue until it is empty')
+    parser.add_argument('--full', action='store_true',
+                        help='Page through all available match history, '
+                             'ignoring the high water marks of previous '
+                             'runs')
     opts = parser.parse_args()
 
+    if opts.replay is not None:
+        return [], opts
+
+    if opts.sequence is not None:
+        if opts.skill is None:
+            opts.skill = 0
+        return [], opts
+
+    if opts.worker:
+        return [], opts
+
+    if opts.skills is None and opts.skill is not None:
+        opts.skills = [opts.skill]
+
+    if opts.hero is None or opts.skills is None:
+        parser.print_help()
+        sys.exit(-1)
+
     # Parse heroes
     hero_name = opts.hero.lower()
     if hero_name == "all":
@@ -458,24 +134,29 @@ def parse_command_line():
         else:
             heroes = [k for k, v in meta.HERO_DICT.items() if v == hero_name]
 
-    if opts.skill not in [1, 2, 3]:
+    if any(t not in [1, 2, 3] for t in opts.skills):
         parser.print_help()
         sys.exit(-1)
 
-    return heroes, opts.skill
+    # Several skills are always sharded, even if only in one process
+    opts.skill = opts.skills[0]
+    if len(opts.skills) > 1:
+        opts.processes = max(opts.processes, 1)
 
+    return heroes, opts
 
-def main():
-    """Main entry point. """
 
-    # Parse command line
-    heroes, skill = parse_command_line()
+def close_archive():
+    """Close the raw match archive, if one is open"""
 
-    # Database connection
-    engine, session = connect_database()
+    if steam_api.ARCHIVE is not None:
+        steam_api.ARCHIVE.close()
+        steam_api.ARCHIVE = None
 
-    # Populate dictionary with matches we already have within
-    # INITIAL_HORIZON (don't refetch there)
+
+def seed_match_ids(engine):
+    """Populate seen-set with matches we already have within
+    INITIAL_HORIZON (don't refetch there). Returns the number of matches."""
 
     # Get UTC timestamps spanning HORIZON_DAYS ago to today
     start_time = int((dt.datetime.utcnow()-dt.timedelta(
@@ -484,29 +165,146 @@ def main():
 
     with engine.connect() as conn:
         stmt = "select start_time, match_id from dota_matches where " \
-               "start_time>={} and start_time<={};".format(start_time, end_time)
-        rows1 = conn.execute(stmt)
-
-    count = 0
-    for row in rows1:
-        MATCH_IDS[row.match_id] = row.start_time
-        count += 1
-    print("Records to seed MATCH_IDS 1: {}".format(count))
-
-    # Main loop over heroes. Create the thread pool now to prevent constant
-    # creation and destruction of threads. Also, destroy database connection
-    # in between heroes just in case something hangs.
-    executor = futures.ThreadPoolExecutor(max_workers=int(NUM_THREADS))
-    counter = 1
-
-    for hero in heroes:
-        log.info("---------------------------------------------------------")
-        log.info(">>>>>>>> Hero: %s %d/%d Skill: %d <<<<<<<<",
-                 meta.HERO_DICT[hero], counter, len(heroes), skill)
-        log.info("---------------------------------------------------------")
-        fetch_matches(session, hero, skill, executor)
-        counter += 1
-        session.commit()
+               "start_time>={} and start_time<={};".format(start_time,
+                                                           end_time)
+        rows = conn.execute(stmt).fetchall()
+
+    fetch_state.MATCH_IDS.update([row.match_id for row in rows],
+                                 [row.start_time for row in rows])
+    return len(rows)
+
+
+def run_sequence(session, opts):
+    """Fetch by match sequence number, from `--sequence SEQ_NUM`, the saved
+    cursor or the latest match"""
+
+    start = opts.sequence if opts.sequence >= 0 else \
+        fetch_state.load_sequence(session)
+    if start is None:
+        start = sequence.get_latest_sequence()
+    log.info("Fetching by match sequence number from %d", start)
+    sequence.fetch_sequence_ranges(session, start, opts.skill)
+
+
+def run_sharded(heroes, opts):
+    """Fetch `heroes` at every skill across `--processes` shards"""
+
+    # Shards open their own connections and archives
+    log.info("Sharding %d heroes and %d skills across %d processes",
+             len(heroes), len(opts.skills), opts.processes)
+    dispose_engines()
+    close_archive()
+    hits, skipped = shards.run_shards(heroes, opts.skills, opts.processes,
+                                      opts.full, opts.archive)
+    fetch_state.REJECTS.hits.update(hits)
+    fetch_state.SKIPPED.update(skipped)
+
+
+def run_heroes(session, heroes, opts):
+    """Fetch `heroes` at a single skill in this process"""
+
+    # Runs over all heroes are checkpointed, resume an interrupted run
+    # rather than re-paging heroes which were just done.
+    checkpoint = opts.hero.lower() == "all"
+    start_at_match_id = None
+    if checkpoint and not opts.restart:
+        previous = fetch_state.load_checkpoint(session, opts.skill)
+        heroes, start_at_match_id = fetch_state.resume_heroes(heroes,
+                                                              previous)
+        if previous is not None:
+            log.info("Resuming at hero %d/%d, start_at_match_id %s",
+                     len(meta.HERO_DICT)-len(heroes)+1,
+                     len(meta.HERO_DICT), start_at_match_id)
+
+    executor = pipeline.create_executor(pipeline.ENGINE)
+    high_water = {} if opts.full else fetch_state.load_high_water(
+        session, opts.skill)
+    try:
+        pipeline.run_pipeline(
+            session, pipeline.Job(heroes, opts.skill, start_at_match_id,
+                                  high_water),
+            executor, checkpoint)
+    finally:
+        executor.shutdown()
+
+    if checkpoint:
+        fetch_state.clear_checkpoint(session, opts.skill)
+
+
+def log_saved_calls():
+    """Log match detail calls saved by the reject cache and by filtering
+    match history summaries"""
+
+    log.info("Reject cache saved %d match detail calls",
+             sum(fetch_state.REJECTS.hits.values()))
+    for reason, count in fetch_state.REJECTS.hits.most_common():
+        log.info("{0:30.30} {1}".format(reason, count))
+    log.info("Match history filters saved %d match detail calls",
+             sum(fetch_state.SKIPPED.values()))
+    for reason, count in fetch_state.SKIPPED.most_common():
+        log.info("{0:30.30} {1}".format(reason, count))
+
+
+def main():
+    """Main entry point. """
+
+    # Parse command line
+    heroes, opts = parse_command_line()
+    pipeline.ENGINE = opts.engine
+    log.info("Match detail engine: %s", pipeline.ENGINE)
+
+    if opts.archive is not None:
+        log.info("Archiving raw match details to: %s", opts.archive)
+        steam_api.ARCHIVE = archive.MatchArchive(opts.archive)
+
+    # Database connection
+    engine, session = connect_database()
+
+    if opts.replay is not None:
+        replay.replay(session, opts.replay)
+        return
+
+    work = work_queue.WorkQueue(engine)
+    if opts.enqueue:
+        window_start, _ = dotautil.TimeMethods.get_time_nearest(time.time())
+        log.info("Queued %d items, queue %s",
+                 work.enqueue(heroes, opts.skills, window_start),
+                 work.stats())
+        return
+
+    # Daily partitions ahead of the matches about to be written, a no-op
+    # after the first run of the day. Workers on other nodes may add the
+    # same ones at the same time, in which case theirs are used.
+    try:
+        maintain_partitions(engine)
+    except exc.DBAPIError as e_msg:
+        log.error("Could not add partitions: %s", e_msg)
+
+    print("Records to seed MATCH_IDS 1: {}".format(seed_match_ids(engine)))
+    log.info("Rejected matches in cache: %d",
+             fetch_state.REJECTS.load(session))
+
+    # The checkpoint is left in place if the API goes down, so the next run
+    # resumes where this one stopped
+    try:
+        if opts.sequence is not None:
+            run_sequence(session, opts)
+        elif opts.worker:
+            log.info("Worker %s finished %d items, queue %s", work.owner,
+                     shards.run_worker(session, work, opts.full),
+                     work.stats())
+        elif opts.processes > 0:
+            run_sharded(heroes, opts)
+        else:
+            run_heroes(session, heroes, opts)
+    except http_util.CircuitOpen as e_msg:
+        log.error("Stopping: %s", e_msg)
+        close_archive()
+        sys.exit(1)
+
+    if opts.sequence is None:
+        log_saved_calls()
+    close_archive()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""State shared by the fetch threads, and fetch progress kept in the
+database between runs.
+
+`MATCH_IDS` is the set of matches already fetched (or claimed) within the
+seen horizon, `SKIPPED` counts matches removed by `prefilter_match` and
+`REJECTS` is the negative cache of matches rejected by `parse_match`. In the
+database, the checkpoint lets an interrupted run over all heroes resume,
+the high water marks stop paging at history fetched by earlier runs, and
+the sequence cursor is where `--sequence` continues from.
+"""
+import os
+import time
+import threading
+import collections
+from dota_stats import dotautil
+from dota_stats.db_util import FetchCheckpoint, FetchHighWater, \
+    FetchSequence, RejectedMatch, upsert_statement
+
+CHECKPOINT_HOURS = float(os.environ.get('DOTA_CHECKPOINT_HOURS', 24))
+REJECT_DAYS = float(os.environ.get('DOTA_REJECT_DAYS', 7))  # Reject cache
+SEEN_HORIZON = float(os.environ.get('DOTA_SEEN_DAYS', 7))  # Days in MATCH_IDS
+
+# Globals used in multi-threading
+MATCH_IDS = dotautil.SeenSet(horizon=SEEN_HORIZON*24*60*60)
+SKIPPED = collections.Counter()    # Matches removed by `prefilter_match`
+
+
+class RejectCache:
+    """Negative cache of matches rejected by `parse_match`, persisted in the
+    `dota_rejected_matches` table so later runs never fetch their details
+    again. Counts the hits by reject reason, each hit is a detail call
+    saved."""
+
+    # Depends on our hero metadata rather than the match, may pass later
+    UNCACHED = ["Missing hero"]
+
+    def __init__(self):
+        self.reasons = {}
+        self.new = []
+        self.hits = collections.Counter()
+        self.lock = threading.Lock()
+
+    def load(self, session, days=None):
+        """Delete rejects older than `days` and load the rest"""
+
+        if days is None:
+            days = REJECT_DAYS
+        cutoff = int(time.time() - days*24*60*60)
+
+        session.query(RejectedMatch).filter(
+            RejectedMatch.start_time < cutoff).delete()
+        session.commit()
+
+        rows = session.query(RejectedMatch.match_id, RejectedMatch.reason)
+        with self.lock:
+            self.reasons.update((t.match_id, t.reason) for t in rows)
+            return len(self.reasons)
+
+    def add(self, match_id, reason, start_time):
+        """Record a rejected match, called from the fetch workers"""
+
+        if reason in self.UNCACHED:
+            return
+        with self.lock:
+            self.reasons[match_id] = reason
+            self.new.append({'match_id': match_id, 'reason': reason,
+                             'start_time': start_time})
+
+    def check(self, match_id):
+        """True if `match_id` was rejected before, counting the hit"""
+
+        with self.lock:
+            reason = self.reasons.get(match_id)
+            if reason is None:
+                return False
+            self.hits[reason] += 1
+            return True
+
+    def save(self, session):
+        """Write rejects added since the last save"""
+
+        with self.lock:
+            rows = list(self.new)
+
+        if rows:
+            columns = ['match_id', 'reason', 'start_time']
+            stmt = upsert_statement(session.get_bind().dialect.name,
+                                    RejectedMatch.__tablename__, columns,
+                                    ['match_id'])
+            session.execute(stmt, rows)
+            session.commit()
+
+        # Only forget rows once written, so a failed save can be retried
+        with self.lock:
+            del self.new[:len(rows)]
+
+
+REJECTS = RejectCache()
+
+
+def load_checkpoint(session, skill):
+    """Checkpoint of an interrupted run for `skill`, None if there isn't one
+    or it is older than `CHECKPOINT_HOURS`."""
+
+    checkpoint = session.query(FetchCheckpoint).get(skill)
+    if checkpoint is None or \
+            time.time() - checkpoint.updated > CHECKPOINT_HOURS*3600:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(session, skill, hero, start_at_match_id):
+    """Record that history for `skill` has been fetched and written up to
+    `start_at_match_id` for `hero` (None if the hero is complete)."""
+
+    session.merge(FetchCheckpoint(skill=skill, hero=hero,
+                                  start_at_match_id=start_at_match_id,
+                                  updated=int(time.time())))
+    session.commit()
+
+
+def clear_checkpoint(session, skill):
+    """Remove the checkpoint for `skill` once a run completes"""
+
+    session.query(FetchCheckpoint).filter_by(skill=skill).delete()
+    session.commit()
+
+
+def load_high_water(session, skill):
+    """High water marks for `skill` as a dictionary of hero to the start time
+    of the newest match. Marks saved without a start time are left out."""
+
+    rows = session.query(FetchHighWater).filter_by(skill=skill)
+    return {t.hero: t.start_time for t in rows if t.start_time is not None}
+
+
+def save_high_water(session, skill, hero, match_id, start_time):
+    """Record that history for `hero` and `skill` has been completely fetched
+    and written up to `match_id`, the newest match start being `start_time`.
+    Never moves the mark backwards."""
+
+    previous = session.query(FetchHighWater).get((hero, skill))
+    if previous is not None and previous.start_time is not None and \
+            previous.start_time >= start_time:
+        return
+
+    session.merge(FetchHighWater(hero=hero, skill=skill, match_id=match_id,
+                                 start_time=start_time,
+                                 updated=int(time.time())))
+    session.commit()
+
+
+def record_progress(session, skill, pages, checkpoint, skip_heroes=()):
+    """Save the high water marks of heroes completed in `pages`, except
+    `skip_heroes`, and if `checkpoint` is set the position after the last
+    page. Everything in `pages` must already be written to the database."""
+
+    for page in pages:
+        if page.high_water is not None and page.hero not in skip_heroes:
+            save_high_water(session, skill, page.hero, *page.high_water)
+
+    if checkpoint and pages:
+        save_checkpoint(session, skill, pages[-1].hero,
+                        pages[-1].start_at_match_id)
+
+
+def resume_heroes(heroes, checkpoint):
+    """Heroes left to fetch after `checkpoint`, and the `start_at_match_id`
+    for the first of them (None to start from the most recent match)."""
+
+    if checkpoint is None or checkpoint.hero not in heroes:
+        return heroes, None
+
+    idx = heroes.index(checkpoint.hero)
+    if checkpoint.start_at_match_id is None:
+        return heroes[idx+1:], None
+    return heroes[idx:], checkpoint.start_at_match_id
+
+
+def load_sequence(session, name="default"):
+    """Saved match sequence number cursor, None if there isn't one"""
+
+    cursor = session.query(FetchSequence).get(name)
+    return None if cursor is None else cursor.match_seq_num
+
+
+def save_sequence(session, match_seq_num, name="default"):
+    """Record that every match before `match_seq_num` has been written"""
+
+    session.merge(FetchSequence(name=name, match_seq_num=match_seq_num,
+                                updated=int(time.time())))
+    session.commit()
@@ -9,7 +9,8 @@ import argparse
 import datetime as dt
 import pandas as pd
 import pytz
-from dota_stats.db_util import FetchSummary, connect_database
+from dota_stats.db_util import FetchSummary, connect_database, \
+    get_engine
 from dota_stats import dotautil
 
 
@@ -28,7 +29,7 @@ def get_health_summary(days, timezone, hour=True):
     """
 
     # Database connection
-    engine, _ = connect_database()
+    engine = get_engine()
 
     # Get TZ offsets, do everything relative to current TZ offset
     local_tz = pytz.timezone(timezone)
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""Utility functions for HTTP access to the Steam API. Includes a shared,
+pooled `requests` session which keeps connections alive between calls and
+negotiates gzip compression.
+
+The connection classes count the connections opened and the TLS/TCP
+handshakes and requests made on them, so the savings from connection reuse
+can be confirmed with `connection_stats`.
+
+Every request to the API, from either fetch engine, first takes a key from
+the process wide pool returned by `get_keys`. `STEAM_KEY` may hold several
+comma separated keys, each with its own `RateLimiter`. This is a token bucket
+combined with an additive-increase/multiplicative-decrease (AIMD) cap on the
+number of requests in flight. A throttled response (429/503) on any thread
+cuts the rate and concurrency of that key for all threads, sustained success
+slowly ramps them back up. Requests go to the least loaded key; keys are put
+on cooldown after a 403 or repeated 429s.
+
+Failed requests are retried following a `RetryPolicy`, with no delay before
+the first attempt. A `CircuitBreaker` shared by every thread counts failed
+requests (no response or a 5xx) and, once the API looks down, fails fast
+with `CircuitOpen` instead of retrying, until a trial request succeeds.
+"""
+import os
+import time
+import random
+import asyncio
+import collections
+import threading
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Number of connections kept open, defaults to one per fetch thread
+POOL_SIZE = int(os.environ.get('DOTA_POOL_SIZE', os.environ['DOTA_THREADS']))
+
+# Rate limiter, requests/second and concurrent requests
+RATE = float(os.environ.get('DOTA_RATE', 10))
+MIN_RATE = float(os.environ.get('DOTA_MIN_RATE', 0.5))
+MAX_RATE = float(os.environ.get('DOTA_MAX_RATE', 50))
+MAX_CONCURRENCY = int(os.environ.get('DOTA_MAX_CONCURRENCY', 256))
+
+# Key health, seconds a key is unused after a 403 or MAX_THROTTLED 429s in a
+# row
+THROTTLE_CODES = (429, 503)
+MAX_THROTTLED = 3
+THROTTLED_COOLDOWN = float(os.environ.get('DOTA_KEY_COOLDOWN', 60))
+FORBIDDEN_COOLDOWN = 3600
+
+# Retries, delays in seconds
+RETRY_ATTEMPTS = int(os.environ.get('DOTA_RETRY_ATTEMPTS', 10))
+RETRY_BASE = float(os.environ.get('DOTA_RETRY_BASE', 0.5))
+RETRY_CAP = float(os.environ.get('DOTA_RETRY_CAP', 60))
+MAX_RETRY_AFTER = 600
+
+# Circuit breaker, failures in a row to open and seconds before a trial
+BREAKER_THRESHOLD = int(os.environ.get('DOTA_BREAKER_THRESHOLD', 20))
+BREAKER_RESET = float(os.environ.get('DOTA_BREAKER_RESET', 30))
+
+HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
+}
+
+# Globals used in multi-threading
+SESSION_LOCK = threading.Lock()
+SESSION = None
+
+# Connections, handshakes and requests since the session was created.
+# Totals only, connections discarded by the pool are not kept around.
+COUNTS_LOCK = threading.Lock()
+COUNTS = collections.Counter()
+
+
+def count(name):
+    """Add one to a connection counter"""
+    with COUNTS_LOCK:
+        COUNTS[name] += 1
+
+
+class CountingMixin:
+    """Count handshakes and requests made on a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        count('connections')
+
+    def connect(self):
+        """Open the socket, counts as a new handshake"""
+        count('handshakes')
+        super().connect()
+
+    def request(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Send a request, possibly on an already open socket"""
+        count('requests')
+        return super().request(*args, **kwargs)
+
+
+class CountingHTTPConnection(CountingMixin, HTTPConnection):
+    """HTTP connection with reuse counters"""
+
+
+class CountingHTTPSConnection(CountingMixin, HTTPSConnection):
+    """HTTPS connection with reuse counters"""
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool using counting connections"""
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool using counting connections"""
+    ConnectionCls = CountingHTTPSConnection
+
+
+class CountingAdapter(HTTPAdapter):
+    """Transport adapter whose pools use the counting connection classes"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+class RateLimiter:
+    """Token bucket limiting the request rate, with an AIMD controlled limit
+    on concurrent requests. `acquire` (or `acquire_async`) must be paired with
+    `release`, which reports whether the API throttled the request.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, rate=RATE, concurrency=POOL_SIZE, min_rate=MIN_RATE,
+                 max_rate=MAX_RATE, max_concurrency=MAX_CONCURRENCY,
+                 decrease=0.5, cooldown=1.0):
+        self.rate = rate
+        self.concurrency = float(concurrency)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.num_throttled = 0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        """Take a token and concurrency slot without waiting, returns 0 if
+        successful, otherwise the time to wait before trying again."""
+
+        with self.cond:
+            return self._try_acquire()
+
+    def _try_acquire(self):
+        """Take a token and a concurrency slot if available, otherwise return
+        the time to wait before trying again. Must hold the lock."""
+
+        now = time.monotonic()
+        self.tokens = min(max(self.rate, 1.0), self.tokens +
+                          (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+        if self.in_flight >= int(self.concurrency):
+            return 1.0 / self.rate
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.rate
+
+        self.tokens -= 1.0
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self):
+        """Block until a request may be made"""
+
+        with self.cond:
+            wait = self._try_acquire()
+            while wait > 0:
+                self.cond.wait(wait)
+                wait = self._try_acquire()
+
+    async def acquire_async(self):
+        """Wait on the event loop until a request may be made"""
+
+        while True:
+            with self.cond:
+                wait = self._try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, throttled=False):
+        """Finish a request. A throttled request multiplicatively decreases
+        rate and concurrency (at most once per `cooldown` seconds), anything
+        else additively increases them."""
+
+        with self.cond:
+            self.in_flight -= 1
+
+            if throttled:
+                self.num_throttled += 1
+                now = time.monotonic()
+                if now - self.last_decrease > self.cooldown:
+                    self.last_decrease = now
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.concurrency = max(1.0, self.concurrency *
+                                           self.decrease)
+                    self.tokens = 0.0
+            else:
+                # Roughly +1 request/second per second of traffic, and +1
+                # concurrent request per `concurrency` successes.
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency +
+                                       1.0 / self.concurrency)
+
+            self.cond.notify_all()
+
+    def stats(self):
+        """Current steady state of the limiter"""
+
+        with self.cond:
+            return {
+                'rate': self.rate,
+                'concurrency': int(self.concurrency),
+                'in_flight': self.in_flight,
+                'throttled': self.num_throttled,
+            }
+
+
+class ApiKey:
+    """A Steam API key, with its own rate limiter and usage counters"""
+
+    def __init__(self, key, **kwargs):
+        self.key = key
+        self.limiter = RateLimiter(**kwargs)
+        self.num_requests = 0
+        self.num_forbidden = 0
+        self.num_throttled = 0    # In a row
+        self.cooldown_until = 0.0
+        self.forbidden_until = 0.0
+
+    @property
+    def name(self):
+        """Enough of the key to tell it apart in logs"""
+        return "..." + self.key[-4:]
+
+    def load(self):
+        """Fraction of the concurrency limit in use, tie broken by tokens"""
+
+        stats = self.limiter.stats()
+        return (stats['in_flight'] / max(stats['concurrency'], 1),
+                -self.limiter.tokens)
+
+    def record(self, status_code):
+        """Track key health from the status code of a finished request, puts
+        the key on cooldown after a 403 or repeated 429s"""
+
+        if status_code == 403:
+            self.num_forbidden += 1
+            self.cooldown_until = time.monotonic() + FORBIDDEN_COOLDOWN
+            self.forbidden_until = self.cooldown_until
+        elif status_code == 429:
+            self.num_throttled += 1
+            if self.num_throttled >= MAX_THROTTLED:
+                self.num_throttled = 0
+                self.cooldown_until = time.monotonic() + THROTTLED_COOLDOWN
+        elif status_code is not None:
+            self.num_throttled = 0
+
+
+class KeyPool:
+    """Pool of API keys. `acquire` (or `acquire_async`) waits for the least
+    loaded key with a token and concurrency slot available, and must be
+    paired with `release`, which reports the response status code (None if
+    there was no response) and tracks key health. Acquiring raises
+    `KeysForbidden` rather than waiting once every key has had a 403."""
+
+    def __init__(self, keys, **kwargs):
+        self.source = keys
+        self.keys = [ApiKey(t.strip(), **kwargs)
+                     for t in keys.split(",") if t.strip()]
+        self.lock = threading.Lock()
+
+    def usable(self):
+        """Keys not on cooldown"""
+
+        now = time.monotonic()
+        return [t for t in self.keys if t.cooldown_until <= now]
+
+    def _try_acquire(self):
+        """Take the least loaded key available, returns (key, 0) if
+        successful otherwise (None, time to wait)."""
+
+        waits = []
+        with self.lock:
+            keys = sorted(self.usable(), key=lambda t: t.load())
+            now = time.monotonic()
+            if not keys and all(t.forbidden_until > now for t in self.keys):
+                raise KeysForbidden("All Steam API keys are forbidden")
+            for key in keys:
+                wait = key.limiter.try_acquire()
+                if wait == 0:
+                    key.num_requests += 1
+                    return key, 0.0
+                waits.append(wait)
+
+            # Everything is on cooldown, wait for the first throttled key to
+            # come back
+            if not keys:
+                waits.append(min(t.cooldown_until for t in self.keys
+                                 if t.forbidden_until <= now) - now)
+
+        return None, max(min(waits), 0.001)
+
+    def acquire(self):
+        """Block until a key may be used, returns the `ApiKey`"""
+
+        key, wait = self._try_acquire()
+        while key is None:
+            time.sleep(wait)
+            key, wait = self._try_acquire()
+        return key
+
+    async def acquire_async(self):
+        """Wait on the event loop until a key may be used"""
+
+        key, wait = self._try_acquire()
+        while key is None:
+            await asyncio.sleep(wait)
+            key, wait = self._try_acquire()
+        return key
+
+    def release(self, key, status_code):
+        """Finish a request made with `key`"""
+
+        key.limiter.release(status_code in THROTTLE_CODES)
+
+        with self.lock:
+            key.record(status_code)
+
+    def stats(self):
+        """Usage of each key"""
+
+        now = time.monotonic()
+        stats = []
+        for key in self.keys:
+            key_stats = key.limiter.stats()
+            key_stats.update({
+                'key': key.name,
+                'requests': key.num_requests,
+                'forbidden': key.num_forbidden,
+                'cooldown': max(0.0, key.cooldown_until - now),
+            })
+            stats.append(key_stats)
+        return stats
+
+
+# Attempts at a request and the delays between them, see `next_delay`
+RetryPolicy = collections.namedtuple(
+    "RetryPolicy", ["attempts", "base", "cap", "max_retry_after"],
+    defaults=(RETRY_ATTEMPTS, RETRY_BASE, RETRY_CAP, MAX_RETRY_AFTER))
+
+
+def next_delay(policy, previous, retry_after=None):
+    """Delay before the next attempt, given the `previous` delay and the
+    `Retry-After` header of the last response, if any. The first attempt is
+    immediate, after that delays use decorrelated jitter: uniform between
+    `policy.base` and three times the previous delay, capped at
+    `policy.cap`. A `Retry-After` from the server is waited out (up to
+    `policy.max_retry_after`) if it is longer."""
+
+    delay = min(policy.cap, random.uniform(policy.base,
+                                           max(policy.base, 3*previous)))
+    seconds = retry_after_seconds(retry_after)
+    if seconds is not None:
+        delay = max(delay, min(seconds, policy.max_retry_after))
+    return delay
+
+
+def retry_after_seconds(value):
+    """Seconds to wait from a `Retry-After` header, either a number of
+    seconds or an HTTP date. None if missing or invalid."""
+
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class CircuitOpen(Exception):
+    """Raised instead of making a request while the API is down"""
+
+
+class KeysForbidden(Exception):
+    """Raised instead of waiting for a key when every key is forbidden"""
+
+
+class CircuitBreaker:
+    """Shared by all requests. Opens after `threshold` failed requests in a
+    row, then `check` raises `CircuitOpen` for `reset` seconds. After that a
+    single trial request is let through, closing the breaker if it succeeds
+    and opening it again if not."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.num_opened = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raise `CircuitOpen` if a request may not be made now"""
+
+        with self.lock:
+            if self.opened is None:
+                return
+            wait = self.opened + self.reset - time.monotonic()
+            if wait > 0 or self.trial:
+                raise CircuitOpen("Steam API down, retry in {0:.0f} s".format(
+                    max(wait, 0)))
+            self.trial = True
+
+    def record(self, status_code):
+        """Record the outcome of a request, `status_code` is None if there
+        was no response"""
+
+        failed = status_code is None or status_code >= 500
+        with self.lock:
+            self.trial = False
+            if not failed:
+                self.failures = 0
+                self.opened = None
+                return
+
+            self.failures += 1
+            if self.opened is not None or self.failures >= self.threshold:
+                if self.opened is None:
+                    self.num_opened += 1
+                self.opened = time.monotonic()
+
+    def stats(self):
+        """Current state of the breaker"""
+
+        with self.lock:
+            return {
+                'open': self.opened is not None,
+                'failures': self.failures,
+                'opened': self.num_opened,
+            }
+
+
+RETRY = RetryPolicy()
+BREAKER = CircuitBreaker()
+KEYS = None
+
+
+def get_keys():
+    """Return the process wide key pool for `STEAM_KEY`, created again if
+    the environment variable changes."""
+
+    global KEYS  # pylint: disable=global-statement
+
+    with SESSION_LOCK:
+        if KEYS is None or KEYS.source != os.environ['STEAM_KEY']:
+            KEYS = KeyPool(os.environ['STEAM_KEY'])
+
+    return KEYS
+
+
+def add_key(url, key):
+    """Add an API key to the query string of `url`"""
+
+    return "{0}{1}key={2}".format(url, "&" if "?" in url else "?", key.key)
+
+
+def get_session():
+    """Return the process wide session, creating it on first use. Sessions
+    are safe to share between the fetch threads for simple GET requests."""
+
+    global SESSION  # pylint: disable=global-statement
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            adapter = CountingAdapter(pool_connections=4,
+                                      pool_maxsize=POOL_SIZE)
+            SESSION = requests.Session()
+            SESSION.headers.update(HEADERS)
+            SESSION.mount('http://', adapter)
+            SESSION.mount('https://', adapter)
+
+    return SESSION
+
+
+def close_session():
+    """Close the shared session and reset connection counters."""
+
+    global SESSION  # pylint: disable=global-statement
+
+    with SESSION_LOCK:
+        if SESSION is not None:
+            SESSION.close()
+        SESSION = None
+    with COUNTS_LOCK:
+        COUNTS.clear()
+
+
+def connection_stats():
+    """Summarize connection reuse. `reused` is the number of requests which
+    did not need a new handshake."""
+
+    with COUNTS_LOCK:
+        counts = COUNTS.copy()
+
+    return {
+        'connections': counts['connections'],
+        'handshakes': counts['handshakes'],
+        'requests': counts['requests'],
+        'reused': counts['requests'] - counts['handshakes'],
+    }
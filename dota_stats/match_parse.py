@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Filtering and parsing of `GetMatchDetails` results.
+
+`parse_matches` parses a batch of matches into columnar numpy arrays and is
+where the filtering conditions are applied. `parse_match` is a single match
+wrapper around it, and `summarize_matches` parses a batch into the match
+summaries written to the database. `prefilter_match` applies the filters
+which can be checked from a `GetMatchHistory` summary, before any details
+are fetched.
+"""
+import json
+import functools
+import collections
+import datetime as dt
+import numpy as np
+from dota_stats import meta
+
+MIN_MATCH_LEN = 1200    # Seconds
+
+VALID_GAME_MODES = [
+    "game_mode_all_pick",
+    "game_mode_captains_mode",
+    "game_mode_random_draft",
+    "game_mode_single_draft",
+    "game_mode_all_random",
+    "game_mode_least_played",
+    "game_mode_captains_draft",
+    "game_mode_all_draft",
+]
+VALID_LOBBY_TYPES = [0, 2, 7, 9, 13]
+
+# Item fields stored in fixed columns of `dota_match_players`
+ITEM_SLOTS = ["item_0", "item_1", "item_2", "item_3", "item_4", "item_5",
+              "item_neutral", "backpack_0", "backpack_1", "backpack_2"]
+HERO_IDS = np.array(meta.HEROES)
+
+# Reasons a match is filtered out by `parse_matches`, index is the reject code
+REJECT_REASONS = [
+    None,
+    "Bad Mode",
+    "Min Length",
+    "Unknown lobby type",
+    "Lobby Type",
+    "Min Players",
+    "Null Hero ID",
+    "Missing hero",
+    "Feeding",
+    "No items",
+    "Leaver",
+]
+
+# Integer player fields read as they are by `player_columns`
+PLAYER_COLUMNS = ["hero_id", "gold_per_min", "gold_spent", "kills", "deaths"]
+
+PLAYER_FIELDS = [
+    "account_id",
+    "player_slot",
+    "hero_id",
+    "item_0",
+    "item_1",
+    "item_2",
+    "item_3",
+    "item_4",
+    "item_5",
+    "backpack_0",
+    "backpack_1",
+    "backpack_2",
+    "kills",
+    "deaths",
+    "assists",
+    "leaver_status",
+    "last_hits",
+    "denies",
+    "gold_per_min",
+    "xp_per_min",
+    "level",
+    "hero_damage",
+    "tower_damage",
+    "hero_healing",
+    "gold",
+    "gold_spent",
+    "scaled_hero_damage",
+    "scaled_tower_damage",
+    "scaled_hero_healing"
+]
+
+
+class ParseException(Exception):
+    """Used to indicate a parse error in the JSON from Valve API"""
+
+
+@functools.lru_cache(maxsize=None)
+def get_item_fields(keys):
+    """Item fields for a player record with `keys`, in the order the API
+    returns them. Active items (including neutral items) come first, followed
+    by the backpack. Returns the fields and the number of active items.
+    Cached since every player in a response has the same layout."""
+
+    active = [t for t in keys if t[0:4] == 'item']
+    backpack = [t for t in keys if t[0:8] == 'backpack']
+    return active + backpack, len(active)
+
+
+def match_rejects(matches):
+    """Match level filters of `parse_matches`, returns the reject code of
+    each match (0 if it passes)"""
+
+    reject = np.zeros(len(matches), dtype=np.int8)
+    for idx, match in enumerate(matches):
+        game_mode = meta.MODE_ENUM[str(match['game_mode'])]['name']
+        if game_mode not in VALID_GAME_MODES:
+            reject[idx] = REJECT_REASONS.index("Bad Mode")
+        elif match['duration'] < MIN_MATCH_LEN:
+            reject[idx] = REJECT_REASONS.index("Min Length")
+        elif match['lobby_type'] not in meta.LOBBY_ENUM.values():
+            reject[idx] = REJECT_REASONS.index("Unknown lobby type")
+        elif match['lobby_type'] not in VALID_LOBBY_TYPES:
+            reject[idx] = REJECT_REASONS.index("Lobby Type")
+        elif {} in match["players"]:
+            reject[idx] = REJECT_REASONS.index("Min Players")
+    return reject
+
+
+def player_columns(matches, reject):
+    """Player columns of `parse_matches`, as a dictionary of (matches,
+    players) arrays, read for matches with no `reject` code only. Also has
+    `present`, `leaver`, `kills`, `deaths` and `no_items` for the player
+    level filters."""
+
+    num_players = max([len(t['players']) for t in matches] + [0])
+    shape = (len(matches), num_players)
+    columns = {t: np.zeros(shape, dtype=np.int32) for t in PLAYER_COLUMNS}
+    columns.update({t: np.zeros(shape, dtype=bool)
+                    for t in ['present', 'leaver', 'no_items']})
+    columns['player_slot'] = np.full(shape, -1, dtype=np.int32)
+    columns['num_items'] = np.zeros(shape, dtype=np.int32)
+    columns['item_slots'] = np.zeros(shape + (len(ITEM_SLOTS),),
+                                     dtype=np.int32)
+    player_items = {}
+
+    for idx in np.flatnonzero(reject == 0):
+        for jdx, player in enumerate(matches[idx]['players']):
+            columns['present'][idx, jdx] = True
+            columns['leaver'][idx, jdx] = player['leaver_status'] > 1
+            columns['player_slot'][idx, jdx] = player['player_slot']
+            for name in PLAYER_COLUMNS:
+                columns[name][idx, jdx] = player[name]
+
+            fields, num_active = get_item_fields(tuple(player.keys()))
+            items = [player[t] for t in fields]
+            columns['no_items'][idx, jdx] = num_active > 0 and \
+                not any(items[0:num_active])
+            columns['num_items'][idx, jdx] = len(items)
+            player_items[(idx, jdx)] = items
+            columns['item_slots'][idx, jdx] = [player.get(t, 0)
+                                               for t in ITEM_SLOTS]
+
+    columns['items'] = np.zeros(
+        shape + (columns['num_items'].max(initial=0),), dtype=np.int32)
+    for (idx, jdx), values in player_items.items():
+        columns['items'][idx, jdx, 0:len(values)] = values
+
+    return columns
+
+
+def player_rejects(columns, reject):
+    """Apply the player level filters of `parse_matches` to `columns` from
+    `player_columns`, in order of precedence for each player. The first
+    player failing any of them rejects the match. Updates `reject` and
+    returns the index of the player causing each reject (-1 if none)."""
+
+    hero_id = columns['hero_id']
+    known = np.isin(hero_id, HERO_IDS)
+    checks = np.stack([
+        ~known & (hero_id == 0),
+        ~known & (hero_id != 0),
+        (columns['deaths'] > 30) & (columns['kills'] < 5),
+        columns['no_items'],
+    ], axis=2) & columns['present'][:, :, np.newaxis]
+    codes = np.array([REJECT_REASONS.index(t) for t in [
+        "Null Hero ID", "Missing hero", "Feeding", "No items"]])
+
+    failed = checks.any(axis=2)
+    player_reject = np.where(failed, codes[checks.argmax(axis=2)], 0)
+    first = failed.argmax(axis=1) if hero_id.shape[1] > 0 else \
+        np.zeros(len(reject), dtype=np.int64)
+
+    reject_player = np.full(len(reject), -1, dtype=np.int8)
+    mask = (reject == 0) & failed.any(axis=1)
+    reject[mask] = player_reject[mask, first[mask]]
+    reject_player[mask] = first[mask]
+
+    mask = (reject == 0) & (columns['leaver'] & columns['present']).any(
+        axis=1)
+    reject[mask] = REJECT_REASONS.index("Leaver")
+
+    return reject_player
+
+
+def parse_matches(matches):
+    """Parse a batch of matches from the main API endpoint into columnar
+    NumPy arrays, one row per match (and one column per player):
+
+        match_id, start_time, radiant_win, api_skill     (matches)
+        hero_id, player_slot, gold_per_min, gold_spent   (matches, players)
+        items                       (matches, players, item fields)
+        num_items                   (matches, players)
+        item_slots                  (matches, players, ITEM_SLOTS)
+        reject                      (matches), index into REJECT_REASONS
+        reject_player               (matches), player causing the reject
+
+    Filters are applied in the same order as the API would be checked one
+    match at a time, so the first failing condition sets `reject`. Player
+    fields are only read for matches passing the match level filters.
+    """
+    reject = match_rejects(matches)
+    columns = player_columns(matches, reject)
+    reject_player = player_rejects(columns, reject)
+
+    return {
+        'match_id': np.array([t['match_id'] for t in matches],
+                             dtype=np.int64),
+        'start_time': np.array([t['start_time'] for t in matches],
+                               dtype=np.int64),
+        'radiant_win': np.array([t['radiant_win'] for t in matches],
+                                dtype=bool),
+        'api_skill': np.array([t['api_skill'] for t in matches],
+                              dtype=np.int32),
+        'hero_id': columns['hero_id'],
+        'player_slot': columns['player_slot'],
+        'gold_per_min': columns['gold_per_min'],
+        'gold_spent': columns['gold_spent'],
+        'items': columns['items'],
+        'num_items': columns['num_items'],
+        'item_slots': columns['item_slots'],
+        'reject': reject,
+        'reject_player': reject_player,
+    }
+
+
+def get_reject(match, columns, idx):
+    """Exception describing why match `idx` in a batch from `parse_matches`
+    was rejected, None if it is valid. Data errors (unknown lobby types and
+    heroes) are a `ValueError`, everything else a `ParseException`."""
+
+    reason = REJECT_REASONS[columns['reject'][idx]]
+
+    if reason is None:
+        return None
+    if reason == "Bad Mode":
+        return ParseException("Bad Mode: {}".format(
+            meta.MODE_ENUM[str(match['game_mode'])]['name']))
+    if reason == "Unknown lobby type":
+        return ValueError("Unknown lobby type: {}".format(match['match_id']))
+    if reason == "Missing hero":
+        return ValueError("Missing hero: {} {}".format(
+            match['match_id'],
+            columns['hero_id'][idx, columns['reject_player'][idx]]))
+    return ParseException(reason)
+
+
+def get_summary(columns, idx):
+    """Summary of valid match `idx` in a batch from `parse_matches`, in the
+    format written to the database."""
+
+    # Sort heroes by farm -- probably not correct but good first pass
+    present = columns['player_slot'][idx] >= 0
+    order = np.lexsort((columns['hero_id'][idx], columns['gold_per_min'][
+        idx]))[::-1]
+    order = [t for t in order if present[t]]
+
+    radiant_heroes = [int(columns['hero_id'][idx, t]) for t in order
+                      if columns['player_slot'][idx, t] <= 4]
+    dire_heroes = [int(columns['hero_id'][idx, t]) for t in order
+                   if columns['player_slot'][idx, t] > 4]
+
+    # Items and net worth, in player order
+    items_dict = {}
+    gold_spent = {}
+    players = []
+    for jdx in np.flatnonzero(present):
+        hero = int(columns['hero_id'][idx, jdx])
+        gold_spent[hero] = int(columns['gold_spent'][idx, jdx])
+        items_dict[hero] = columns['items'][
+            idx, jdx, 0:columns['num_items'][idx, jdx]].tolist()
+        players.append({
+            'hero_id': hero,
+            'player_slot': int(columns['player_slot'][idx, jdx]),
+            'gold_spent': gold_spent[hero],
+            'items': columns['item_slots'][idx, jdx].tolist(),
+        })
+
+    return {
+        'match_id': int(columns['match_id'][idx]),
+        'start_time': int(columns['start_time'][idx]),
+        'radiant_heroes': radiant_heroes,
+        'dire_heroes': dire_heroes,
+        'radiant_win': bool(columns['radiant_win'][idx]),
+        'api_skill': int(columns['api_skill'][idx]),
+        'items': json.dumps(items_dict),
+        'gold_spent': json.dumps(gold_spent),
+        'players': players,
+    }
+
+
+def parse_match(match):
+    """Parse match info from main API endpoint, a single match wrapper around
+    `parse_matches`. Raises if the match is filtered out.
+    """
+    match['batch_time'] = int(dt.datetime.fromtimestamp(match[
+        'start_time']).strftime("%Y%m%d_%H%M"))
+
+    columns = parse_matches([match])
+    reject = get_reject(match, columns, 0)
+    if reject is not None:
+        raise reject
+
+    return get_summary(columns, 0)
+
+
+def summarize_matches(matches):
+    """Parse a batch of fetched matches with `parse_matches`. Returns the
+    valid match summaries and a count of rejects by reason."""
+
+    results = []
+    try:
+        columns = parse_matches(matches)
+        for idx, match in enumerate(matches):
+            reject = get_reject(match, columns, idx)
+            results.append(get_summary(columns, idx) if reject is None
+                           else reject)
+    except KeyError:
+        # Malformed JSON in the batch, parse one at a time to isolate it
+        results = []
+        for match in matches:
+            try:
+                results.append(parse_match(match))
+            except (ParseException, ValueError, KeyError) as e_msg:
+                results.append(e_msg)
+
+    summaries = []
+    rejects = collections.Counter()
+    for result in results:
+        if isinstance(result, ParseException):
+            rejects[str(result)] += 1
+        elif isinstance(result, Exception):
+            rejects["{0}: {1}".format(type(result).__name__, result)] += 1
+        else:
+            summaries.append(result)
+
+    return summaries, rejects
+
+
+def prefilter_match(match):
+    """Apply the filters from `parse_matches` which can be checked using the
+    `GetMatchHistory` summary of a match (valid lobby type and null hero
+    IDs), so matches which would be rejected are never fetched. Returns the
+    reject reason or None. Missing fields pass, leaving the check to
+    `parse_matches`.
+
+    Unknown lobby types and heroes also pass: they mean `meta` is out of
+    date, so the detail parse raises and the failure is logged rather than
+    counted as skipped. Player counts are not checked, `parse_matches`
+    rejects empty player slots rather than short lists."""
+
+    lobby_type = match.get('lobby_type')
+    players = match.get('players')
+
+    if lobby_type in meta.LOBBY_ENUM.values() and \
+            lobby_type not in VALID_LOBBY_TYPES:
+        return "Lobby Type"
+
+    if players is not None:
+        if 0 in [t.get('hero_id') for t in players]:
+            return "Null Hero ID"
+
+    return None
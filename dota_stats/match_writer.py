@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Database writes of parsed matches.
+
+`write_matches` writes match summaries (and their players) with batched
+upserts. A `MatchWriter` buffers at most a batch and flushes it when full or
+every `FLUSH_INTERVAL` seconds. A `BackgroundWriter` runs a `MatchWriter` on
+its own thread, the only one using the database session while fetching, fed
+from a bounded queue so a slow database only slows fetching once the queue
+is full. Transient database errors are retried with backoff.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from sqlalchemy import exc
+from dota_stats import match_parse
+from dota_stats.db_util import Match, MatchPlayer, upsert_statement
+
+BATCH_SIZE = int(os.environ.get('DOTA_BATCH_SIZE', 500))  # Rows per upsert
+FLUSH_INTERVAL = float(os.environ.get('DOTA_FLUSH_INTERVAL', 10))  # Seconds
+WRITE_QUEUE_SIZE = int(os.environ.get('DOTA_WRITE_QUEUE', 5000))  # Items
+WRITE_RETRIES = 5    # Attempts at a database write before giving up
+
+log = logging.getLogger("dota")
+
+
+def player_rows(summary):
+    """Rows of `dota_match_players` for a match summary"""
+
+    rows = []
+    for player in summary['players']:
+        row = {
+            'match_id': summary['match_id'],
+            'hero_id': player['hero_id'],
+            'start_time': summary['start_time'],
+            'player_slot': player['player_slot'],
+            'team': 0 if player['player_slot'] <= 4 else 1,
+            'gold_spent': player['gold_spent'],
+        }
+        row.update(zip(match_parse.ITEM_SLOTS, player['items']))
+        rows.append(row)
+    return rows
+
+
+def write_matches(session, matches, batch_size=None):
+    """Write matches to database using bulk upserts of up to `batch_size`
+    matches per statement, along with their players in
+    `dota_match_players`. Returns a list of (rows, seconds) for each batch,
+    rows counting matches."""
+
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+
+    dialect = session.get_bind().dialect.name
+    columns = [t.name for t in Match.__table__.columns]
+    stmt = upsert_statement(dialect, Match.__tablename__, columns,
+                            ['match_id'])
+    columns = [t.name for t in MatchPlayer.__table__.columns]
+    player_stmt = upsert_statement(dialect, MatchPlayer.__tablename__,
+                                   columns, ['match_id', 'hero_id'])
+
+    rows = []
+    for summary in matches:
+        rows.append({
+            'match_id': summary['match_id'],
+            'start_time': summary['start_time'],
+            'radiant_heroes': str(summary['radiant_heroes']),
+            'dire_heroes': str(summary['dire_heroes']),
+            'radiant_win': summary['radiant_win'],
+            'api_skill': summary['api_skill'],
+            'items': summary['items'],
+            'gold_spent': summary['gold_spent'],
+            **Match.hero_columns(summary['radiant_heroes'],
+                                 summary['dire_heroes']),
+        })
+
+    timings = []
+    for idx in range(0, len(rows), batch_size):
+        start = time.time()
+        session.execute(stmt, rows[idx:idx+batch_size])
+        players = [t for summary in matches[idx:idx+batch_size]
+                   for t in player_rows(summary)]
+        if players:
+            session.execute(player_stmt, players)
+        session.commit()
+        timings.append((len(rows[idx:idx+batch_size]), time.time()-start))
+
+    return timings
+
+
+class MatchWriter:
+    """Buffer parsed matches and write them with `write_matches` once
+    `batch_size` matches are waiting or `flush_interval` seconds have passed
+    since the last write."""
+
+    def __init__(self, session, batch_size=None, flush_interval=None):
+        self.session = session
+        self.batch_size = BATCH_SIZE if batch_size is None else batch_size
+        self.flush_interval = FLUSH_INTERVAL if flush_interval is None \
+            else flush_interval
+        self.buffer = []
+        self.last_flush = time.time()
+        self.timings = []
+
+    def add(self, matches):
+        """Add matches, writing if a batch is ready. Returns the timings of
+        any batches written. Call with no matches to write on time alone."""
+
+        self.buffer.extend(matches)
+        if self.ready():
+            return self.flush()
+        return []
+
+    def ready(self):
+        """True if there is a batch to write, by size or time"""
+
+        if not self.buffer:
+            return False
+        return len(self.buffer) >= self.batch_size or \
+            time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """Write everything buffered"""
+
+        timings = write_matches(self.session, self.buffer, self.batch_size)
+        for rows, seconds in timings:
+            log.info("Wrote %d matches in %.3f s (%.1f rows/s)", rows,
+                     seconds, rows/max(seconds, 1e-6))
+
+        self.buffer = []
+        self.last_flush = time.time()
+        self.timings.extend(timings)
+        return timings
+
+
+class BackgroundWriter:
+    """Database writer thread, the only user of `session` until `close`.
+    Parsed matches (`add`) and other database work (`call`) are queued in
+    order on a bounded queue, blocking the caller when it is full, and
+    matches are written in batches by a `MatchWriter`. Writes failing with a
+    transient error (`OperationalError`, e.g. a lost connection or lock
+    timeout) are retried with backoff. If the writer gives up, the error is
+    raised in the calling thread by the next `add`, `call` or `close`."""
+
+    def __init__(self, session, queue_size=None, **kwargs):
+        # Hand over the session without a transaction (and connection) open
+        # on this thread
+        session.commit()
+        self.session = session
+        self.writer = MatchWriter(session, **kwargs)
+        self.queue = queue.Queue(
+            maxsize=WRITE_QUEUE_SIZE if queue_size is None else queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def timings(self):
+        """(rows, seconds) of every batch written"""
+        return self.writer.timings
+
+    def _put(self, item):
+        """Queue an item, waiting for space"""
+
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def add(self, matches):
+        """Queue parsed matches for writing"""
+        if matches:
+            self._put(("add", matches))
+
+    def call(self, func, *args):
+        """Run `func(session, *args)` on the writer thread once everything
+        queued before it has been written"""
+        self._put(("call", (func, args)))
+
+    def _retry(self, func, *args):
+        """Call `func`, retrying transient database errors"""
+
+        for attempt in range(WRITE_RETRIES):
+            try:
+                return func(*args)
+            except exc.OperationalError as e_msg:
+                self.session.rollback()
+                if attempt == WRITE_RETRIES - 1:
+                    raise
+                log.error("Database error (attempt %d): %s", attempt + 1,
+                          str(e_msg))
+                time.sleep(2**attempt)
+        return None
+
+    def _run(self):
+        """Background writer"""
+
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                item = ("add", [])
+
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            kind, value = item
+            try:
+                if kind == "add":
+                    self.writer.buffer.extend(value)
+                    if self.writer.ready():
+                        self._retry(self.writer.flush)
+                else:
+                    self._retry(self.writer.flush)
+                    func, args = value
+                    self._retry(func, self.session, *args)
+            except Exception as e_msg:  # pylint: disable=broad-except
+                log.error("Database writer failed: %s", str(e_msg))
+                self.error = e_msg
+
+        if self.error is None:
+            try:
+                self._retry(self.writer.flush)
+                self.session.commit()
+            except Exception as e_msg:  # pylint: disable=broad-except
+                log.error("Database writer failed: %s", str(e_msg))
+                self.error = e_msg
+
+    def close(self):
+        """Write everything queued and stop the thread"""
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
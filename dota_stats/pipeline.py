@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""Fetch pipeline over `GetMatchHistory` and `GetMatchDetails`.
+
+A producer thread runs `fetch_heroes`, which calls `fetch_matches` for each
+hero. This uses the `GetMatchHistory` endpoint to fetch recent matches for a
+specified `hero` and `skill` level, continuing in a loop until no more
+matches are found. The set of seen matches is updated to prevent "re-pulls"
+of matches, and each page of new match IDs is put on a bounded queue so
+paging runs ahead of the detail fetches, across hero boundaries. Paging for
+a hero stops early at its high water mark, the start time of the newest
+match seen by the last complete fetch for that hero and skill, less a
+maximum match duration.
+
+On the main thread, `process_matches` drains the queue, submitting each page
+to the executor as soon as it arrives. This is point at which the process is
+parallelized. `process_match` calls `fetch_match` to grab a single match from
+the API, parses the output in `parse_match`, and returns. Results are handled
+as they complete, in any order: each valid match goes straight to a
+`BackgroundWriter`. A match which takes longer than `DOTA_TASK_TIMEOUT`
+seconds is cancelled and skipped, rather than holding up its page.
+
+An alternative asyncio engine (`DOTA_ENGINE=async` or `--engine async`)
+replaces the thread pool for `GetMatchDetails`. All requests are issued from
+a single event loop, with up to `DOTA_ASYNC_LIMIT` requests in flight, and
+the responses are fed through the same `parse_match` path.
+"""
+import logging
+import time
+import os
+import asyncio
+import threading
+import queue
+import collections
+from concurrent import futures
+import aiohttp
+from dota_stats import meta, http_util, match_parse, steam_api, match_writer, \
+    fetch_state
+from dota_stats.db_util import pool_stats
+
+NUM_THREADS = int(os.environ['DOTA_THREADS'])    # Match detail workers
+ENGINE = os.environ.get('DOTA_ENGINE', 'thread')  # "thread" or "async"
+ASYNC_LIMIT = int(os.environ.get('DOTA_ASYNC_LIMIT', 200))  # In-flight
+PAGE_QUEUE_SIZE = int(os.environ.get('DOTA_PAGE_QUEUE', 4))  # Pages ahead
+TASK_TIMEOUT = float(os.environ.get('DOTA_TASK_TIMEOUT', 300))  # Per match
+MAX_MATCH_DURATION = int(os.environ.get('DOTA_MAX_MATCH_DURATION', 3*60*60))
+
+# A page of new match IDs from `fetch_matches`. `start_at_match_id` is where
+# the next page starts (None after the last page of a hero), `high_water` is
+# the newest (match ID, start time) seen for the hero, on its last page only.
+Page = collections.namedtuple(
+    "Page", ["hero", "match_ids", "start_at_match_id", "high_water"])
+
+# Heroes to page through at a skill level for `run_pipeline`. The first hero
+# starts from `start_at_match_id` when resuming, `high_water` is a dictionary
+# of hero to high water mark, see `fetch_matches`. Paging ends early once the
+# optional `stop` event is set, e.g. when a work item's lease is lost.
+Job = collections.namedtuple(
+    "Job", ["heroes", "skill", "start_at_match_id", "high_water", "stop"],
+    defaults=(None, None, None))
+FAILED = object()    # Result of a match which could not be fetched or parsed
+
+log = logging.getLogger("dota")
+
+
+def summarize_match(match, txt):
+    """Run `parse_match` on a fetched match, logging the outcome. Returns
+    None if the match was filtered out."""
+
+    try:
+        summary = match_parse.parse_match(match)
+        log.debug("{0:30.30} {1}". format("Success", txt))
+        return summary
+    except match_parse.ParseException as e_msg:
+        log.debug("{0:30.30} {1}". format(str(e_msg), txt))
+        fetch_state.REJECTS.add(match['match_id'], str(e_msg),
+                                match['start_time'])
+        return None
+
+
+def process_match(hero, skill, match_id):
+    """Process a single match, used by the multi-threading engine. Returns
+    the summary, None if the match was filtered out, or `FAILED` if it
+    could not be fetched or parsed."""
+
+    txt = "match ID {0} hero {1:3} skill {2}".format(match_id, hero, skill)
+
+    try:
+        match = steam_api.fetch_match(match_id, skill)
+        return summarize_match(match, txt)
+    except steam_api.APIException as e_msg:
+        log.error("{0:30.30} {1}". format("API Error", str(e_msg)))
+    except ValueError as e_msg:
+        log.error("{0:30.30} {1}". format("Error", str(e_msg)))
+    return FAILED
+
+
+async def process_match_async(client, hero, skill, match_id):
+    """Process a single match, used by the asyncio engine."""
+
+    txt = "match ID {0} hero {1:3} skill {2}".format(match_id, hero, skill)
+
+    try:
+        match = await steam_api.fetch_match_async(client, match_id, skill)
+        return summarize_match(match, txt)
+    except steam_api.APIException as e_msg:
+        log.error("{0:30.30} {1}". format("API Error", str(e_msg)))
+    except ValueError as e_msg:
+        log.error("{0:30.30} {1}". format("Error", str(e_msg)))
+    return FAILED
+
+
+class AsyncEngine:
+    """Runs the asyncio engine on an event loop in a background thread.
+    `submit` mirrors `ThreadPoolExecutor.submit`, returning a concurrent
+    future, so the pipeline treats both engines the same way. The connector
+    limits the number of requests in flight to `ASYNC_LIMIT`."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(
+            self._create_client(), self.loop).result()
+
+    @staticmethod
+    async def _create_client():
+        """Client session must be created on the event loop"""
+        connector = aiohttp.TCPConnector(limit=ASYNC_LIMIT)
+        timeout = aiohttp.ClientTimeout(total=60)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def submit(self, coroutine, *args):
+        """Schedule `coroutine(client, *args)` on the event loop"""
+        return asyncio.run_coroutine_threadsafe(
+            coroutine(self.client, *args), self.loop)
+
+    def shutdown(self):
+        """Close the client session and stop the event loop"""
+        asyncio.run_coroutine_threadsafe(self.client.close(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def create_executor(engine):
+    """Create the executor for match details, either a thread pool or the
+    asyncio engine."""
+
+    if engine == "async":
+        return AsyncEngine()
+    return futures.ThreadPoolExecutor(max_workers=NUM_THREADS)
+
+
+def submit_match(executor, hero, skill, match_id):
+    """Fetch and parse a single match on `executor`, returns a future."""
+
+    if isinstance(executor, AsyncEngine):
+        return executor.submit(process_match_async, hero, skill, match_id)
+    return executor.submit(process_match, hero, skill, match_id)
+
+
+def submit_time(executor):
+    """Start time of a task just submitted to `executor`, for `wait_tasks`.
+    Futures of the asyncio engine never report running, the coroutine is
+    started on the event loop straight away so the clock starts now."""
+
+    return time.time() if isinstance(executor, AsyncEngine) else None
+
+
+def wait_tasks(tasks, timeout=1.0):
+    """Wait up to `timeout` seconds for any of `tasks`, a dictionary of
+    futures to [context, start time], the start time being filled in once
+    the task is seen running if `submit_time` did not set it. Finished
+    tasks are removed and returned as a list of (context, result). Tasks
+    running for more than `TASK_TIMEOUT` seconds are cancelled, removed and
+    returned as a list of contexts."""
+
+    if not tasks:
+        return [], []
+
+    finished, _ = futures.wait(
+        list(tasks), timeout=min(timeout, TASK_TIMEOUT),
+        return_when=futures.FIRST_COMPLETED)
+    results = [(tasks.pop(task)[0], task.result()) for task in finished]
+
+    now = time.time()
+    timed_out = []
+    for task, (context, started) in list(tasks.items()):
+        if started is None:
+            if task.running():
+                tasks[task][1] = now
+        elif now - started > TASK_TIMEOUT:
+            # Cancels the coroutine on the async engine, a thread can't be
+            # interrupted but its result is ignored
+            task.cancel()
+            del tasks[task]
+            timed_out.append(context)
+
+    return results, timed_out
+
+
+def fetch_and_parse(hero, skill, match_ids, executor):
+    """Fetch and parse `match_ids` on `executor`, returns the list of valid
+    match summaries in the order of `match_ids`."""
+
+    tasks = {submit_match(executor, hero, skill, match_id):
+             [idx, submit_time(executor)]
+             for idx, match_id in enumerate(match_ids)}
+
+    matches = [None] * len(match_ids)
+    while tasks:
+        results, timed_out = wait_tasks(tasks)
+        for idx, match in results:
+            matches[idx] = match
+        for idx in timed_out:
+            log.error("Timed out fetching match %d", match_ids[idx])
+
+    return [m for m in matches if m is not None and m is not FAILED]
+
+
+def submit_pages(page_queue, executor, skill, pages, tasks):
+    """Take pages from `page_queue` and submit their matches to `executor`,
+    until at least two pages have matches outstanding and there are twice
+    as many tasks as workers. Waits for a page only if there are no `tasks`.
+    Each page is appended to `pages` as [page, matches outstanding]. Returns
+    True once the end of the pages is reached."""
+
+    if isinstance(executor, AsyncEngine):
+        max_pending = 2*ASYNC_LIMIT
+    else:
+        max_pending = 2*NUM_THREADS
+
+    while sum(1 for t in pages if t[1] > 0) < 2 or len(tasks) < max_pending:
+        try:
+            page = page_queue.get(block=not tasks)
+        except queue.Empty:
+            return False
+
+        if page is None:
+            return True
+
+        entry = [page, len(page.match_ids)]
+        pages.append(entry)
+        for match_id in page.match_ids:
+            task = submit_match(executor, page.hero, skill, match_id)
+            tasks[task] = [(entry, match_id), submit_time(executor)]
+    return False
+
+
+def collect_matches(tasks, skip_heroes):
+    """Wait for `tasks` from `submit_pages`, counting down the matches
+    outstanding on their pages. Heroes with a match which failed or timed
+    out are added to `skip_heroes`. Returns the valid match summaries."""
+
+    results, timed_out = wait_tasks(tasks)
+    for (entry, _), result in results:
+        entry[1] -= 1
+        if result is FAILED:
+            skip_heroes.add(entry[0].hero)
+    for entry, match_id in timed_out:
+        entry[1] -= 1
+        skip_heroes.add(entry[0].hero)
+        log.error("Timed out fetching match %d (hero %d)", match_id,
+                  entry[0].hero)
+    return [t[1] for t in results if t[1] is not None and t[1] is not FAILED]
+
+
+def process_matches(session, page_queue, skill, executor, checkpoint=False):
+    """Consumer side of the pipeline. Takes pages of match IDs from
+    `page_queue` and submits them to `executor` as soon as they arrive. At
+    least two pages (or twice as many matches as workers) are kept in the
+    executor. Results are streamed to a `BackgroundWriter` as they complete,
+    so a slow match only holds up itself. A match running for more than
+    `TASK_TIMEOUT` seconds is cancelled and skipped.
+
+    Once every match up to a page is done, the writer saves the high water
+    marks of completed heroes after writing them, along with the position
+    of the last page if `checkpoint` is set. The high water mark of a hero
+    with a skipped or failed match is not saved, so the next run pages back
+    over it.
+    """
+
+    writer = match_writer.BackgroundWriter(session)
+    pages = collections.deque()    # [page, matches outstanding], in order
+    tasks = {}
+    skip_heroes = set()    # Heroes with matches timed out or failed
+    done = False
+
+    try:
+        while not done or tasks:
+            if not done:
+                done = submit_pages(page_queue, executor, skill, pages, tasks)
+            writer.add(collect_matches(tasks, skip_heroes))
+
+            # Pages finished so far, recorded once their matches are written
+            completed = []
+            while pages and pages[0][1] == 0:
+                completed.append(pages.popleft()[0])
+            if completed:
+                writer.call(fetch_state.record_progress, skill, completed,
+                            checkpoint, frozenset(skip_heroes))
+                writer.call(fetch_state.REJECTS.save)
+
+        writer.call(fetch_state.record_progress, skill, [t[0] for t in pages],
+                    checkpoint, frozenset(skip_heroes))
+        writer.call(fetch_state.REJECTS.save)
+    finally:
+        writer.close()
+
+
+def fetch_matches_loop(url, skill, start_at_match_id, hero):
+    """Loop until we find matches. There is a bug in valve API with load
+    balancing, sometimes the API returns no matches, so we'll re-try a few
+    times if we expect more matches.
+    """
+    resp = {}
+    for retry in range(20):
+        resp = steam_api.fetch_url(url.format(
+            skill,
+            start_at_match_id,
+            hero,
+        ))
+
+        log.error("num_results (try %d) %d", retry, resp['num_results'])
+
+        # If we found results, break out of loop
+        if resp['num_results'] > 0:
+            break
+
+        time.sleep(1)
+
+    return resp
+
+
+def filter_page(matches):
+    """IDs of the new matches on a `GetMatchHistory` page. Matches are
+    claimed in `MATCH_IDS`, so they're not fetched twice either in this run
+    or by another shard, and those rejected before or which the summary
+    shows would be rejected are removed."""
+
+    new_ids = set(fetch_state.MATCH_IDS.claim(
+        [t['match_id'] for t in matches],
+        [t['start_time'] for t in matches]))
+
+    match_ids = []
+    for match in matches:
+        if match['match_id'] not in new_ids or \
+                fetch_state.REJECTS.check(match['match_id']):
+            continue
+
+        reason = match_parse.prefilter_match(match)
+        if reason is not None:
+            fetch_state.SKIPPED[reason] += 1
+            continue
+        match_ids.append(match['match_id'])
+    return match_ids
+
+
+def fetch_matches(hero, skill, start_at_match_id=None, high_water=None):
+    """Gets list of matches by page. This is just the index, not the
+    individual match results. Generates a `Page` of new match IDs for each
+    page of history, the next page is only requested once the caller asks
+    for it.
+
+    Paging stops early once a page reaches matches which started
+    `MAX_MATCH_DURATION` seconds before `high_water`, the start time of the
+    newest match of a previous complete fetch for this hero and skill. Match
+    IDs are assigned when a game starts but history only lists finished
+    games, so a long game can appear after the mark was saved with a lower
+    ID. It can't have started more than a game length before the mark.
+    """
+    counter = 1
+    start = time.time()
+    newest = (0, 0)    # Newest match ID and start time seen
+    if start_at_match_id is None:
+        start_at_match_id = 9999999999
+
+    url = steam_api.API_URL + "GetMatchHistory/"
+    url += "V001/?skill={0}&start_at_match_id={1}&hero_id={2}"
+
+    no_results_remain = False
+    while not no_results_remain:
+        log.info("Fetching more matches: %d", counter)
+
+        resp = fetch_matches_loop(url, skill, start_at_match_id, hero)
+
+        oldest_time = None
+        if resp['num_results'] > 0:
+            match_ids = [t['match_id'] for t in resp['matches']]
+            start_times = [t['start_time'] for t in resp['matches']]
+            start_at_match_id = min(match_ids)-1
+            newest = (max([newest[0]] + match_ids),
+                      max([newest[1]] + start_times))
+            oldest_time = min(start_times)
+
+        matches = filter_page(resp['matches'])
+        log.info("%d matches after removing duplicates and filtering.",
+                 len(matches))
+
+        # Exit if no results remain, or the rest were fetched by a
+        # previous run.
+        if resp['results_remaining'] == 0:
+            no_results_remain = True
+        elif high_water is not None and oldest_time is not None and \
+                oldest_time <= high_water - MAX_MATCH_DURATION:
+            log.info("Reached high water mark (start time %d), %d remaining "
+                     "skipped", high_water, resp['results_remaining'])
+            no_results_remain = True
+        else:
+            log.info("Remaining %d (Match ID %d)", resp['results_remaining'],
+                     start_at_match_id)
+
+        if no_results_remain:
+            yield Page(hero, matches, None, newest if newest[0] else None)
+        else:
+            yield Page(hero, matches, start_at_match_id, None)
+
+        counter = counter+1
+
+    log.debug("Matches per minute: %s", str(60*counter/(time.time()-start)))
+
+
+def fetch_heroes(job, page_queue, stop):
+    """Page through match history for the heroes of `job`, a `Job`, runs in
+    its own thread ahead of the match detail workers. Each page is put on
+    `page_queue`, blocking if the consumer falls behind, and a final `None`
+    marks the end of the pages. Paging ends early once `stop` or the job's
+    own stop event is set, before requesting or queueing another page."""
+
+    def stopped():
+        return stop.is_set() or (job.stop is not None and job.stop.is_set())
+
+    high_water = job.high_water or {}
+    start_at_match_id = job.start_at_match_id
+    try:
+        counter = 1
+        for hero in job.heroes:
+            if stopped():
+                break
+            log.info("-----------------------------------------------------")
+            log.info(">>>>>>>> Hero: %s %d/%d Skill: %d <<<<<<<<",
+                     meta.HERO_DICT[hero], counter, len(job.heroes),
+                     job.skill)
+            log.info("-----------------------------------------------------")
+            for page in fetch_matches(hero, job.skill, start_at_match_id,
+                                      high_water.get(hero)):
+                if stopped():
+                    break
+                page_queue.put(page)
+                if stopped():
+                    break
+            start_at_match_id = None
+            counter += 1
+
+            stats = http_util.connection_stats()
+            log.info("HTTP connections %d handshakes %d requests %d "
+                     "reused %d", stats['connections'], stats['handshakes'],
+                     stats['requests'], stats['reused'])
+            for stats in http_util.get_keys().stats():
+                log.info("Key %s requests %d rate limit %.1f/s concurrency "
+                         "%d throttled %d forbidden %d cooldown %.0fs",
+                         stats['key'], stats['requests'], stats['rate'],
+                         stats['concurrency'], stats['throttled'],
+                         stats['forbidden'], stats['cooldown'])
+            stats = http_util.BREAKER.stats()
+            log.info("Circuit breaker open %s failures %d opened %d",
+                     stats['open'], stats['failures'], stats['opened'])
+            stats = pool_stats()
+            if stats:
+                log.info("DB pool checked out %d/%d overflow %d wait %.3fs "
+                         "max %.3fs", stats['checked_out'], stats['size'],
+                         stats['overflow'], stats['wait_time'],
+                         stats['max_wait'])
+    finally:
+        page_queue.put(None)
+
+
+def run_pipeline(session, job, executor, checkpoint=False):
+    """Page match history for `job`, a `Job`, in a producer thread, running
+    ahead of the detail workers by up to PAGE_QUEUE_SIZE pages, while match
+    details are fetched, parsed and written on this thread as pages
+    arrive."""
+
+    page_queue = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    with futures.ThreadPoolExecutor(max_workers=1) as producer:
+        history = producer.submit(fetch_heroes, job, page_queue, stop)
+        try:
+            process_matches(session, page_queue, job.skill, executor,
+                            checkpoint)
+        finally:
+            # Stop and unblock the producer if the consumer stopped early
+            stop.set()
+            while not history.done():
+                try:
+                    page_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        history.result()
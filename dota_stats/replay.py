@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Re-parse stored match JSON without calling the API (`--replay`).
+
+Reads raw match details kept in the archive (`--archive DIR`, see
+`archive.py`) or other stored match files, parses them across a process pool
+and writes the results to the database, so changes to the `parse_match`
+filters can be applied to history. A match or file which can't be read,
+such as the segment still being written or one left truncated by a killed
+run, is counted under `UNREADABLE` and the rest are replayed.
+"""
+import logging
+import time
+import os
+import gzip
+import zlib
+import json
+import glob
+import collections
+from concurrent import futures
+from dota_stats import match_parse, match_writer, pipeline
+
+UNREADABLE = "Unreadable"    # Reject reason of matches which can't be read
+
+log = logging.getLogger("dota")
+
+
+def iter_replay_files(paths):
+    """Stored match files under `paths`, which may be single match `.json`
+    files (e.g. `error` dumps), archive segments (`.json.gz`) or directories
+    containing either."""
+
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = glob.glob(os.path.join(path, "**", "*.json"),
+                                  recursive=True)
+            filenames += glob.glob(os.path.join(path, "**", "*.json.gz"),
+                                   recursive=True)
+            yield from sorted(filenames)
+        else:
+            yield path
+
+
+def read_file(filename):
+    """Matches stored in `filename`, one per line in an archive segment
+    (`archive.iter_segment`). Returns the matches read and the number of
+    unreadable lines, counting the rest of the file as one if it is
+    truncated or corrupt."""
+
+    matches = []
+    unreadable = 0
+    try:
+        if filename.endswith(".gz"):
+            with gzip.open(filename, "rt") as file_handle:
+                for line in file_handle:
+                    try:
+                        matches.append(json.loads(line))
+                    except ValueError:
+                        unreadable += 1
+        else:
+            with open(filename) as file_handle:
+                matches.append(json.loads(file_handle.read()))
+    except (OSError, EOFError, ValueError, zlib.error) as e_msg:
+        log.error("Unreadable %s: %s", filename, e_msg)
+        unreadable += 1
+
+    return matches, unreadable
+
+
+def replay_file(filename):
+    """Parse every match stored in `filename` as one batch, runs in a worker
+    process. Returns the valid match summaries and a count of rejects by
+    reason."""
+
+    matches, unreadable = read_file(filename)
+    summaries, rejects = match_parse.summarize_matches(matches)
+    if unreadable > 0:
+        rejects[UNREADABLE] += unreadable
+    return summaries, rejects
+
+
+def replay(session, paths):
+    """Re-parse stored match JSON from `paths` across a process pool and
+    bulk write the results to the database. Used to apply changes in
+    `parse_match` filters to history without fetching from the API again.
+    Returns the number of matches read and rejects by reason."""
+
+    filenames = list(iter_replay_files(paths))
+    log.info("Replaying %d files", len(filenames))
+
+    writer = match_writer.BackgroundWriter(session)
+    rejects = collections.Counter()
+    num_matches = 0
+    start = time.time()
+
+    try:
+        with futures.ProcessPoolExecutor(
+                max_workers=pipeline.NUM_THREADS) as executor:
+            for summaries, file_rejects in executor.map(replay_file,
+                                                        filenames):
+                num_matches += len(summaries) + sum(file_rejects.values())
+                rejects.update(file_rejects)
+                writer.add(summaries)
+    finally:
+        writer.close()
+
+    elapsed = max(time.time() - start, 1e-6)
+    write_time = sum(t[1] for t in writer.timings)
+    log.info("Replayed %d matches in %.1f s (%.1f matches/s), %.1f s "
+             "writing to database", num_matches, elapsed,
+             num_matches/elapsed, write_time)
+    for reason, count in rejects.most_common():
+        log.info("{0:30.30} {1}".format(reason, count))
+
+    return num_matches, rejects
@@ -4,17 +4,32 @@ import unittest
 import logging
 import os
 import json
+import time
+import threading
+import gzip
+import glob
+import tempfile
 import numpy as np
 import pandas as pd
+from sqlalchemy import create_engine, exc
 import fetch
 from dota_stats import meta, db_util, win_rate_pick_rate, dotautil, \
-    fetch_summary, win_rate_position
+    fetch_summary, win_rate_position, http_util, archive, match_parse, \
+    steam_api, match_writer, replay
+import test_fetch_pipeline
+from test_fetch_pipeline import TestSQLite
 
 # Globals
 BIGINT = 9223372036854775808    # Max bitmask
 DUMP_BUG = None                 # Set to none for no dump
 
 
+def load_tests(loader, tests, _):
+    """Run the stub server tests in `test_fetch_pipeline.py` with the rest"""
+    tests.addTests(loader.loadTestsFromModule(test_fetch_pipeline))
+    return tests
+
+
 class TestDumpBug(unittest.TestCase):
     """Use this class to dump a problematic match JSON for additional testing
     JSON is stored into the testing directory.
@@ -28,7 +43,7 @@ class TestDumpBug(unittest.TestCase):
             return
 
         match_id = str(DUMP_BUG)
-        match = fetch.fetch_match(match_id, 0)
+        match = steam_api.fetch_match(match_id, 0)
         with open("./testing/{}.json".format(match_id), "w") as filename:
             filename.write(json.dumps(match, indent=4))
             self.assertTrue(match is not None)
@@ -88,15 +103,15 @@ class TestFetchSummary(unittest.TestCase):
 
 
 class TestFetch(TestDB):
-    """Test routines in the main fetch.py logic"""
+    """Test routines in the main fetch logic"""
 
     def test_bad_api_key(self):
         """Bad API Key"""
 
         old_key = os.environ["STEAM_KEY"]
         os.environ["STEAM_KEY"] = "AAAAA"
-        with self.assertRaises(fetch.APIException) as context:
-            _ = fetch.fetch_match(111, 1)
+        with self.assertRaises(steam_api.APIException) as context:
+            _ = steam_api.fetch_match(111, 1)
 
         self.assertEqual(str(context.exception),
                          'Forbidden - Check Steam API key')
@@ -105,8 +120,8 @@ class TestFetch(TestDB):
     def test_bad_match_id(self):
         """Bad Match ID"""
 
-        with self.assertRaises(fetch.APIException) as context:
-            _ = fetch.fetch_match(111, 1)
+        with self.assertRaises(steam_api.APIException) as context:
+            _ = steam_api.fetch_match(111, 1)
         self.assertEqual(str(context.exception), 'Match ID not found')
 
     def test_feeding_bit_detection(self):
@@ -116,7 +131,7 @@ class TestFetch(TestDB):
             match = json.loads(filename.read())
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'Feeding')
 
@@ -126,7 +141,7 @@ class TestFetch(TestDB):
 
         with open("./testing/backpack.json") as filename:
             match = json.loads(filename.read())
-        parsed_match = fetch.parse_match(match)
+        parsed_match = match_parse.parse_match(match)
         item_dict = json.loads(parsed_match['items'])
         jugg = item_dict[str(meta.REVERSE_HERO_DICT['juggernaut'])]
         self.assertTrue(meta.ITEMS['phase_boots']['id'] in jugg)
@@ -138,7 +153,7 @@ class TestFetch(TestDB):
         file_handle.close()
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'No items')
 
@@ -148,7 +163,7 @@ class TestFetch(TestDB):
             match = json.loads(filename.read())
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'Null Hero ID')
 
@@ -169,9 +184,9 @@ class TestFetch(TestDB):
         with open("./testing/write_match.json") as filename:
             match = json.loads(filename.read())
 
-        match = fetch.parse_match(match)
+        match = match_parse.parse_match(match)
         match_id = match['match_id']
-        fetch.write_matches(self.session, [match])
+        match_writer.write_matches(self.session, [match])
 
         match_read = self.session.query(db_util.Match).\
             filter(db_util.Match.match_id == match_id).first()
@@ -183,6 +198,316 @@ class TestFetch(TestDB):
                          match['dire_heroes'])
 
 
+class TestPrefilter(unittest.TestCase):
+    """Filters applied to the match history summary"""
+
+    def test_prefilter_match(self):
+        """Matches are skipped using lobby type and hero IDs"""
+
+        players = [{'account_id': 4294967295, 'player_slot': t,
+                    'hero_id': t+1} for t in range(10)]
+        match = {'match_id': 1, 'start_time': 1607867126, 'lobby_type': 7,
+                 'players': players}
+        self.assertIsNone(match_parse.prefilter_match(match))
+        self.assertIsNone(match_parse.prefilter_match({'match_id': 1}))
+
+        self.assertEqual(match_parse.prefilter_match(dict(match,
+                                                          lobby_type=1)),
+                         "Lobby Type")
+        self.assertEqual(match_parse.prefilter_match(dict(
+            match, players=players[1:] + [dict(players[0], hero_id=0)])),
+                         "Null Hero ID")
+
+        # Left for the detail parse to raise on, not skipped
+        self.assertIsNone(match_parse.prefilter_match(dict(match,
+                                                           lobby_type=99)))
+        self.assertIsNone(match_parse.prefilter_match(dict(
+            match, players=players[1:])))
+        self.assertIsNone(match_parse.prefilter_match(dict(
+            match, players=players[1:] + [dict(players[0], hero_id=999)])))
+
+
+class TestBulkWriter(TestSQLite):
+    """Batched upserts of parsed matches"""
+
+    def test_write_matches(self):
+        """Matches are written in batches, re-writes update in place"""
+
+        with open("./testing/write_match.json") as filename:
+            match = match_parse.parse_match(json.loads(filename.read()))
+
+        matches = []
+        for match_id in range(25):
+            matches.append(dict(match, match_id=match_id))
+
+        timings = match_writer.write_matches(self.session, matches,
+                                             batch_size=10)
+        self.assertEqual([t[0] for t in timings], [10, 10, 5])
+
+        # Upsert over the top of existing rows
+        writer = match_writer.MatchWriter(self.session, batch_size=10,
+                                          flush_interval=3600)
+        self.assertEqual(writer.add([dict(matches[0], radiant_win=True)]),
+                         [])
+        self.assertEqual(len(writer.flush()), 1)
+
+        rows = self.session.query(db_util.Match).all()
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0].radiant_win, 1)
+        self.assertEqual(json.loads(rows[0].radiant_heroes),
+                         match['radiant_heroes'])
+
+    def test_players(self):
+        """Every player is written to dota_match_players with fixed item
+        slots"""
+
+        with open("./testing/write_match.json") as filename:
+            raw = json.loads(filename.read())
+        match = match_parse.parse_match(dict(raw))
+
+        match_writer.write_matches(self.session, [match, match])
+        rows = self.session.query(db_util.MatchPlayer).all()
+        self.assertEqual(len(rows), 10)
+
+        radiant = sorted(t.hero_id for t in rows if t.team == 0)
+        self.assertEqual(radiant, sorted(match['radiant_heroes']))
+
+        player = raw['players'][0]
+        row = self.session.query(db_util.MatchPlayer).get(
+            (match['match_id'], player['hero_id']))
+        self.assertEqual(row.gold_spent, player['gold_spent'])
+        self.assertEqual(row.player_slot, player['player_slot'])
+        self.assertEqual([getattr(row, t) for t in match_parse.ITEM_SLOTS],
+                         [player[t] for t in match_parse.ITEM_SLOTS])
+
+
+class TestBackgroundWriter(TestSQLite):
+    """Database writes on a dedicated thread"""
+
+    def setUp(self):
+        super().setUp()
+        with open("./testing/write_match.json") as filename:
+            self.match = match_parse.parse_match(json.loads(filename.read()))
+
+    def count(self):
+        """Matches in the database"""
+        return self.session.query(db_util.Match).count()
+
+    def test_ordered_calls(self):
+        """Calls run after every match queued before them is written, and
+        close flushes the rest"""
+
+        counts = []
+        writer = match_writer.BackgroundWriter(self.session, batch_size=100,
+                                               flush_interval=3600)
+        writer.add([dict(self.match, match_id=t) for t in range(5)])
+        writer.call(lambda session: counts.append(
+            session.query(db_util.Match).count()))
+        writer.add([dict(self.match, match_id=t) for t in range(5, 8)])
+        writer.close()
+
+        self.assertEqual(counts, [5])
+        self.assertEqual(self.count(), 8)
+
+    def test_backpressure(self):
+        """A full queue blocks the caller until the writer catches up"""
+
+        release = threading.Event()
+        writer = match_writer.BackgroundWriter(self.session, queue_size=1)
+        writer.call(lambda session: release.wait())
+        writer.add([self.match])
+
+        blocked = threading.Thread(target=writer.add, args=([self.match],))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join()
+        writer.close()
+        self.assertEqual(self.count(), 1)
+
+    def test_retry(self):
+        """Transient database errors are retried, others are raised by
+        close"""
+
+        attempts = []
+
+        def flaky(session):
+            attempts.append(session)
+            if len(attempts) < 2:
+                raise exc.OperationalError("INSERT", {}, Exception("gone"))
+
+        writer = match_writer.BackgroundWriter(self.session)
+        writer.call(flaky)
+        writer.add([self.match])
+        writer.close()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.count(), 1)
+
+        writer = match_writer.BackgroundWriter(self.session)
+        writer.call(lambda session: 1/0)
+        with self.assertRaises(ZeroDivisionError):
+            writer.close()
+
+
+class TestParseMatches(unittest.TestCase):
+    """Batched, columnar parsing of matches"""
+
+    def test_parse_matches(self):
+        """Batch parse agrees with parsing one match at a time"""
+
+        matches = []
+        for name in ["write_match", "bots", "backpack", "null_hero",
+                     "no_items"]:
+            with open("./testing/{}.json".format(name)) as filename:
+                matches.append(json.loads(filename.read()))
+
+        columns = match_parse.parse_matches(matches)
+        self.assertEqual(columns['hero_id'].shape, (5, 10))
+        self.assertEqual(columns['items'].shape[:2], (5, 10))
+
+        reasons = [match_parse.REJECT_REASONS[t] for t in columns['reject']]
+        self.assertEqual(reasons, [None, 'Feeding', None, 'Null Hero ID',
+                                   'No items'])
+
+        for idx, match in enumerate(matches):
+            reject = match_parse.get_reject(match, columns, idx)
+            if reject is None:
+                self.assertEqual(match_parse.get_summary(columns, idx),
+                                 match_parse.parse_match(match))
+            else:
+                with self.assertRaises(match_parse.ParseException) as context:
+                    match_parse.parse_match(match)
+                self.assertEqual(str(context.exception), str(reject))
+
+        # Heroes are ordered by GPM, highest first
+        summary = match_parse.get_summary(columns, 0)
+        self.assertEqual(summary['radiant_heroes'], [93, 128, 65, 86, 51])
+        self.assertEqual(summary['dire_heroes'], [18, 13, 129, 101, 57])
+
+
+class TestArchive(unittest.TestCase):
+    """Compressed archive of raw match details"""
+
+    def test_archive(self):
+        """Archive rotates segments, matches can be read back by ID or by
+        streaming segments"""
+
+        with open("./testing/write_match.json") as filename:
+            match = json.loads(filename.read())
+
+        with tempfile.TemporaryDirectory() as directory:
+            match_archive = archive.MatchArchive(directory,
+                                                 segment_bytes=1)
+            for match_id in range(5):
+                match_archive.put(dict(match, match_id=match_id))
+            match_archive.close()
+
+            segments = sorted(glob.glob(os.path.join(directory, "*.gz")))
+            self.assertEqual(len(segments), 5)
+            streamed = [t['match_id'] for segment in segments
+                        for t in archive.iter_segment(segment)]
+            self.assertEqual(streamed, list(range(5)))
+
+            # Re-open, new matches go into a new segment
+            match_archive = archive.MatchArchive(directory)
+            match_archive.put(dict(match, match_id=5))
+            match_archive.close()
+
+            self.assertEqual(match_archive.read(3), dict(match, match_id=3))
+            self.assertEqual(match_archive.read(5)['match_id'], 5)
+            self.assertIsNone(match_archive.read(6))
+            self.assertEqual(
+                len(glob.glob(os.path.join(directory, "*.gz"))), 6)
+
+
+class TestReplay(TestSQLite):
+    """Offline re-parse of stored match JSON"""
+
+    def test_replay(self):
+        """Replay single match files and archive segments"""
+
+        with open("./testing/write_match.json") as filename:
+            match = json.loads(filename.read())
+
+        with tempfile.TemporaryDirectory() as directory:
+            match_archive = archive.MatchArchive(directory)
+            for match_id in range(10):
+                match_archive.put(dict(match, match_id=match_id))
+            match_archive.close()
+
+            # A segment cut off mid-line, one cut off mid-block and a
+            # corrupt match file
+            with gzip.open(os.path.join(directory, "partial.json.gz"),
+                           "wt") as file_handle:
+                for match_id in range(10, 12):
+                    file_handle.write(json.dumps(dict(match,
+                                                      match_id=match_id)))
+                    file_handle.write("\n")
+                file_handle.write('{"match_id": 12, "play')
+            data = gzip.compress(json.dumps(match).encode())
+            with open(os.path.join(directory, "truncated.json.gz"),
+                      "wb") as file_handle:
+                file_handle.write(data[:len(data)//2])
+            with open(os.path.join(directory, "corrupt.json"),
+                      "w") as file_handle:
+                file_handle.write('{"match_id": ')
+
+            num_matches, rejects = replay.replay(self.session,
+                                                 [directory, "testing"])
+
+        # 12 archived, 5 test matches (2 valid), a non-match JSON file and 3
+        # unreadable
+        self.assertEqual(num_matches, 21)
+        self.assertEqual(rejects[replay.UNREADABLE], 3)
+        self.assertEqual(rejects['Feeding'], 1)
+        self.assertEqual(rejects['No items'], 1)
+        self.assertEqual(rejects['Null Hero ID'], 1)
+        self.assertEqual(rejects["KeyError: 'start_time'"], 1)
+        self.assertEqual(self.session.query(db_util.Match).count(), 14)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Shared token bucket and AIMD concurrency controller"""
+
+    def test_aimd(self):
+        """Throttling halves rate and concurrency, success ramps up"""
+
+        limiter = http_util.RateLimiter(rate=10, concurrency=8, min_rate=1,
+                                        max_rate=20, max_concurrency=16)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.stats()['in_flight'], 2)
+
+        # Two 429s in the same window only decrease once
+        limiter.release(throttled=True)
+        limiter.release(throttled=True)
+        stats = limiter.stats()
+        self.assertEqual(stats['rate'], 5)
+        self.assertEqual(stats['concurrency'], 4)
+        self.assertEqual(stats['throttled'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+        for _ in range(50):
+            limiter.in_flight += 1
+            limiter.release()
+        stats = limiter.stats()
+        self.assertGreater(stats['rate'], 5)
+        self.assertGreater(stats['concurrency'], 4)
+        self.assertLessEqual(stats['rate'], 20)
+
+    def test_token_bucket(self):
+        """Requests are spaced out at the configured rate"""
+
+        limiter = http_util.RateLimiter(rate=50, concurrency=8, max_rate=50)
+        start = time.time()
+        for _ in range(11):
+            limiter.acquire()
+            limiter.release()
+        self.assertGreater(time.time() - start, 0.15)
+
+
 class TestDBUtil(unittest.TestCase):
     """Test utility functions in DBUtil"""
 
@@ -197,6 +522,109 @@ class TestDBUtil(unittest.TestCase):
         self.assertEqual(begin[-1], 1609210800)
 
 
+class TestPartitions(unittest.TestCase):
+    """Daily partition maintenance and purge"""
+
+    def test_partitions(self):
+        """Partitions are planned ahead by day and expire by whole days"""
+
+        day = db_util.DAY
+        start = 1609459200    # 2021-01-01 00:00 UTC
+        self.assertEqual(db_util.partition_name(start + day), "p20210101")
+
+        # Last partition ends 2021-01-02, now is during 2021-01-03
+        bounds = db_util.new_partition_bounds(start + day, start + 2.5*day,
+                                              days_ahead=2)
+        self.assertEqual(bounds, [start + t*day for t in range(2, 6)])
+        self.assertEqual(db_util.new_partition_bounds(
+            bounds[-1], start + 2.5*day, days_ahead=2), [])
+
+        partitions = [(db_util.partition_name(t), t) for t in bounds]
+        self.assertEqual(db_util.expired_partitions(
+            partitions, start + 3*day - 1), ["p20210102", "p20210103"])
+        self.assertEqual(db_util.expired_partitions(
+            partitions, start + 3*day - 2), ["p20210102"])
+
+    def test_sqlite(self):
+        """Nothing to maintain without partitioning"""
+        db_util.maintain_partitions(create_engine("sqlite://"))
+
+
+class TestEngineRegistry(unittest.TestCase):
+    """Process wide engines and pool metrics"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.uri = "sqlite:///{}".format(os.path.join(self.tmp.name, "db"))
+
+    def tearDown(self):
+        engine = db_util.ENGINES.pop(self.uri, None)
+        if engine is not None:
+            engine.dispose()
+        self.tmp.cleanup()
+
+    def pooled_engine(self):
+        """Register a `TimedQueuePool` engine as get_engine would for
+        MariaDB"""
+        engine = create_engine(self.uri, poolclass=db_util.TimedQueuePool,
+                               pool_size=1, max_overflow=1)
+        db_util._fork_safe(engine)  # pylint: disable=protected-access
+        db_util.ENGINES[self.uri] = engine
+        return engine
+
+    def test_shared(self):
+        """One engine per URI, sessions bound to the shared engine"""
+
+        engine = db_util.get_engine(self.uri)
+        self.assertIs(db_util.get_engine(self.uri), engine)
+        self.assertIsNot(db_util.get_engine("sqlite://"), engine)
+        self.assertIs(db_util.connect_database()[0], db_util.get_engine())
+        self.assertEqual(db_util.pool_stats(self.uri), {})
+
+    def test_pool_stats(self):
+        """Checked out connections, overflow and waits are reported"""
+
+        engine = self.pooled_engine()
+        first = engine.connect()
+        second = engine.connect()
+        stats = db_util.pool_stats(self.uri)
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+
+        # Pool exhausted, the next checkout waits for a connection
+        threading.Timer(0.2, first.close).start()
+        third = engine.connect()
+        stats = db_util.pool_stats(self.uri)
+        self.assertGreaterEqual(stats['max_wait'], 0.1)
+        self.assertGreaterEqual(stats['wait_time'], stats['max_wait'])
+
+        second.close()
+        third.close()
+        self.assertEqual(db_util.pool_stats(self.uri)['checked_out'], 0)
+
+    def test_fork(self):
+        """Connections opened by another process are replaced on checkout"""
+
+        engine = self.pooled_engine()
+        conn = engine.connect()
+        dbapi_conn = conn.connection.connection
+        conn.execute("select 1")
+        conn.close()
+
+        conn = engine.connect()
+        self.assertIs(conn.connection.connection, dbapi_conn)
+        # pylint: disable=protected-access
+        conn.connection._connection_record.info['pid'] = -1
+        conn.close()
+
+        conn = engine.connect()
+        self.assertIsNot(conn.connection.connection, dbapi_conn)
+        self.assertEqual(conn.execute("select 1").scalar(), 1)
+        conn.close()
+
+
 class TestWinRatePickRate(TestDB):
     """Test code to calculate win rate vs. pick rate tables"""
 
@@ -221,6 +649,89 @@ class TestWinRatePickRate(TestDB):
             sum(df_out[['radiant_total', 'dire_total']].sum(axis=1)))
 
 
+class TestSeenSet(unittest.TestCase):
+    """Compact set of fetched match IDs"""
+
+    def test_seen_set(self):
+        """Same membership behaviour as a dictionary, across merges"""
+
+        now = int(time.time())
+        seen = dotautil.SeenSet(buffer_size=4)
+        seen.update([50, 10, 30], [now]*3)
+        for match_id in [60, 20, 40, 20, 70]:
+            seen[match_id] = now
+
+        self.assertEqual(len(seen), 7)
+        for match_id in range(0, 80, 5):
+            self.assertEqual(match_id in seen,
+                             match_id % 10 == 0 and 10 <= match_id <= 70)
+
+    def test_horizon(self):
+        """Old matches are evicted when the buffer is merged"""
+
+        now = int(time.time())
+        seen = dotautil.SeenSet(horizon=3600, buffer_size=2)
+        seen[1] = now - 7200
+        seen[2] = now
+        self.assertNotIn(1, seen)
+        self.assertIn(2, seen)
+        self.assertEqual(seen.times.dtype, np.uint32)
+
+
+class TestBitmask(TestSQLite):
+    """Hero bitmasks and integer hero columns"""
+
+    def test_bitmask(self):
+        """Masks round trip through the stored signed halves"""
+
+        heroes = [1, 2, 59, 136, 135]
+        mask = dotautil.Bitmask.encode(heroes)
+        self.assertEqual(dotautil.Bitmask.decode(mask), sorted(heroes))
+
+        lo_mask, hi_mask = dotautil.Bitmask.split(mask)
+        self.assertEqual(dotautil.Bitmask.join(lo_mask, hi_mask), mask)
+        self.assertEqual(dotautil.Bitmask.split(1 << 63 | 1 << 127),
+                         (-2**63, -2**63))
+        self.assertEqual(dotautil.Bitmask.join(-2**63, -2**63),
+                         1 << 63 | 1 << 127)
+
+        with self.assertRaises(ValueError):
+            dotautil.Bitmask.encode([0])
+
+    def test_filter(self):
+        """Written matches can be filtered by hero in SQL, and old rows are
+        backfilled"""
+
+        with open("./testing/write_match.json") as filename:
+            match = match_parse.parse_match(json.loads(filename.read()))
+        match_writer.write_matches(self.session, [
+            dict(match, match_id=1),
+            dict(match, match_id=2, radiant_heroes=match['dire_heroes'],
+                 dire_heroes=match['radiant_heroes'])])
+
+        row = self.session.query(db_util.Match).get(1)
+        self.assertEqual([row.radiant_hero1, row.radiant_hero5],
+                         [match['radiant_heroes'][0],
+                          match['radiant_heroes'][4]])
+
+        for hero in match['radiant_heroes']:
+            rows = self.session.query(db_util.Match).filter(
+                db_util.Match.has_hero(hero, "radiant")).all()
+            self.assertEqual([t.match_id for t in rows], [1])
+            rows = self.session.query(db_util.Match).filter(
+                db_util.Match.has_hero(hero, "dire")).all()
+            self.assertEqual([t.match_id for t in rows], [2])
+
+        # Rows written before the columns existed
+        self.session.query(db_util.Match).update(
+            {t: None for t in db_util.Match.hero_columns([], [])})
+        self.session.commit()
+        self.assertEqual(db_util.backfill_heroes(self.engine, 1), 2)
+        rows = self.session.query(db_util.Match).filter(
+            db_util.Match.has_hero(match['radiant_heroes'][0])).all()
+        self.assertEqual([t.match_id for t in rows], [1])
+
+
 class TestMLEncoding(unittest.TestCase):
     """Test one-hot encoding for machine learning"""
 
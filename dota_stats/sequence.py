@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Match ingestion by sequence number (`--sequence`).
+
+Instead of paging match history hero by hero, walks the global match
+sequence number with `GetMatchHistoryBySequenceNum`, which returns complete
+match details in bulk. Range workers fetch consecutive blocks of sequence
+numbers in parallel, the matches go straight through `parse_matches`, and a
+cursor saved after each round lets the next run continue.
+"""
+import logging
+import time
+import os
+import collections
+from concurrent import futures
+from dota_stats import match_parse, steam_api, match_writer, fetch_state, \
+    pipeline
+
+SEQ_RANGE = int(os.environ.get('DOTA_SEQ_RANGE', 1000))  # Per range worker
+SEQ_PAGE_SIZE = 100    # Matches per GetMatchHistoryBySequenceNum call
+SEQ_RETRIES = 3    # Tries at an empty page before taking it as the head
+SEQ_RETRY_WAIT = 1.0    # Seconds between tries
+
+log = logging.getLogger("dota")
+
+
+def get_latest_sequence():
+    """Sequence number of the most recent public match, used as the starting
+    point when there is no saved cursor."""
+
+    resp = steam_api.fetch_url(steam_api.API_URL +
+                               "GetMatchHistory/V001/?matches_requested=1")
+    match = steam_api.fetch_match(resp['matches'][0]['match_id'], 0)
+    return match['match_seq_num']
+
+
+def fetch_sequence_page(url, seq_num):
+    """A page of matches from `seq_num`. Like the empty history pages
+    `fetch_matches_loop` retries, an empty or malformed page may be a
+    hiccup of the API rather than the head of the sequence, so it is tried
+    `SEQ_RETRIES` times. Returns the matches, empty at the head."""
+
+    for retry in range(SEQ_RETRIES):
+        if retry > 0:
+            time.sleep(SEQ_RETRY_WAIT)
+        page = steam_api.fetch_url(url.format(seq_num,
+                                              SEQ_PAGE_SIZE)).get('matches')
+        if page:
+            return page
+        log.debug("No matches from sequence number %d (try %d)", seq_num,
+                  retry)
+    return []
+
+
+def fetch_sequence(start, end, skill=0):
+    """Fetch matches with sequence numbers in [`start`, `end`), complete
+    details come back in bulk from `GetMatchHistoryBySequenceNum`, so they
+    are parsed directly. Runs in a range worker thread. Returns the valid
+    summaries, rejects by reason, the next sequence number to fetch and
+    whether the range was completed (False once the most recent match is
+    reached). An empty page is retried by `fetch_sequence_page` before it is
+    taken as the head, the range then stops without advancing."""
+
+    url = steam_api.API_URL + "GetMatchHistoryBySequenceNum/V001/" \
+                              "?start_at_match_seq_num={0}" \
+                              "&matches_requested={1}"
+
+    matches = []
+    seq_num = start
+    complete = True
+    while seq_num < end:
+        page = fetch_sequence_page(url, seq_num)
+        for match in page:
+            if match['match_seq_num'] >= end:
+                seq_num = end
+                break
+            if match['match_id'] not in fetch_state.MATCH_IDS:
+                matches.append(steam_api.check_match(
+                    match, match['match_id'], skill))
+            seq_num = match['match_seq_num'] + 1
+
+        # A short page is the head of the sequence, nothing more yet
+        if len(page) < SEQ_PAGE_SIZE and seq_num < end:
+            complete = False
+            break
+
+    summaries, rejects = match_parse.summarize_matches(matches)
+    return summaries, rejects, seq_num, complete
+
+
+def fetch_round(executor, start, skill, num_workers):
+    """One round of `fetch_sequence_ranges`, `num_workers` consecutive
+    ranges from `start` fetched in parallel on `executor`. Returns the valid
+    summaries, rejects by reason, the cursor and whether the most recent
+    match was reached."""
+
+    tasks = [executor.submit(fetch_sequence, start + t*SEQ_RANGE,
+                             start + (t+1)*SEQ_RANGE, skill)
+             for t in range(num_workers)]
+
+    # Ranges are in order, the cursor stops in the first one which was not
+    # completed.
+    summaries = []
+    rejects = collections.Counter()
+    cursor = start
+    caught_up = False
+    for task in tasks:
+        range_summaries, range_rejects, seq_num, complete = task.result()
+        summaries.extend(range_summaries)
+        rejects.update(range_rejects)
+        if not caught_up:
+            cursor = seq_num
+            caught_up = not complete
+
+    return summaries, rejects, cursor, caught_up
+
+
+def fetch_sequence_ranges(session, start, skill=0, num_workers=None):
+    """Walk the global match sequence from `start` until the most recent
+    match. Each round, `num_workers` range workers fetch consecutive ranges
+    of `SEQ_RANGE` sequence numbers in parallel, the results are written and
+    the cursor saved with `save_sequence`, so an interrupted run redoes at
+    most one round. Returns the final cursor and rejects by reason."""
+
+    if num_workers is None:
+        num_workers = pipeline.NUM_THREADS
+
+    writer = match_writer.BackgroundWriter(session)
+    rejects = collections.Counter()
+
+    try:
+        with futures.ThreadPoolExecutor(
+                max_workers=num_workers) as executor:
+            caught_up = False
+            while not caught_up:
+                summaries, round_rejects, cursor, caught_up = fetch_round(
+                    executor, start, skill, num_workers)
+                writer.add(summaries)
+                rejects.update(round_rejects)
+
+                writer.call(fetch_state.save_sequence, cursor)
+                log.info("Match sequence number %d (%d/round)", cursor,
+                         cursor - start)
+                start = cursor
+    finally:
+        writer.close()
+    for reason, count in rejects.most_common():
+        log.info("{0:30.30} {1}".format(reason, count))
+
+    return start, rejects
@@ -1,19 +1,15 @@
 # -*- coding: utf-8 -*-
-"""Flask server to display analytics results, uses a common instance of
-SQLAlchemy to deal with concurrency.
+"""Flask server to display analytics results, queries go through the
+process wide engine from `db_util.get_engine` so each gunicorn worker shares
+one connection pool.
 """
 import json
-import os
 import plotly
 import plotly.graph_objs as go
-from flask import Flask, render_template
-from flask_sqlalchemy import SQLAlchemy
-from dota_stats import win_rate_pick_rate, fetch_summary
+from flask import Flask, jsonify, render_template
+from dota_stats import db_util, win_rate_pick_rate, fetch_summary
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DOTA_DB_URI']
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
 
 
 def get_health_chart(days, timezone, hour=True):
@@ -94,5 +90,11 @@ def status():
                            rec_plot30=rec_plot30, )
 
 
+@app.route('/pool')
+def pool():
+    """Connection pool metrics of this worker's shared engine"""
+    return jsonify(db_util.pool_stats())
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Sharded (`--processes N`) and worker (`--worker`) fetch modes.
+
+With `--processes`, every (hero, skill) pair is put on one queue served by a
+`ShardManager`, along with a shared `SeenSet` of claimed match IDs, and
+worker processes each run the normal pipeline on items from the queue. In
+worker mode, (hero, skill) items are claimed from the database work queue
+instead (`work_queue.py`), so several machines can share a fetch.
+"""
+import logging
+import os
+import queue
+import collections
+from concurrent import futures
+from multiprocessing.managers import BaseManager
+from dota_stats import meta, http_util, archive, dotautil, steam_api, \
+    fetch_state, pipeline
+from dota_stats.db_util import connect_database
+
+log = logging.getLogger("dota")
+
+
+class ShardManager(BaseManager):
+    """Serves the work queue and the `SeenSet` of claimed match IDs shared
+    by every shard process"""
+
+
+ShardManager.register("SeenSet", dotautil.SeenSet)
+ShardManager.register("Queue", queue.Queue)
+
+
+def fetch_shard(shard, task_queue, shared_ids, full=False, archive_dir=None):
+    """Shard worker process. Takes (hero, skill) items from `task_queue`
+    until it is empty, fetching each through the normal pipeline. Match IDs
+    are claimed in `shared_ids`, so each match is fetched by one shard only.
+    Returns the number of items done, reject cache hits and skipped matches
+    by reason."""
+
+    fetch_state.MATCH_IDS = shared_ids
+    http_util.close_session()    # Don't reuse connections from the parent
+    if archive_dir is not None:
+        steam_api.ARCHIVE = archive.MatchArchive(os.path.join(
+            archive_dir, "shard_{0:02d}".format(shard)))
+
+    _, session = connect_database()
+    fetch_state.REJECTS.load(session)
+    executor = pipeline.create_executor(pipeline.ENGINE)
+
+    items = 0
+    try:
+        while True:
+            try:
+                hero, skill = task_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            log.info("Shard %d: hero %s skill %d", shard,
+                     meta.HERO_DICT[hero], skill)
+            high_water = {} if full else fetch_state.load_high_water(
+                session, skill)
+            pipeline.run_pipeline(
+                session, pipeline.Job([hero], skill, high_water=high_water),
+                executor)
+            items += 1
+    finally:
+        executor.shutdown()
+        if steam_api.ARCHIVE is not None:
+            steam_api.ARCHIVE.close()
+        session.close()
+
+    return items, fetch_state.REJECTS.hits, fetch_state.SKIPPED
+
+
+def collect_shards(tasks):
+    """Wait for the `fetch_shard` tasks, returns reject cache hits and
+    skipped matches by reason, summed over the shards."""
+
+    hits = collections.Counter()
+    skipped = collections.Counter()
+    for shard, task in enumerate(tasks):
+        items, shard_hits, shard_skipped = task.result()
+        log.info("Shard %d finished %d items", shard, items)
+        hits.update(shard_hits)
+        skipped.update(shard_skipped)
+
+    return hits, skipped
+
+
+def run_shards(heroes, skills, processes, full=False, archive_dir=None):
+    """Shard every (hero, skill) pair across `processes` worker processes,
+    taking work from one queue. Matches already in `MATCH_IDS` are copied to
+    the shared set first. Returns reject cache hits and skipped matches by
+    reason, summed over the shards."""
+
+    with ShardManager() as manager:
+        shared_ids = manager.SeenSet(
+            horizon=fetch_state.SEEN_HORIZON*24*60*60)
+        shared_ids.update(fetch_state.MATCH_IDS.ids,
+                          fetch_state.MATCH_IDS.times)
+
+        task_queue = manager.Queue()
+        for skill in skills:
+            for hero in heroes:
+                task_queue.put((hero, skill))
+
+        with futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            return collect_shards([
+                pool.submit(fetch_shard, shard, task_queue, shared_ids, full,
+                            archive_dir)
+                for shard in range(processes)])
+
+
+def run_worker(session, work, full=False):
+    """Worker mode, claims (hero, skill) items from the database `work`
+    queue until none are left, holding a lease on each while it is fetched
+    through the normal pipeline. If the lease is lost to another worker,
+    paging stops and the item is left to its new owner. Returns the number of
+    items done."""
+
+    executor = pipeline.create_executor(pipeline.ENGINE)
+    items = 0
+    try:
+        while True:
+            item = work.claim()
+            if item is None:
+                break
+            log.info("Claimed hero %s skill %d (attempt %d)",
+                     meta.HERO_DICT[item.hero], item.skill, item.attempts)
+
+            done = False
+            try:
+                with work.lease(item) as lease:
+                    high_water = {} if full else fetch_state.load_high_water(
+                        session, item.skill)
+                    pipeline.run_pipeline(
+                        session, pipeline.Job([item.hero], item.skill,
+                                              high_water=high_water,
+                                              stop=lease.lost),
+                        executor)
+                done = True
+            finally:
+                if not done:
+                    work.release(item)
+
+            if lease.lost.is_set():
+                log.error("Stopped hero %d skill %d, its lease was taken by "
+                          "another worker", item.hero, item.skill)
+            elif not work.complete(item):
+                log.error("Lease on hero %d skill %d expired before it "
+                          "completed, it may be fetched again", item.hero,
+                          item.skill)
+            else:
+                items += 1
+    finally:
+        executor.shutdown()
+
+    return items
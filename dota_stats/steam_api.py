@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Steam Web API calls made while fetching.
+
+`fetch_url` (and `fetch_url_async` for the asyncio engine) wraps every
+request in the retry loop, using the shared keep-alive session, API key pool
+and circuit breaker from `http_util`. `fetch_match` fetches the details of a
+single match and `check_match` tags it with its skill level and adds it to
+the raw match archive (`ARCHIVE`), if one is open.
+"""
+import time
+import os
+import ssl
+import json
+import asyncio
+import logging
+import requests
+import aiohttp
+from dota_stats import http_util
+
+API_URL = "https://api.steampowered.com/IDOTA2Match_570/"
+CTX = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+ARCHIVE = None    # Optional archive.MatchArchive of raw match details
+
+log = logging.getLogger("dota")
+
+
+class APIException(Exception):
+    """Used to indicate an error fetching from the Valve API"""
+
+
+def parse_response(status_code, reason, content):
+    """Handle a response from the API, shared by both engines. Returns the
+    `result` section, or None if the request should be retried.
+    """
+
+    # Normal response
+    if status_code == 200:
+        resp_json = json.loads(content)
+        if 'error' in resp_json['result']:
+            raise APIException(resp_json['result']['error'])
+        return resp_json['result']
+
+    # Error handling
+    if status_code == 429:
+        log.error("Too many requests")
+    elif status_code == 503:
+        log.error("Service unavailable")
+    elif status_code == 403:
+        raise APIException("Forbidden - Check Steam API key")
+    else:
+        log.error("Unknown repsonse %d %s", status_code, reason)
+
+    return None
+
+
+def fetch_url(url, policy=None):
+    """Retry loop around fetching to deal with things like network outages,
+    etc... Uses the shared keep-alive session and key pool from `http_util`,
+    `url` is given without the API key. A forbidden key is taken out of
+    rotation and the request retried on another, it is an `APIException`
+    at once when no keys are left. Retries follow `policy`
+    (`http_util.RETRY` by default), and `http_util.CircuitOpen` is raised
+    without a request while the shared circuit breaker is open."""
+
+    if policy is None:
+        policy = http_util.RETRY
+
+    session = http_util.get_session()
+    keys = http_util.get_keys()
+    delay = 0.0
+    for _ in range(policy.attempts):
+        time.sleep(delay)
+        status_code = None
+        retry_after = None
+        try:
+            key = keys.acquire()
+        except http_util.KeysForbidden:
+            raise APIException("Forbidden - Check Steam API key") from None
+        try:
+            http_util.BREAKER.check()
+        except http_util.CircuitOpen:
+            keys.release(key, None)
+            raise
+        try:
+            resp = session.get(http_util.add_key(url, key), timeout=60)
+            status_code = resp.status_code
+            retry_after = resp.headers.get('Retry-After')
+        except requests.exceptions.ConnectionError as conn_error:
+            log.error("Connection error: %r", conn_error)
+        except requests.exceptions.ReadTimeout as timeout_error:
+            log.error("Timeout error: %r", timeout_error)
+        finally:
+            keys.release(key, status_code)
+            http_util.BREAKER.record(status_code)
+
+        delay = http_util.next_delay(policy, delay, retry_after)
+        if status_code is None:
+            continue
+        if status_code == 403 and keys.usable():
+            log.error("Forbidden - Steam API key %s", key.name)
+            delay = 0.0
+            continue
+
+        result = parse_response(resp.status_code, resp.reason, resp.content)
+        if result is not None:
+            return result
+
+    raise ValueError("Could not fetch (timeout?): {}".format(url))
+
+
+async def fetch_url_async(client, url, policy=None):
+    """Asyncio version of `fetch_url`, same retry loop and error handling.
+    `client` is a shared `aiohttp.ClientSession`."""
+
+    if policy is None:
+        policy = http_util.RETRY
+
+    keys = http_util.get_keys()
+    delay = 0.0
+    for _ in range(policy.attempts):
+        await asyncio.sleep(delay)
+        status_code = None
+        retry_after = None
+        try:
+            key = await keys.acquire_async()
+        except http_util.KeysForbidden:
+            raise APIException("Forbidden - Check Steam API key") from None
+        try:
+            http_util.BREAKER.check()
+        except http_util.CircuitOpen:
+            keys.release(key, None)
+            raise
+        try:
+            async with client.get(http_util.add_key(url, key),
+                                  headers=http_util.HEADERS) as resp:
+                status_code = resp.status
+                retry_after = resp.headers.get('Retry-After')
+                content = await resp.read()
+        except aiohttp.ClientConnectionError as conn_error:
+            log.error("Connection error: %r", conn_error)
+        except asyncio.TimeoutError as timeout_error:
+            log.error("Timeout error: %r", timeout_error)
+        finally:
+            keys.release(key, status_code)
+            http_util.BREAKER.record(status_code)
+
+        delay = http_util.next_delay(policy, delay, retry_after)
+        if status_code is None:
+            continue
+        if status_code == 403 and keys.usable():
+            log.error("Forbidden - Steam API key %s", key.name)
+            delay = 0.0
+            continue
+
+        result = parse_response(resp.status, resp.reason, content)
+        if result is not None:
+            return result
+
+    raise ValueError("Could not fetch (timeout?): {}".format(url))
+
+
+def fetch_match(match_id, skill):
+    """Skill is optional, this simply sets an object in the json
+    for reference"""
+
+    url = API_URL + "GetMatchDetails/V001/?match_id={0}"
+
+    match = {}
+    for _ in range(10):
+        match = fetch_url(url.format(match_id))
+        if 'start_time' in match.keys():
+            break
+
+        log.error("Match ID not found: %s", str(match_id))
+        time.sleep(1)
+
+    return check_match(match, match_id, skill)
+
+
+async def fetch_match_async(client, match_id, skill):
+    """Asyncio version of `fetch_match`"""
+
+    url = API_URL + "GetMatchDetails/V001/?match_id={0}"
+
+    match = {}
+    for _ in range(10):
+        match = await fetch_url_async(
+            client, url.format(match_id))
+        if 'start_time' in match.keys():
+            break
+
+        log.error("Match ID not found: %s", str(match_id))
+        await asyncio.sleep(1)
+
+    return check_match(match, match_id, skill)
+
+
+def check_match(match, match_id, skill):
+    """Tag the match with skill level and add it to the raw match archive,
+    if enabled. If something went wrong, log to file and raise so no match
+    is returned."""
+
+    match['api_skill'] = skill
+
+    if 'start_time' not in match.keys():
+        if not os.path.exists('error'):
+            os.makedirs('error')
+        with open("./error/{}.json".format(match_id), "w") as file_handle:
+            file_handle.write(json.dumps(match))
+        raise APIException("Bad match JSON {}".format(match_id))
+
+    # Copy, since parsing modifies the match while it waits to be archived
+    if ARCHIVE is not None:
+        ARCHIVE.put(dict(match))
+
+    return match
@@ -0,0 +1,877 @@
+# -*- coding: utf-8 -*-
+"""Unit testing for the fetch pipeline against a local stub of the Steam API,
+also run as part of `run_test.py`"""
+import unittest
+import logging
+import os
+import json
+import time
+import threading
+import gzip
+import tempfile
+from concurrent import futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from dota_stats import db_util, http_util, work_queue, steam_api, \
+    fetch_state, pipeline, sequence, shards
+
+
+class StubSteamHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the Steam API, returns `write_match.json` for every
+    GetMatchDetails request with the requested match ID. Keeps connections
+    alive and compresses the response when asked to."""
+
+    SEQUENCE_HEAD = 250    # Sequence numbers of the available matches
+    details = []           # Match IDs of every GetMatchDetails request
+    history = []           # Hero IDs of every GetMatchHistory request
+    keys = []              # API key of every request
+    slow = set()           # Match IDs answered after a delay
+    hidden = set()         # Match IDs left out of match history (unfinished)
+    broken = set()         # Match IDs whose details have an unknown hero
+    down = set()           # Match IDs answered with a 503
+    hiccups = 0            # Sequence pages to answer empty before the rest
+
+    protocol_version = "HTTP/1.1"
+    encodings = []
+
+    with open("./testing/write_match.json") as filename:
+        MATCH = json.loads(filename.read())
+
+    @classmethod
+    def reset(cls):
+        """Forget the requests seen and answer every match normally"""
+        for requests in [cls.details, cls.history, cls.keys, cls.encodings]:
+            requests.clear()
+        for match_ids in [cls.slow, cls.hidden, cls.broken, cls.down]:
+            match_ids.clear()
+        cls.hiccups = 0
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve a single match, or a page of match history. Keys starting
+        with "bad" are forbidden, with "down" the service is unavailable."""
+        query = parse_qs(urlparse(self.path).query)
+        self.keys.append(query['key'][0])
+        if query['key'][0].startswith("bad"):
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if query['key'][0].startswith("down") or \
+                int(query.get('match_id', [0])[0]) in self.down:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if "GetMatchHistoryBySequenceNum" in self.path:
+            result = self.match_sequence(
+                int(query['start_at_match_seq_num'][0]),
+                int(query['matches_requested'][0]))
+        elif "GetMatchHistory" in self.path:
+            self.history.append(int(query['hero_id'][0]))
+            result = self.match_history(int(query['hero_id'][0]),
+                                        int(query['start_at_match_id'][0]))
+        else:
+            result = dict(self.MATCH)
+            result['match_id'] = int(query['match_id'][0])
+            self.details.append(result['match_id'])
+            if result['match_id'] in self.broken:
+                result['players'] = [dict(t) for t in result['players']]
+                result['players'][0]['hero_id'] = 999
+            if result['match_id'] in self.slow:
+                time.sleep(2)
+
+        body = json.dumps({'result': result}).encode()
+        encoding = self.headers.get("Accept-Encoding", "")
+        self.encodings.append(encoding)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in encoding:
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def start_time(match_id):
+        """Matches start a minute apart"""
+        return 1607867126 + 60*match_id
+
+    @classmethod
+    def match_history(cls, hero, start_at_match_id):
+        """Pages of 10 matches, hero N played matches 10*N to 10*N+24 so
+        neighbouring heroes share matches."""
+        match_ids = [t for t in range(10*hero+24, 10*hero-1, -1)
+                     if t <= start_at_match_id and t not in cls.hidden]
+        return {
+            'num_results': min(10, len(match_ids)),
+            'results_remaining': max(0, len(match_ids) - 10),
+            'matches': [{'match_id': t, 'start_time': cls.start_time(t),
+                         'lobby_type': 7,
+                         'players': [{'player_slot': u, 'hero_id': u+1}
+                                     for u in range(10)]}
+                        for t in match_ids[0:10]],
+        }
+
+    @classmethod
+    def match_sequence(cls, start, num):
+        """Full match details by sequence number, match IDs are 100000
+        above the sequence number."""
+        if cls.hiccups > 0:
+            cls.hiccups -= 1
+            return {'status': 1, 'matches': []}
+
+        matches = []
+        for seq_num in range(start, min(start+num, cls.SEQUENCE_HEAD)):
+            matches.append(dict(cls.MATCH, match_id=100000+seq_num,
+                                match_seq_num=seq_num))
+        return {'status': 1, 'matches': matches}
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep test output quiet"""
+
+
+class TestStubServer(unittest.TestCase):
+    """Parent class for tests which run against a local stub of the Steam
+    API, so fetch throughput can be compared offline."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSteamHandler,
+                                         bind_and_activate=False)
+        # The asyncio engine opens many connections at once, don't let the
+        # listen backlog delay them
+        cls.server.request_queue_size = 256
+        cls.server.server_bind()
+        cls.server.server_activate()
+        cls.thread = threading.Thread(target=cls.server.serve_forever,
+                                      daemon=True)
+        cls.thread.start()
+
+        cls.old_url = steam_api.API_URL
+        steam_api.API_URL = "http://127.0.0.1:{}/IDOTA2Match_570/".format(
+            cls.server.server_address[1])
+
+        cls.old_keys = http_util.KEYS
+
+    @classmethod
+    def tearDownClass(cls):
+        steam_api.API_URL = cls.old_url
+        http_util.KEYS = cls.old_keys
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+        StubSteamHandler.reset()
+        self.old_key = os.environ['STEAM_KEY']
+        self.use_keys(self.old_key)
+
+    def tearDown(self):
+        super().tearDown()
+        os.environ['STEAM_KEY'] = self.old_key
+
+    @staticmethod
+    def use_keys(keys):
+        """Fetch with `keys`, don't let the rate limiter hide the engine
+        throughput"""
+        os.environ['STEAM_KEY'] = keys
+        http_util.KEYS = http_util.KeyPool(keys, rate=10000, max_rate=10000)
+
+
+class TestFetchEngines(TestStubServer):
+    """Compare the thread pool and asyncio match detail engines"""
+
+    def test_engines(self):
+        """Both engines return the same summaries, print matches/min"""
+
+        match_ids = list(range(1000, 1032))
+        results = {}
+
+        for engine in ["thread", "async"]:
+            executor = pipeline.create_executor(engine)
+            start = time.time()
+            results[engine] = pipeline.fetch_and_parse(1, 1, match_ids,
+                                                       executor)
+            elapsed = time.time() - start
+            executor.shutdown()
+            print("{0:8} {1:10.1f} matches/min".format(
+                engine, 60 * len(match_ids) / elapsed))
+
+        self.assertEqual(len(results['thread']), len(match_ids))
+        self.assertEqual(sorted(m['match_id'] for m in results['async']),
+                         match_ids)
+        self.assertEqual(results['thread'], results['async'])
+
+
+class TestSQLite(unittest.TestCase):
+    """Parent class for tests using an in-memory SQLite database as a local
+    stand-in for MariaDB. The one connection is shared between threads, so
+    the database writer thread sees the same database."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = create_engine(
+            "sqlite://", poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+        db_util.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        super().tearDown()
+        self.session.close()
+
+
+class PipelineTestCase(TestSQLite, TestStubServer):
+    """Parent class for tests running the fetch pipeline against the stub
+    server"""
+
+    def setUp(self):
+        super().setUp()
+        fetch_state.MATCH_IDS.clear()
+
+    def tearDown(self):
+        super().tearDown()
+        fetch_state.MATCH_IDS.clear()
+
+    def run_pipeline(self, heroes, start_at_match_id=None,
+                     checkpoint=False, high_water=None, engine="thread"):
+        """Fetch `heroes` from the stub server, returns match IDs written"""
+
+        executor = pipeline.create_executor(engine)
+        pipeline.run_pipeline(
+            self.session,
+            pipeline.Job(heroes, 1, start_at_match_id, high_water),
+            executor, checkpoint)
+        executor.shutdown()
+
+        return sorted(t.match_id for t in
+                      self.session.query(db_util.Match).all())
+
+
+class TestPipeline(PipelineTestCase):
+    """History paging runs ahead of match details across heroes"""
+
+    def test_pipeline(self):
+        """Every match is fetched and written once, across heroes"""
+
+        self.assertEqual(self.run_pipeline([1, 2, 3]), list(range(10, 55)))
+
+    def test_task_timeout(self):
+        """A slow match is skipped without holding up the rest, and its
+        hero's high water mark is not saved"""
+        self.check_task_timeout("thread")
+
+    def test_task_timeout_async(self):
+        """Same on the asyncio engine, whose futures never report running"""
+        self.check_task_timeout("async")
+
+    def check_task_timeout(self, engine):
+        """Run heroes 1 and 3 on `engine` with match 12 slow"""
+
+        old_timeout = pipeline.TASK_TIMEOUT
+        pipeline.TASK_TIMEOUT = 0.5
+        StubSteamHandler.slow.add(12)
+        try:
+            match_ids = self.run_pipeline([1, 3], engine=engine)
+        finally:
+            pipeline.TASK_TIMEOUT = old_timeout
+
+        self.assertEqual(match_ids, [t for t in range(10, 55) if t != 12])
+        self.assertEqual(fetch_state.load_high_water(self.session, 1),
+                         {3: StubSteamHandler.start_time(54)})
+
+    def test_stop(self):
+        """Nothing is paged once the job's stop event is set"""
+
+        stop = threading.Event()
+        stop.set()
+        executor = pipeline.create_executor("thread")
+        pipeline.run_pipeline(self.session,
+                              pipeline.Job([1, 2], 1, stop=stop), executor)
+        executor.shutdown()
+        self.assertEqual(StubSteamHandler.history, [])
+
+    def test_consumer_failure(self):
+        """Paging stops once the consumer fails, rather than requesting the
+        history of every remaining hero"""
+
+        executor = pipeline.create_executor("thread")
+        executor.shutdown()    # Every submit raises
+        with self.assertRaises(RuntimeError):
+            pipeline.run_pipeline(self.session,
+                                  pipeline.Job([1, 2, 3, 4, 5, 6], 1),
+                                  executor)
+
+        # At most the pages queued ahead, of 18
+        self.assertLessEqual(len(StubSteamHandler.history),
+                             pipeline.PAGE_QUEUE_SIZE + 2)
+        self.assertNotIn(6, StubSteamHandler.history)
+
+
+class TestCheckpoint(PipelineTestCase):
+    """Interrupted runs resume from the last written page"""
+
+    def test_resume_completed_hero(self):
+        """Heroes completed before the interruption are skipped"""
+
+        self.run_pipeline([1, 2], checkpoint=True)
+        checkpoint = fetch_state.load_checkpoint(self.session, 1)
+        self.assertEqual((checkpoint.hero, checkpoint.start_at_match_id),
+                         (2, None))
+        self.assertEqual(fetch_state.resume_heroes([1, 2, 3], checkpoint),
+                         ([3], None))
+
+        fetch_state.clear_checkpoint(self.session, 1)
+        self.assertIsNone(fetch_state.load_checkpoint(self.session, 1))
+
+    def test_resume_mid_hero(self):
+        """Paging restarts from the saved `start_at_match_id`"""
+
+        fetch_state.save_checkpoint(self.session, 1, 2, 25)
+        heroes, start_at_match_id = fetch_state.resume_heroes(
+            [1, 2, 3], fetch_state.load_checkpoint(self.session, 1))
+        self.assertEqual((heroes, start_at_match_id), ([2, 3], 25))
+
+        match_ids = self.run_pipeline(heroes, start_at_match_id)
+        self.assertEqual(match_ids, list(range(20, 26)) + list(range(30, 55)))
+
+    def test_stale_checkpoint(self):
+        """Old checkpoints are ignored"""
+
+        fetch_state.save_checkpoint(self.session, 1, 2, 25)
+        checkpoint = self.session.query(db_util.FetchCheckpoint).get(1)
+        checkpoint.updated -= int(fetch_state.CHECKPOINT_HOURS*3600) + 1
+        self.session.commit()
+        self.assertIsNone(fetch_state.load_checkpoint(self.session, 1))
+        self.assertEqual(fetch_state.resume_heroes([1, 2, 3], None),
+                         ([1, 2, 3], None))
+
+    def test_circuit_open(self):
+        """The run stops when the breaker opens, leaving a checkpoint and
+        marks the next run can resume from"""
+
+        old_breaker = http_util.BREAKER
+        http_util.BREAKER = http_util.CircuitBreaker(threshold=1, reset=60)
+        StubSteamHandler.down.add(20)
+        try:
+            with self.assertRaises(http_util.CircuitOpen):
+                self.run_pipeline([1, 2], checkpoint=True)
+        finally:
+            http_util.BREAKER = old_breaker
+
+        # Hero 1 stopped at most after its first page (34 to 25)
+        checkpoint = fetch_state.load_checkpoint(self.session, 1)
+        if checkpoint is not None:
+            self.assertEqual((checkpoint.hero, checkpoint.start_at_match_id),
+                             (1, 24))
+        self.assertEqual(fetch_state.load_high_water(self.session, 1), {})
+
+        StubSteamHandler.down.clear()
+        fetch_state.MATCH_IDS.clear()
+        heroes, start_at_match_id = fetch_state.resume_heroes([1, 2],
+                                                              checkpoint)
+        self.assertEqual(self.run_pipeline(heroes, start_at_match_id, True),
+                         list(range(10, 45)))
+
+
+class TestHighWater(PipelineTestCase):
+    """Paging stops at matches fetched by previous runs"""
+
+    def setUp(self):
+        super().setUp()
+        self.old_duration = pipeline.MAX_MATCH_DURATION
+        pipeline.MAX_MATCH_DURATION = 0
+
+    def tearDown(self):
+        pipeline.MAX_MATCH_DURATION = self.old_duration
+        super().tearDown()
+
+    def test_high_water(self):
+        """Marks are saved for completed heroes and stop later paging"""
+
+        start_time = StubSteamHandler.start_time
+        self.assertEqual(self.run_pipeline([1]), list(range(10, 35)))
+        self.assertEqual(fetch_state.load_high_water(self.session, 1),
+                         {1: start_time(34)})
+
+        # Hero 2 (matches 20 to 44) stops after the first page reaches 36
+        fetch_state.save_high_water(self.session, 1, 2, 36, start_time(36))
+        match_ids = self.run_pipeline(
+            [2], high_water=fetch_state.load_high_water(self.session, 1))
+        self.assertEqual(match_ids, list(range(10, 45)))
+        self.assertEqual(fetch_state.load_high_water(self.session, 1),
+                         {1: start_time(34), 2: start_time(44)})
+
+        # Never moves backwards
+        fetch_state.save_high_water(self.session, 1, 2, 40, start_time(40))
+        self.assertEqual(fetch_state.load_high_water(self.session, 1)[2],
+                         start_time(44))
+
+    def test_page_count(self):
+        """Only the pages above the high water mark are requested"""
+
+        pages = list(pipeline.fetch_matches(
+            3, 1, high_water=StubSteamHandler.start_time(45)))
+        self.assertEqual([t.match_ids for t in pages],
+                         [list(range(54, 44, -1))])
+        self.assertEqual(pages[-1].high_water,
+                         (54, StubSteamHandler.start_time(54)))
+
+    def test_failed_match(self):
+        """No mark is saved for a hero with a match that failed to parse"""
+
+        StubSteamHandler.broken.add(30)
+        match_ids = self.run_pipeline([1])
+        self.assertEqual(match_ids, [t for t in range(10, 35) if t != 30])
+        self.assertEqual(fetch_state.load_high_water(self.session, 1), {})
+
+    def test_late_match(self):
+        """A long game finishing after the mark was saved is still fetched
+        when it started within a maximum match duration of the mark"""
+
+        # Match 22 is still in progress on the first run
+        StubSteamHandler.hidden.add(22)
+        self.assertNotIn(22, self.run_pipeline([1]))
+        StubSteamHandler.hidden.clear()
+
+        # Without a margin paging stops on the first page (34 to 25)
+        high_water = fetch_state.load_high_water(self.session, 1)[1]
+        self.assertEqual(len(list(pipeline.fetch_matches(
+            1, 1, high_water=high_water))), 1)
+
+        # Ten minutes covers the game, paging continues to the second page
+        pipeline.MAX_MATCH_DURATION = 600
+        match_ids = self.run_pipeline([1], high_water={1: high_water})
+        self.assertIn(22, match_ids)
+        self.assertEqual(fetch_state.load_high_water(self.session, 1),
+                         {1: StubSteamHandler.start_time(34)})
+
+
+class TestRejectCache(PipelineTestCase):
+    """Rejected matches are remembered and not fetched again"""
+
+    def setUp(self):
+        super().setUp()
+        self.old_rejects = fetch_state.REJECTS
+        fetch_state.REJECTS = fetch_state.RejectCache()
+
+    def tearDown(self):
+        super().tearDown()
+        fetch_state.REJECTS = self.old_rejects
+
+    def test_reject_cache(self):
+        """Rejects are saved, expired and loaded"""
+
+        with open("./testing/bots.json") as filename:
+            match = json.loads(filename.read())
+        self.assertIsNone(pipeline.summarize_match(match, "bots"))
+
+        now = int(time.time())
+        fetch_state.REJECTS.add(1, "Leaver", now)
+        fetch_state.REJECTS.add(2, "Missing hero", now)
+        fetch_state.REJECTS.add(3, "Min Length", now - 30*24*3600)
+        fetch_state.REJECTS.save(self.session)
+        self.assertEqual(self.session.query(db_util.RejectedMatch).count(), 3)
+
+        cache = fetch_state.RejectCache()
+        self.assertEqual(cache.load(self.session, days=90000), 3)
+        self.assertTrue(cache.check(match['match_id']))
+        self.assertTrue(cache.check(1))
+        self.assertFalse(cache.check(2))
+        self.assertEqual(cache.hits, {"Feeding": 1, "Leaver": 1})
+
+        # Expired rejects are deleted
+        self.assertEqual(
+            fetch_state.RejectCache().load(self.session, days=7), 1)
+        self.assertEqual(self.session.query(db_util.RejectedMatch).count(), 1)
+
+    def test_skip_rejects(self):
+        """Previously rejected matches are skipped when paging"""
+
+        for match_id in range(10, 15):
+            fetch_state.REJECTS.add(match_id, "Lobby Type", int(time.time()))
+
+        self.assertEqual(self.run_pipeline([1]), list(range(15, 35)))
+        self.assertEqual(fetch_state.REJECTS.hits, {"Lobby Type": 5})
+        self.assertEqual(self.session.query(db_util.RejectedMatch).count(), 5)
+
+
+class TestSequence(PipelineTestCase):
+    """Fetch all matches by sequence number with parallel range workers"""
+
+    def setUp(self):
+        super().setUp()
+        self.old_sizes = sequence.SEQ_RANGE, sequence.SEQ_PAGE_SIZE, \
+            sequence.SEQ_RETRY_WAIT
+        sequence.SEQ_RANGE, sequence.SEQ_PAGE_SIZE = 50, 20
+        sequence.SEQ_RETRY_WAIT = 0
+
+    def tearDown(self):
+        super().tearDown()
+        sequence.SEQ_RANGE, sequence.SEQ_PAGE_SIZE, \
+            sequence.SEQ_RETRY_WAIT = self.old_sizes
+
+    def test_fetch_sequence(self):
+        """Ranges stop at the end of the range or the latest match"""
+
+        summaries, _, seq_num, complete = sequence.fetch_sequence(10, 60)
+        self.assertEqual([t['match_id'] for t in summaries],
+                         list(range(100010, 100060)))
+        self.assertEqual((seq_num, complete), (60, True))
+
+        summaries, _, seq_num, complete = sequence.fetch_sequence(240, 290)
+        self.assertEqual(len(summaries), 10)
+        self.assertEqual((seq_num, complete), (250, False))
+
+    def test_empty_page(self):
+        """An empty page from an API hiccup is retried, not taken as the
+        head of the sequence"""
+
+        StubSteamHandler.hiccups = sequence.SEQ_RETRIES - 1
+        summaries, _, seq_num, complete = sequence.fetch_sequence(10, 60)
+        self.assertEqual(len(summaries), 50)
+        self.assertEqual((seq_num, complete), (60, True))
+
+        # Still empty after every try, stop where it was
+        StubSteamHandler.hiccups = sequence.SEQ_RETRIES
+        summaries, _, seq_num, complete = sequence.fetch_sequence(10, 60)
+        self.assertEqual((summaries, seq_num, complete), ([], 10, False))
+
+    def test_fetch_sequence_ranges(self):
+        """Cursor is saved and resumed, every match written once"""
+
+        self.assertIsNone(fetch_state.load_sequence(self.session))
+        cursor, _ = sequence.fetch_sequence_ranges(self.session, 10,
+                                                   num_workers=3)
+        self.assertEqual(cursor, 250)
+        self.assertEqual(fetch_state.load_sequence(self.session), 250)
+
+        match_ids = sorted(t.match_id for t in
+                           self.session.query(db_util.Match).all())
+        self.assertEqual(match_ids, list(range(100010, 100250)))
+        self.assertEqual(
+            {t.api_skill for t in self.session.query(db_util.Match)}, {0})
+
+        # Nothing new at the head
+        cursor, _ = sequence.fetch_sequence_ranges(self.session, 250)
+        self.assertEqual(cursor, 250)
+
+
+class TestShards(PipelineTestCase):
+    """Hero and skill pairs sharded across processes"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_uri = db_util.DB_URI
+        db_util.DB_URI = "sqlite:///{}".format(
+            os.path.join(self.tmp_dir.name, "dota.db"))
+        engine = create_engine(db_util.DB_URI)
+        db_util.Base.metadata.create_all(engine)
+        engine.dispose()
+
+    def tearDown(self):
+        super().tearDown()
+        db_util.DB_URI = self.old_uri
+        self.tmp_dir.cleanup()
+
+    def test_shards(self):
+        """Each match is fetched once across all shards"""
+
+        shards.run_shards([1, 2, 3], [1, 2], 2)
+
+        engine = create_engine(db_util.DB_URI)
+        with engine.connect() as conn:
+            match_ids = sorted(t.match_id for t in conn.execute(
+                "select match_id from dota_matches"))
+            high_water = sorted(tuple(t) for t in conn.execute(
+                "select hero, skill, match_id from dota_fetch_high_water"))
+        engine.dispose()
+
+        self.assertEqual(match_ids, list(range(10, 55)))
+        self.assertEqual(sorted(StubSteamHandler.details), match_ids)
+        self.assertEqual(high_water, [(1, 1, 34), (1, 2, 34), (2, 1, 44),
+                                      (2, 2, 44), (3, 1, 54), (3, 2, 54)])
+
+
+class TestWorkQueue(PipelineTestCase):
+    """Lease based work queue shared by workers on several nodes"""
+
+    def setUp(self):
+        super().setUp()
+
+        # Heartbeats run on their own connection, so use a file
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite:///{}".format(
+            os.path.join(self.tmp_dir.name, "dota.db")))
+        db_util.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        super().tearDown()
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_leases(self):
+        """Items are leased to one worker, expired leases are reclaimed"""
+
+        node1 = work_queue.WorkQueue(self.engine, "node1", lease_seconds=60)
+        node2 = work_queue.WorkQueue(self.engine, "node2", lease_seconds=60)
+        self.assertEqual(node1.enqueue([1, 2], [1], 1000), 2)
+        self.assertEqual(node2.enqueue([1, 2, 3], [1], 1000), 1)
+
+        item1 = node1.claim()
+        item2 = node2.claim()
+        self.assertEqual((item1.hero, item1.owner), (1, "node1"))
+        self.assertEqual((item2.hero, item2.owner), (2, "node2"))
+        self.assertTrue(node1.heartbeat(item1))
+        self.assertFalse(node2.heartbeat(item1))
+
+        # Expire node1's lease, node2 takes it over
+        with self.engine.connect() as conn:
+            conn.execute("update dota_fetch_queue set lease_expires=0 "
+                         "where hero=1")
+        item3 = node2.claim()
+        self.assertEqual((item3.hero, item3.owner, item3.attempts),
+                         (1, "node2", 2))
+        self.assertFalse(node1.complete(item1))
+        self.assertTrue(node2.complete(item3))
+        self.assertTrue(node2.release(item2))
+
+        self.assertEqual(node1.stats(), {'done': 1, 'pending': 2})
+
+    def test_heartbeat(self):
+        """Heartbeats keep the lease alive past its expiry"""
+
+        node1 = work_queue.WorkQueue(self.engine, "node1", lease_seconds=1)
+        node2 = work_queue.WorkQueue(self.engine, "node2", lease_seconds=1)
+        node1.enqueue([1], [1], 1000)
+
+        item = node1.claim()
+        with node1.lease(item) as heartbeat:
+            time.sleep(2)
+            self.assertIsNone(node2.claim())
+        self.assertFalse(heartbeat.lost.is_set())
+        self.assertTrue(node1.complete(item))
+
+    def test_worker(self):
+        """Worker mode fetches every queued item"""
+
+        work = work_queue.WorkQueue(self.engine, "node1")
+        work.enqueue([1, 2, 3], [1], 1000)
+        self.assertEqual(shards.run_worker(self.session, work), 3)
+        self.assertEqual(work.stats(), {'done': 3})
+
+        match_ids = sorted(t.match_id for t in
+                           self.session.query(db_util.Match).all())
+        self.assertEqual(match_ids, list(range(10, 55)))
+
+    def test_lost_lease(self):
+        """A worker whose lease is taken over stops and leaves the item to
+        the new owner"""
+
+        class TakenOver(work_queue.WorkQueue):
+            """Another worker takes the lease at the first heartbeat"""
+            def heartbeat(self, item):
+                with self.engine.connect() as conn:
+                    conn.execute("update dota_fetch_queue set owner='node2', "
+                                 "lease_expires={0}".format(
+                                     int(time.time()) + 60))
+                return False
+
+        work = TakenOver(self.engine, "node1", lease_seconds=0.3)
+        work.enqueue([1], [1], 1000)
+        StubSteamHandler.slow.add(12)
+        self.assertEqual(shards.run_worker(self.session, work), 0)
+        self.assertEqual(work.stats(), {'leased': 1})
+
+
+class TestHTTPSession(TestStubServer):
+    """Connection pooling and compression in the shared HTTP session"""
+
+    def test_connection_reuse(self):
+        """Requests share a small number of compressed, kept-alive
+        connections"""
+
+        http_util.close_session()
+        match_ids = list(range(2000, 2024))
+
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            matches = list(executor.map(lambda t: steam_api.fetch_match(t, 1),
+                                        match_ids))
+        self.assertEqual([m['match_id'] for m in matches], match_ids)
+
+        stats = http_util.connection_stats()
+        self.assertEqual(stats['requests'], len(match_ids))
+        self.assertLessEqual(stats['handshakes'], 4)
+        self.assertEqual(stats['reused'],
+                         len(match_ids) - stats['handshakes'])
+        self.assertTrue(all("gzip" in t for t in StubSteamHandler.encodings))
+        http_util.close_session()
+
+
+class TestKeyPool(TestStubServer):
+    """Rotation and health tracking of several API keys"""
+
+    def test_least_loaded(self):
+        """Requests in flight are spread over the keys"""
+
+        pool = http_util.KeyPool("key1,key2,key3", rate=100, concurrency=2)
+        keys = [pool.acquire() for _ in range(6)]
+        self.assertEqual(sorted(t.key for t in keys),
+                         ["key1", "key1", "key2", "key2", "key3", "key3"])
+
+        for key in keys:
+            pool.release(key, 200)
+        stats = pool.stats()
+        self.assertEqual([t['key'] for t in stats],
+                         ["...key1", "...key2", "...key3"])
+        self.assertEqual([t['requests'] for t in stats], [2, 2, 2])
+        self.assertEqual([t['in_flight'] for t in stats], [0, 0, 0])
+
+    def test_throttled_cooldown(self):
+        """Repeated 429s take a key out of rotation, success resets"""
+
+        pool = http_util.KeyPool("key1,key2", rate=100)
+        key1 = pool.keys[0]
+
+        for status_code in [429, 429, 200, 429, 429]:
+            key1.limiter.in_flight += 1
+            pool.release(key1, status_code)
+        self.assertEqual(len(pool.usable()), 2)
+
+        key1.limiter.in_flight += 1
+        pool.release(key1, 429)
+        self.assertEqual(pool.usable(), [pool.keys[1]])
+        self.assertGreater(pool.stats()[0]['cooldown'], 0)
+
+        for _ in range(5):
+            key = pool.acquire()
+            self.assertEqual(key.key, "key2")
+            pool.release(key, 200)
+
+    def test_forbidden(self):
+        """A forbidden key is retried on another, and no longer used"""
+
+        self.use_keys("bad1,good1")
+        for match_id in range(5):
+            match = steam_api.fetch_match(match_id, 1)
+            self.assertEqual(match['match_id'], match_id)
+
+        self.assertLessEqual(StubSteamHandler.keys.count("bad1"), 1)
+        self.assertEqual(StubSteamHandler.keys.count("good1"), 5)
+        self.assertEqual(http_util.KEYS.stats()[0]['forbidden'],
+                         StubSteamHandler.keys.count("bad1"))
+
+        # Only forbidden keys left
+        os.environ['STEAM_KEY'] = "bad1,bad2"
+        with self.assertRaises(steam_api.APIException):
+            steam_api.fetch_match(1, 1)
+
+    def test_single_forbidden(self):
+        """Once the only key is forbidden, later requests fail at once
+        rather than waiting out its cooldown"""
+
+        self.use_keys("bad1")
+        start = time.time()
+        for engine in ["thread", "async"]:
+            executor = pipeline.create_executor(engine)
+            try:
+                for match_id in range(2):
+                    future = pipeline.submit_match(executor, 1, 1, match_id)
+                    self.assertIs(future.result(timeout=10), pipeline.FAILED)
+            finally:
+                executor.shutdown()
+
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(StubSteamHandler.keys.count("bad1"), 1)
+        with self.assertRaises(http_util.KeysForbidden):
+            http_util.KEYS.acquire()
+
+
+class TestRetryPolicy(TestStubServer):
+    """Retry delays and the shared circuit breaker"""
+
+    def setUp(self):
+        super().setUp()
+        self.old_breaker = http_util.BREAKER
+        http_util.BREAKER = http_util.CircuitBreaker(threshold=3, reset=0.2)
+
+    def tearDown(self):
+        super().tearDown()
+        http_util.BREAKER = self.old_breaker
+
+    def test_delays(self):
+        """Decorrelated jitter between base and cap, Retry-After is waited
+        out"""
+
+        policy = http_util.RetryPolicy(base=1, cap=10, max_retry_after=60)
+        delay = 0.0
+        for _ in range(100):
+            previous, delay = delay, http_util.next_delay(policy, delay)
+            self.assertGreaterEqual(delay, 1)
+            self.assertLessEqual(delay, min(10, max(1, 3*previous)))
+
+        self.assertEqual(http_util.next_delay(policy, 0, "30"), 30)
+        self.assertEqual(http_util.next_delay(policy, 0, "3600"), 60)
+        self.assertLessEqual(http_util.next_delay(policy, 0, "soon"), 1)
+        self.assertEqual(http_util.retry_after_seconds(
+            "Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+
+    def test_breaker(self):
+        """Failures open the breaker, which fails fast until a trial
+        request succeeds"""
+
+        policy = http_util.RetryPolicy(attempts=10, base=0.001, cap=0.01)
+        os.environ['STEAM_KEY'] = "down1"
+        with self.assertRaises(http_util.CircuitOpen):
+            steam_api.fetch_url(steam_api.API_URL + "GetMatchDetails/V001/"
+                                "?match_id=1", policy)
+        self.assertEqual(len(StubSteamHandler.keys), 3)
+
+        # Fails without a request
+        os.environ['STEAM_KEY'] = "good1"
+        with self.assertRaises(http_util.CircuitOpen):
+            steam_api.fetch_url(steam_api.API_URL + "GetMatchDetails/V001/"
+                                "?match_id=1", policy)
+        self.assertEqual(len(StubSteamHandler.keys), 3)
+        self.assertTrue(http_util.BREAKER.stats()['open'])
+
+        time.sleep(0.25)
+        match = steam_api.fetch_url(steam_api.API_URL + "GetMatchDetails/V001/"
+                                    "?match_id=1", policy)
+        self.assertEqual(match['match_id'], 1)
+        self.assertEqual(http_util.BREAKER.stats(),
+                         {'open': False, 'failures': 0, 'opened': 1})
+
+    def test_breaker_forbidden(self):
+        """A trial request finding every key forbidden doesn't keep the
+        breaker open"""
+
+        url = steam_api.API_URL + "GetMatchDetails/V001/?match_id=1"
+        policy = http_util.RetryPolicy(attempts=10, base=0.001, cap=0.01)
+        self.use_keys("down1")
+        with self.assertRaises(http_util.CircuitOpen):
+            steam_api.fetch_url(url, policy)
+
+        time.sleep(0.25)
+        self.use_keys("bad1")
+        http_util.KEYS.release(http_util.KEYS.acquire(), 403)
+        with self.assertRaises(steam_api.APIException):
+            steam_api.fetch_url(url, policy)
+
+        self.use_keys("good1")
+        self.assertEqual(steam_api.fetch_url(url, policy)['match_id'], 1)
+        self.assertFalse(http_util.BREAKER.stats()['open'])
+
+
+if __name__ == '__main__':
+    logging.getLogger("dota").setLevel(logging.CRITICAL)
+    unittest.main()
@@ -80,7 +80,7 @@ def write_to_database(summary, skill, end_time):
     """Update win rate data in database"""
 
     rows = []
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
 
     # Coerce to integers
     summary = summary.astype('int')
@@ -99,19 +99,23 @@ def write_to_database(summary, skill, end_time):
                 row['dire_win'],
                 row['dire_total']))
 
+    # Return the connection to the shared pool when done
     conn = engine.raw_connection()
-    cursor = conn.cursor()
-    stmt = "REPLACE INTO dota_hero_win_rate VALUES (%s, %s, %s, %s, %s, %s, " \
-           "%s, %s)"
-    cursor.executemany(stmt, rows)
-    conn.commit()
+    try:
+        cursor = conn.cursor()
+        stmt = "REPLACE INTO dota_hero_win_rate VALUES (%s, %s, %s, %s, %s, " \
+               "%s, %s, %s)"
+        cursor.executemany(stmt, rows)
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_current_win_rate_table(days):
     """Sets a summary table for current win rates, spanning `days` worth of
     time"""
 
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
     end = int(db_util.get_max_start_time())
     begin = int(end - days * 24 * 3600)
 
@@ -164,7 +168,7 @@ def main(days, skill):
     )
 
     # Get database connection
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
 
     with engine.connect() as conn:
         for ttime, btime, etime in zip(text, begin, end):
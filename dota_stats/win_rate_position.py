@@ -6,10 +6,10 @@ code to estimate role based on `prior` probability models.
 import os
 import json
 from itertools import permutations
-import mariadb
 import pandas as pd
 import numpy as np
 from dota_stats import meta
+from dota_stats.db_util import get_engine
 
 MATCH_CUTOFF = 30  # Number of matches needed to calculate winrate
 
@@ -127,18 +127,10 @@ class HeroMaxLikelihood:
 def main():
     """Main entry point"""
     # Database fetch
-    conn = mariadb.connect(
-        user=os.environ['DOTA_USERNAME'],
-        password=os.environ['DOTA_PASSWORD'],
-        host=os.environ['DOTA_HOSTNAME'],
-        database=os.environ['DOTA_DATABASE'])
-    cursor = conn.cursor()
-
     stmt = "SELECT match_id, radiant_heroes, dire_heroes, radiant_win FROM " \
            "dota_matches LIMIT 5000"
-    cursor.execute(stmt)
-
-    rows = cursor.fetchall()
+    with get_engine().connect() as conn:
+        rows = conn.execute(stmt).fetchall()
     print("{0} matches found in database".format(len(rows)))
 
     hml = HeroMaxLikelihood(os.path.join("analytics", "prior_final.json"))
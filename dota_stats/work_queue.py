@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Lease based work queue in the database, so `fetch.py` workers on several
+machines (each with its own Steam key) can share the same MariaDB without
+paging the same hero and skill at the same time.
+
+Items are (hero, skill, window) rows in `dota_fetch_queue`, where the window
+is the start of the hour the item was queued for. A worker claims an item by
+taking a lease on it, which it extends with heartbeats while it works, then
+marks the item done. If a worker dies its lease expires and the item can be
+claimed by another worker.
+
+Claims are a conditional `UPDATE` of a single row, checked with the row
+count, so they are atomic on any database (including SQLite, used for
+testing) without row locks.
+"""
+import os
+import time
+import socket
+import logging
+import threading
+from sqlalchemy import and_, or_
+from dota_stats.db_util import FetchWork
+
+LEASE_SECONDS = int(os.environ.get('DOTA_LEASE_SECONDS', 300))
+MAX_ATTEMPTS = 3    # Claims before an item is marked failed
+
+log = logging.getLogger("dota")
+
+
+class WorkQueue:
+    """Queue of fetch work items stored in the database behind `engine`.
+    `owner` identifies this worker in the leases it takes."""
+
+    def __init__(self, engine, owner=None, lease_seconds=LEASE_SECONDS):
+        self.engine = engine
+        self.owner = owner if owner is not None else \
+            "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.table = FetchWork.__table__
+
+    def _key(self, item):
+        """WHERE clause for a single item"""
+        return and_(self.table.c.hero == item.hero,
+                    self.table.c.skill == item.skill,
+                    self.table.c.window_start == item.window_start)
+
+    def enqueue(self, heroes, skills, window_start):
+        """Queue every (hero, skill) pair for `window_start`, skipping items
+        already queued. Returns the number of new items."""
+
+        with self.engine.begin() as conn:
+            existing = set((t.hero, t.skill) for t in conn.execute(
+                self.table.select().where(
+                    self.table.c.window_start == window_start)))
+
+            rows = [{'hero': hero, 'skill': skill,
+                     'window_start': window_start, 'status': 'pending',
+                     'owner': None, 'lease_expires': 0, 'attempts': 0,
+                     'updated': int(time.time())}
+                    for skill in skills for hero in heroes
+                    if (hero, skill) not in existing]
+            if rows:
+                conn.execute(self.table.insert(), rows)
+
+        return len(rows)
+
+    def claim(self):
+        """Lease the oldest available item, either pending or with an expired
+        lease. Returns the item, or None if there is nothing to do."""
+
+        now = int(time.time())
+        available = or_(self.table.c.status == 'pending',
+                        and_(self.table.c.status == 'leased',
+                             self.table.c.lease_expires < now))
+
+        with self.engine.connect() as conn:
+            candidates = conn.execute(
+                self.table.select().where(available).order_by(
+                    self.table.c.window_start, self.table.c.skill,
+                    self.table.c.hero).limit(20)).fetchall()
+
+            for item in candidates:
+                status = 'failed' if item.attempts >= MAX_ATTEMPTS \
+                    else 'leased'
+                result = conn.execute(
+                    self.table.update().where(
+                        and_(self._key(item), available)).values(
+                            status=status, owner=self.owner,
+                            lease_expires=now + self.lease_seconds,
+                            attempts=item.attempts + 1, updated=now))
+
+                # Someone else claimed it first, try the next one
+                if result.rowcount != 1:
+                    continue
+
+                if status == 'failed':
+                    log.error("Work item hero %d skill %d failed after %d "
+                              "attempts", item.hero, item.skill,
+                              item.attempts)
+                    continue
+
+                return conn.execute(self.table.select().where(
+                    self._key(item))).first()
+
+        return None
+
+    def _update_lease(self, item, **values):
+        """Update an item this worker holds the lease on, returns False if
+        the lease was lost"""
+
+        values['updated'] = int(time.time())
+        with self.engine.connect() as conn:
+            result = conn.execute(self.table.update().where(and_(
+                self._key(item), self.table.c.status == 'leased',
+                self.table.c.owner == self.owner)).values(**values))
+        return result.rowcount == 1
+
+    def heartbeat(self, item):
+        """Extend the lease on `item`, returns False if it was lost"""
+        return self._update_lease(
+            item, lease_expires=int(time.time()) + self.lease_seconds)
+
+    def complete(self, item):
+        """Mark `item` done, returns False if the lease was lost"""
+        return self._update_lease(item, status='done', lease_expires=0)
+
+    def release(self, item):
+        """Give up the lease on `item` so another worker can retry it"""
+        return self._update_lease(item, status='pending', owner=None,
+                                  lease_expires=0)
+
+    def stats(self):
+        """Number of items by status"""
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(self.table.select()).fetchall()
+
+        counts = {}
+        for row in rows:
+            counts[row.status] = counts.get(row.status, 0) + 1
+        return counts
+
+    def lease(self, item):
+        """Context manager sending heartbeats for `item` while it is worked
+        on"""
+        return Heartbeat(self, item)
+
+
+class Heartbeat:
+    """Extends a lease from a background thread every third of the lease
+    time, until the `with` block exits. The `lost` event is set if the lease
+    was taken by another worker."""
+
+    def __init__(self, work_queue, item):
+        self.work_queue = work_queue
+        self.item = item
+        self.lost = threading.Event()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        """Background heartbeat"""
+        interval = max(self.work_queue.lease_seconds / 3.0, 0.1)
+        while not self.stop.wait(interval):
+            if not self.work_queue.heartbeat(self.item):
+                log.error("Lost lease on hero %d skill %d", self.item.hero,
+                          self.item.skill)
+                self.lost.set()
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()